@@ -0,0 +1 @@
+../eva/audio_protocol.py
\ No newline at end of file
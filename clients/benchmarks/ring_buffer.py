@@ -0,0 +1,96 @@
+"""
+Measures the CPU time spent buffering microphone audio for snowboy hotword
+detection, with the previous deque-based ring buffer and the bytearray-based
+:class:`snowboy.ring_buffer.RingBuffer`.
+
+The workload mimics the headless client: PortAudio delivers 2048 frames of
+16-bit mono audio at 16 kHz (every 128 ms), and the detector loop reads the
+buffer every 30 ms. Audio is simulated as fast as possible and the CPU time per
+second of audio is reported, so run it on the target device (a Raspberry Pi for
+example) for meaningful numbers::
+
+    python3 clients/benchmarks/ring_buffer.py --seconds=600
+"""
+
+import os
+import sys
+import time
+import argparse
+import collections
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snowboy.ring_buffer import RingBuffer
+
+SAMPLE_RATE = 16000
+FRAMES_PER_BUFFER = 2048
+SAMPLE_WIDTH = 2
+POLL_INTERVAL = 0.03
+
+class DequeRingBuffer(object):
+    """
+    The previous ring buffer, which stores every byte as a Python int.
+    """
+    def __init__(self, size=4096):
+        self._buf = collections.deque(maxlen=size)
+
+    def extend(self, data):
+        self._buf.extend(data)
+
+    def get(self):
+        tmp = bytes(bytearray(self._buf))
+        self._buf.clear()
+        return tmp
+
+def previous_callback(ring_buffer, in_data):
+    """
+    The previous PortAudio callback, which allocated unused output data.
+    """
+    ring_buffer.extend(in_data)
+    play_data = chr(0) * len(in_data)
+    return play_data, 0
+
+def current_callback(ring_buffer, in_data):
+    """
+    The current PortAudio callback.
+    """
+    ring_buffer.extend(in_data)
+    return None, 0
+
+def run(ring_buffer, callback, seconds):
+    """
+    Simulates ``seconds`` of audio capture and detector polling.
+
+    :return: The CPU time used, in seconds.
+    """
+    chunk = os.urandom(FRAMES_PER_BUFFER * SAMPLE_WIDTH)
+    callback_interval = FRAMES_PER_BUFFER / float(SAMPLE_RATE)
+    next_callback = 0.0
+    clock = 0.0
+    read = 0
+    start = time.process_time()
+    while clock < seconds:
+        while next_callback <= clock:
+            callback(ring_buffer, chunk)
+            next_callback += callback_interval
+        read += len(ring_buffer.get())
+        clock += POLL_INTERVAL
+    elapsed = time.process_time() - start
+    assert read > 0
+    return elapsed
+
+def main():
+    """
+    Runs the benchmark and prints the results.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', help='Seconds of audio to simulate', type=int, default=300)
+    args = parser.parse_args()
+    size = SAMPLE_RATE * 5
+    previous = run(DequeRingBuffer(size), previous_callback, args.seconds)
+    current = run(RingBuffer(size), current_callback, args.seconds)
+    print('Simulated %s seconds of audio' %args.seconds)
+    print('deque ring buffer:     %.3f ms CPU per second of audio' %(previous * 1000 / args.seconds))
+    print('bytearray ring buffer: %.3f ms CPU per second of audio' %(current * 1000 / args.seconds))
+    print('CPU reduction: %.1f%%' %(100 * (1 - current / previous)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Compares the memory use and latency of the two ways clients can receive Eva
+messages:
+
+* ``processes`` - one subscriber process per channel (the previous design)
+* ``multiplexer`` - a single :class:`multiplexer.Multiplexer` thread
+
+Messages are published on every channel with their send time, and the delay
+until a handler receives them is recorded. Memory is the proportional set size
+of the subscriber processes (or the growth of this process for the multiplexer).
+
+Usage (against a running Eva MongoDB database or local pubsub socket)::
+
+    python3 clients/benchmarks/subscribers.py --mode=processes
+    python3 clients/benchmarks/subscribers.py --mode=multiplexer --socket-path=/tmp/eva.sock
+"""
+
+import os
+import sys
+import time
+import argparse
+from multiprocessing import Process, Queue
+from statistics import median
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pymongo import MongoClient
+from anypubsub import create_pubsub_from_settings
+from local_pubsub import LocalPubSub
+from multiplexer import Multiplexer
+
+CHANNELS = ['eva_benchmark_messages', 'eva_benchmark_responses']
+
+def get_pubsub(args):
+    """
+    Gets the pubsub object for the backend selected on the command line.
+    """
+    if args.socket_path:
+        return LocalPubSub(args.socket_path)
+    client = MongoClient(args.mongo_host, int(args.mongo_port))
+    return create_pubsub_from_settings({'backend': 'mongodb',
+                                        'client': client,
+                                        'database': 'eva',
+                                        'collection': 'communications'})
+
+def get_memory(pid):
+    """
+    Gets the proportional set size of a process in KiB (Linux only), so that
+    pages shared by forked processes are not counted twice. Falls back to the
+    resident set size on older kernels.
+    """
+    for path, field in (('/proc/%s/smaps_rollup' %pid, 'Pss:'), ('/proc/%s/status' %pid, 'VmRSS:')):
+        try:
+            with open(path) as status:
+                for line in status:
+                    if line.startswith(field):
+                        return int(line.split()[1])
+        except IOError:
+            continue
+    return 0
+
+def consume(args, channel, latencies):
+    """
+    The per-channel subscriber process, as clients used to run it.
+    """
+    subscriber = get_pubsub(args).subscribe(channel)
+    for message in subscriber:
+        if message is None:
+            time.sleep(0.1)
+            continue
+        latencies.put(time.time() - message['sent'])
+
+def start_processes(args, latencies):
+    """
+    Starts one subscriber process per channel.
+
+    :return: The process IDs to measure.
+    """
+    pids = []
+    for channel in CHANNELS:
+        process = Process(target=consume, args=(args, channel, latencies), daemon=True)
+        process.start()
+        pids.append(process.pid)
+    return pids
+
+def start_multiplexer(args, latencies):
+    """
+    Starts a multiplexer listening to every channel.
+
+    :return: The process IDs to measure.
+    """
+    multiplexer = Multiplexer(get_pubsub(args))
+    for channel in CHANNELS:
+        multiplexer.register(channel, lambda message: latencies.put(time.time() - message['sent']))
+    multiplexer.start()
+    return [os.getpid()]
+
+def main():
+    """
+    Runs the benchmark and prints the results.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['processes', 'multiplexer'], default='multiplexer')
+    parser.add_argument('--messages', help='Messages published per channel', type=int, default=50)
+    parser.add_argument('--interval', help='Seconds between messages', type=float, default=0.05)
+    parser.add_argument('--mongo-host', default='localhost')
+    parser.add_argument('--mongo-port', default=27017)
+    parser.add_argument('--socket-path', help="Eva's local pubsub socket (instead of MongoDB)")
+    args = parser.parse_args()
+    latencies = Queue()
+    baseline = get_memory(os.getpid())
+    if args.mode == 'processes':
+        pids = start_processes(args, latencies)
+    else:
+        pids = start_multiplexer(args, latencies)
+    # Let the subscribers connect.
+    time.sleep(2)
+    publisher = get_pubsub(args)
+    for _ in range(args.messages):
+        for channel in CHANNELS:
+            publisher.publish(channel, {'sent': time.time()})
+        time.sleep(args.interval)
+    time.sleep(2)
+    memory = sum(get_memory(pid) for pid in pids)
+    if args.mode == 'multiplexer':
+        memory -= baseline
+    received = []
+    while not latencies.empty():
+        received.append(latencies.get() * 1000)
+    received.sort()
+    print('Mode: %s' %args.mode)
+    print('Subscriber processes: %s' %(len(pids) if args.mode == 'processes' else 0))
+    print('Subscriber memory: %.1f MiB' %(memory / 1024.0))
+    print('Messages received: %s/%s' %(len(received), args.messages * len(CHANNELS)))
+    if received:
+        print('Latency (ms): median %.2f, p95 %.2f, max %.2f' \
+              %(median(received), received[int(len(received) * 0.95) - 1], received[-1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Evaluates the client-side endpointer (:class:`vad.Endpointer`) on a set of
+recordings, and reports how much audio it trims and how accurately it finds the
+speech in every one of them.
+
+Without arguments, a set of synthetic utterances is generated (voiced speech
+with syllables and pauses, in quiet and noisy rooms, spoken early or late, or
+already under way when recording starts, and with a microphone that takes a
+chunk to come up to level).
+They can be written out as WAV fixtures, along with their ``labels.csv``
+(``name,speech start,speech end`` in seconds), to be re-evaluated or tweaked::
+
+    python3 clients/benchmarks/vad.py --write-fixtures=/tmp/vad-fixtures
+    python3 clients/benchmarks/vad.py --fixtures=/tmp/vad-fixtures
+
+Any directory of 16-bit mono WAV recordings can be evaluated the same way; add
+a ``labels.csv`` file to get boundary errors. Thresholds can be tuned with the
+same options as the headless client (``--vad-energy`` for example).
+
+Every recording is fed in chunks of 2048 samples, like the microphone does, and
+recording normally lasts 5 seconds.
+"""
+
+import os
+import sys
+import csv
+import wave
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy
+from vad import Endpointer
+
+SAMPLE_RATE = 16000
+CHUNK_SAMPLES = 2048
+DURATION = 5.0
+
+def synthetic_speech(duration, rng, level=-20.0):
+    """
+    Generates a voiced, speech-like signal: a harmonic tone with a wandering
+    pitch, split in syllables by an amplitude envelope.
+
+    :return: The samples, as floats between -1 and 1.
+    :rtype: numpy.ndarray
+    """
+    count = int(duration * SAMPLE_RATE)
+    time = numpy.arange(count) / float(SAMPLE_RATE)
+    pitch = 130 + 30 * numpy.sin(2 * numpy.pi * 0.7 * time + rng.uniform(0, 6))
+    phase = 2 * numpy.pi * numpy.cumsum(pitch) / SAMPLE_RATE
+    signal = sum(numpy.sin(harmonic * phase) / harmonic for harmonic in range(1, 8))
+    syllables = 0.55 + 0.45 * numpy.sin(2 * numpy.pi * 4 * time) ** 2
+    signal *= syllables
+    # Fade in/out over 30ms.
+    ramp = numpy.minimum(1, numpy.minimum(time, duration - time) / 0.03)
+    signal *= ramp
+    rms = numpy.sqrt(numpy.mean(signal ** 2))
+    return signal / rms * 10 ** (level / 20)
+
+def noise(count, rng, level):
+    """
+    Generates low-passed background noise (roughly like a fan or a room).
+
+    :return: The samples, as floats between -1 and 1.
+    :rtype: numpy.ndarray
+    """
+    white = rng.standard_normal(count + 8)
+    hum = numpy.convolve(white, numpy.ones(8) / 8, mode='valid')[:count]
+    return hum / numpy.sqrt(numpy.mean(hum ** 2)) * 10 ** (level / 20)
+
+def synthetic_fixtures():
+    """
+    Generates the synthetic test set.
+
+    :return: A list of ``(name, samples, speech start, speech end)`` tuples,
+        with 16-bit samples.
+    :rtype: list
+    """
+    rng = numpy.random.default_rng(7)
+    cases = [
+        # name, noise level, [(speech start, speech end), ...], muted seconds
+        ('quiet-early', -65.0, [(0.3, 1.6)], 0.0),
+        ('quiet-late', -65.0, [(1.8, 2.9)], 0.0),
+        ('quiet-two-words', -65.0, [(0.5, 1.1), (1.4, 2.2)], 0.0),
+        ('noisy-early', -40.0, [(0.4, 1.8)], 0.0),
+        ('noisy-two-words', -40.0, [(0.6, 1.2), (1.5, 2.6)], 0.0),
+        ('noisy-long', -40.0, [(0.5, 3.8)], 0.0),
+        ('noisy-immediate', -40.0, [(0.0, 1.5)], 0.0),
+        ('noisy-muted-start', -40.0, [(1.0, 2.2)], 0.13),
+        ('silence', -60.0, [], 0.0),
+    ]
+    fixtures = []
+    for name, noise_level, words, muted in cases:
+        signal = noise(int(DURATION * SAMPLE_RATE), rng, noise_level)
+        # The microphone only picks up a fraction of the room at first.
+        signal[:int(muted * SAMPLE_RATE)] *= 0.01
+        for start, end in words:
+            first = int(start * SAMPLE_RATE)
+            speech = synthetic_speech(end - start, rng)
+            signal[first:first + len(speech)] += speech
+        samples = numpy.clip(signal * 32767, -32768, 32767).astype('<i2')
+        if words:
+            fixtures.append((name, samples, words[0][0], words[-1][1]))
+        else:
+            fixtures.append((name, samples, None, None))
+    return fixtures
+
+def read_fixtures(path):
+    """
+    Reads the WAV recordings of a directory, and their labels if any.
+
+    :return: A list of ``(name, samples, speech start, speech end)`` tuples.
+    :rtype: list
+    """
+    labels = {}
+    labels_path = os.path.join(path, 'labels.csv')
+    if os.path.exists(labels_path):
+        with open(labels_path) as labels_file:
+            for row in csv.reader(labels_file):
+                if row and row[0] != 'name':
+                    labels[row[0]] = (float(row[1]) if row[1] else None,
+                                      float(row[2]) if row[2] else None)
+    fixtures = []
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith('.wav'):
+            continue
+        name = filename[:-4]
+        with wave.open(os.path.join(path, filename), 'rb') as wav:
+            if wav.getsampwidth() != 2 or wav.getnchannels() != 1 or \
+               wav.getframerate() != SAMPLE_RATE:
+                print('Skipping %s: not 16-bit mono %s Hz audio' %(filename, SAMPLE_RATE))
+                continue
+            samples = numpy.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2')
+        start, end = labels.get(name, (None, None))
+        fixtures.append((name, samples, start, end))
+    return fixtures
+
+def write_fixtures(path, fixtures):
+    """
+    Writes fixtures as WAV files, along with their labels.
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'labels.csv'), 'w') as labels_file:
+        writer = csv.writer(labels_file)
+        writer.writerow(['name', 'start', 'end'])
+        for name, samples, start, end in fixtures:
+            with wave.open(os.path.join(path, name + '.wav'), 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(SAMPLE_RATE)
+                wav.writeframes(samples.tobytes())
+            writer.writerow([name, '' if start is None else start, '' if end is None else end])
+    print('Wrote %s fixtures to %s' %(len(fixtures), path))
+
+def evaluate(endpointer, samples):
+    """
+    Feeds a recording to the endpointer in microphone-sized chunks.
+
+    :return: The number of samples sent, and the number of samples recorded
+        before the endpointer ended the utterance.
+    :rtype: tuple
+    """
+    pcm = samples.tobytes()
+    recorded = [0]
+    def chunks():
+        for offset in range(0, len(pcm), CHUNK_SAMPLES * 2):
+            chunk = pcm[offset:offset + CHUNK_SAMPLES * 2]
+            recorded[0] += len(chunk) // 2
+            yield chunk
+    sent = sum(len(data) for data in endpointer.process(chunks())) // 2
+    return sent, recorded[0]
+
+def score(endpointer, start, end):
+    """
+    Compares the speech found by the endpointer in the last recording with
+    its labels.
+
+    :param endpointer: The endpointer that processed the recording.
+    :type endpointer: :class:`vad.Endpointer`
+    :param start: The labelled start of speech, in seconds (``None`` if the
+        recording is silent or unlabelled).
+    :type start: float
+    :param end: The labelled end of speech, in seconds.
+    :type end: float
+    :return: The start and end errors, in seconds (``None`` if unknown), and
+        whether speech was cut (``yes``/``no``), ``missed``, found where there
+        was none (``false``), or ``None`` if unknown.
+    :rtype: tuple
+    """
+    if endpointer.speech_start is not None and start is not None:
+        detected_start = endpointer.speech_start * endpointer.frame_duration
+        detected_end = endpointer.speech_end * endpointer.frame_duration
+        padding = endpointer.padding_frames * endpointer.frame_duration
+        cut = 'yes' if detected_start - padding > start or detected_end + padding < end else 'no'
+        return detected_start - start, detected_end - end, cut
+    if start is not None:
+        return None, None, 'missed'
+    if endpointer.speech_start is not None:
+        return None, None, 'false'
+    return None, None, None
+
+def main():
+    """
+    Runs the evaluation and prints the results.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', help='Directory of WAV recordings (and labels.csv) to evaluate')
+    parser.add_argument('--write-fixtures', help='Write the synthetic fixtures to this directory and exit')
+    parser.add_argument('--vad-energy', help='Minimum energy of speech, in dBFS', type=float, default=-45.0)
+    parser.add_argument('--vad-margin', help='How much louder than the noise floor speech is, in dB', type=float, default=10.0)
+    parser.add_argument('--vad-zcr', help='Maximum zero-crossing rate of speech', type=float, default=0.35)
+    parser.add_argument('--vad-silence', help='Seconds of silence that end the command', type=float, default=0.5)
+    args = parser.parse_args()
+    if args.write_fixtures:
+        write_fixtures(args.write_fixtures, synthetic_fixtures())
+        return
+    fixtures = read_fixtures(args.fixtures) if args.fixtures else synthetic_fixtures()
+    endpointer = Endpointer(SAMPLE_RATE, energy_threshold=args.vad_energy,
+                            noise_margin=args.vad_margin, zcr_threshold=args.vad_zcr,
+                            silence_timeout=args.vad_silence)
+    total_recorded = 0
+    total_sent = 0
+    print('%-20s %8s %8s %8s %8s %8s %8s' %('fixture', 'length', 'sent', 'ended', 'start', 'end', 'cut'))
+    for name, samples, start, end in fixtures:
+        sent, recorded = evaluate(endpointer, samples)
+        total_sent += sent
+        total_recorded += min(len(samples), int(DURATION * SAMPLE_RATE))
+        start_error, end_error, cut = score(endpointer, start, end)
+        print('%-20s %7.2fs %7.2fs %7.2fs %8s %8s %8s' %(
+            name, len(samples) / float(SAMPLE_RATE), sent / float(SAMPLE_RATE),
+            recorded / float(SAMPLE_RATE),
+            '-' if start_error is None else '%+.2f' %start_error,
+            '-' if end_error is None else '%+.2f' %end_error, cut or '-'))
+    print('Audio sent: %.2fs out of %.2fs recorded (%.1f%% less)' %(
+        total_sent / float(SAMPLE_RATE), total_recorded / float(SAMPLE_RATE),
+        100 * (1 - total_sent / float(total_recorded))))
+
+if __name__ == '__main__':
+    main()
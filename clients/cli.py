@@ -6,8 +6,7 @@ Please use the local_cli.py or remote_cli.py to interact with Eva via the
 command line.
 """
 
-import time
-from multiprocessing import Process
+from multiplexer import Multiplexer
 
 class CLI(object):
     """
@@ -18,7 +17,23 @@ class CLI(object):
     See the LocalCLI and RemoteCLI objects for examples.
     """
     def __init__(self):
-        self.process = None
+        self.pubsub = None
+        self.multiplexer = None
+
+    def get_multiplexer(self):
+        """
+        Gets the multiplexer that receives the messages of every channel this
+        client listens to, over a single connection.
+
+        :return: The started multiplexer.
+        :rtype: multiplexer.Multiplexer
+        """
+        if self.pubsub is None:
+            self.pubsub = self.get_pubsub()
+        if self.multiplexer is None:
+            self.multiplexer = Multiplexer(self.pubsub)
+            self.multiplexer.start()
+        return self.multiplexer
 
     def start_consumer(self, queue, response_prefix='Eva Message: '):
         """
@@ -29,33 +44,21 @@ class CLI(object):
         :param response_prefix: A string that will prefix all messages from the queue.
         :type response_prefix: string
         """
-        self.process = Process(target=self.consume_messages, args=(queue, response_prefix))
-        self.process.start()
+        self.get_multiplexer().register(queue, lambda message: self.print_message(message, response_prefix))
 
-    def consume_messages(self, queue, response_prefix):
+    def print_message(self, message, response_prefix): #pylint: disable=R0201
         """
-        A method that consumes the messages from the queue specified.
-        Will automatically print the messages to the CLI.
-        This is the method used to fire off a separate process in the
-        ``start_consumer`` method.
-        It will continuously tail the MongoDB collection holding the messages.
+        Prints a message received from Eva to the CLI.
 
-        :param queue: The channel to receive messages from.
-        :type queue: string
-        :param response_prefix: A string that will prefix all messages from the queue.
+        :param message: The message received.
+        :type message: string or dict
+        :param response_prefix: A string that will prefix the message.
         :type response_prefix: string
         """
-        # Need to listen for messages and print them to the CLI.
-        pubsub = self.get_pubsub()
-        subscriber = pubsub.subscribe(queue)
-        # Subscriber will continuously tail the mongodb collection queue.
-        for message in subscriber:
-            if message is not None:
-                if isinstance(message, dict):
-                    print('%s%s' %(response_prefix, message['output_text']))
-                else:
-                    print('%s%s' %(response_prefix, message))
-            time.sleep(0.1)
+        if isinstance(message, dict):
+            print('%s%s' %(response_prefix, message['output_text']))
+        else:
+            print('%s%s' %(response_prefix, message))
 
     def get_pubsub(self):
         """
@@ -79,7 +82,8 @@ class CLI(object):
         """
         if command is not None:
             results = self.get_results(command)
-            self.handle_results(results)
+            if results is not None:
+                self.handle_results(results)
         else:
             print('=== Eva CLI ===')
             while True:
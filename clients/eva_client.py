@@ -0,0 +1,216 @@
+"""
+A client library to send commands to a running Eva server and wait for the
+matching responses from scripts and integrations.
+
+Every request returns a :class:`concurrent.futures.Future` that resolves to
+Eva's response (or fails with :class:`TimeoutError`), so many requests can be
+outstanding at once over a single connection::
+
+    from eva_client import EvaClient
+    client = EvaClient.connect(host='localhost', port=27017)
+    futures = [client.request('What time is it?') for _ in range(100)]
+    for future in futures:
+        print(future.result()['output_text'])
+    print(client.interact('Hello', timeout=10)['output_text'])
+
+Or from asyncio code::
+
+    response = await client.request_async('Hello')
+
+Responses are matched to requests with a per-request ID, on this client's own
+reply channel (``eva_responses_<client_id>``). The only dependencies are
+pymongo and anypubsub (or none at all with the local pubsub backend).
+"""
+
+import time
+import uuid
+import heapq
+import asyncio
+import threading
+from concurrent.futures import Future
+from pymongo import MongoClient
+from anypubsub import create_pubsub_from_settings
+from local_pubsub import LocalPubSub
+from multiplexer import Multiplexer
+
+def get_pubsub(host='localhost', port=27017, username='', password='', socket_path=None):
+    """
+    Connects to the pubsub of an Eva server.
+
+    :param host: The hostname or IP of Eva's MongoDB instance.
+    :type host: string
+    :param port: The port of Eva's MongoDB instance.
+    :type port: integer
+    :param username: The MongoDB username.
+    :type username: string
+    :param password: The MongoDB password.
+    :type password: string
+    :param socket_path: Eva's local pubsub socket (instead of MongoDB, same
+        machine only).
+    :type socket_path: string
+    :return: The pubsub object used to send/receive messages to/from Eva.
+    :rtype: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    """
+    if socket_path is not None:
+        return LocalPubSub(socket_path)
+    uri = 'mongodb://'
+    if len(username) > 0:
+        uri = uri + username
+        if len(password) > 0:
+            uri = uri + ':' + password + '@'
+        else:
+            uri = uri + '@'
+    uri = '%s%s:%s' %(uri, host, port)
+    client = MongoClient(uri)
+    return create_pubsub_from_settings({'backend': 'mongodb',
+                                        'client': client,
+                                        'database': 'eva',
+                                        'collection': 'communications'})
+
+class EvaClient(object):
+    """
+    Sends commands to Eva and resolves a future with every response.
+    """
+    def __init__(self, pubsub, timeout=30, multiplexer=None):
+        """
+        :param pubsub: The pubsub object connected to Eva (see
+            :func:`get_pubsub`).
+        :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+        :param timeout: The default number of seconds to wait for a response.
+        :type timeout: float
+        :param multiplexer: An existing (started) multiplexer to receive
+            responses with (a new one is started otherwise).
+        :type multiplexer: multiplexer.Multiplexer
+        :raises TimeoutError: If the reply channel could not be subscribed to
+            within ``timeout`` seconds.
+        """
+        self.pubsub = pubsub
+        self.timeout = timeout
+        self.client_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        # Futures of the outstanding requests, by request ID.
+        self.pending = {}
+        # Heap of (deadline, request ID) used to expire requests.
+        self.deadlines = []
+        self.wakeup = threading.Event()
+        self.reaper = threading.Thread(target=self.expire, daemon=True)
+        self.reaper.start()
+        if multiplexer is None:
+            multiplexer = Multiplexer(pubsub)
+            multiplexer.start()
+        self.multiplexer = multiplexer
+        # Wait until we listen before sending anything so that no response is missed.
+        ready = self.multiplexer.register('eva_responses_%s' %self.client_id, self.resolve)
+        if not ready.wait(timeout):
+            raise TimeoutError('Could not subscribe to the reply channel')
+
+    @classmethod
+    def connect(cls, host='localhost', port=27017, username='', password='',
+                socket_path=None, timeout=30):
+        """
+        Creates a client connected to an Eva server (see :func:`get_pubsub`).
+
+        :return: The client.
+        :rtype: EvaClient
+        """
+        return cls(get_pubsub(host, port, username, password, socket_path), timeout)
+
+    def request(self, command, timeout=None, **data):
+        """
+        Sends a command to Eva without waiting for the response.
+
+        :param command: The query/command to send Eva.
+        :type command: string
+        :param timeout: Seconds before the future fails with
+            :class:`TimeoutError` (defaults to the client's timeout).
+        :type timeout: float
+        :param data: Any other data to send along with the command
+            (``input_audio`` for example).
+        :return: A future resolving to Eva's response dict.
+        :rtype: :class:`concurrent.futures.Future`
+        """
+        request_id = uuid.uuid4().hex
+        future = Future()
+        future.set_running_or_notify_cancel()
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        with self.lock:
+            self.pending[request_id] = future
+            heapq.heappush(self.deadlines, (deadline, request_id))
+            if self.deadlines[0][1] == request_id:
+                self.wakeup.set()
+        data.update({'input_text': command,
+                     'client_id': self.client_id,
+                     'request_id': request_id})
+        try:
+            self.pubsub.publish('eva_commands', data)
+        except Exception as err: #pylint: disable=W0703
+            self.fail(request_id, err)
+        return future
+
+    def request_async(self, command, timeout=None, **data):
+        """
+        Same as :meth:`request`, for asyncio code.
+
+        :return: An awaitable resolving to Eva's response dict.
+        :rtype: :class:`asyncio.Future`
+        """
+        return asyncio.wrap_future(self.request(command, timeout, **data))
+
+    def interact(self, command, timeout=None, **data):
+        """
+        Sends a command to Eva and waits for the response.
+
+        :return: Eva's response dict.
+        :rtype: dict
+        :raises TimeoutError: If Eva did not respond in time.
+        """
+        return self.request(command, timeout, **data).result()
+
+    def resolve(self, message):
+        """
+        Resolves the future of the request a response is for. Responses to
+        unknown (expired) requests are dropped.
+
+        :param message: A response received on this client's reply channel.
+        :type message: dict
+        """
+        if not isinstance(message, dict):
+            return
+        with self.lock:
+            future = self.pending.pop(message.get('request_id'), None)
+        if future is not None:
+            future.set_result(message)
+
+    def fail(self, request_id, error):
+        """
+        Fails the future of a request (if it is still pending).
+        """
+        with self.lock:
+            future = self.pending.pop(request_id, None)
+        if future is not None:
+            future.set_exception(error)
+
+    def expire(self):
+        """
+        Fails the requests that were not answered in time. Runs in a
+        background thread.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                expired = []
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(self.deadlines)[1])
+                wait = self.deadlines[0][0] - now if self.deadlines else None
+                self.wakeup.clear()
+            for request_id in expired:
+                self.fail(request_id, TimeoutError('Eva did not respond in time'))
+            self.wakeup.wait(wait)
+
+    def outstanding(self):
+        """
+        :return: The number of requests waiting for a response.
+        :rtype: integer
+        """
+        with self.lock:
+            return len(self.pending)
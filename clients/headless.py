@@ -32,7 +32,7 @@ Requirements
 
     ``pip3 install pyusb``
 
-* Requires pydub for converting mp3 and ogg to wav for playback
+* Requires pydub and ffmpeg for decoding mp3 and ogg for playback
 
     ``pip3 install pydub``
 
@@ -56,12 +56,22 @@ Requirements
 
     ``pip3 install pymongo --user``
 
-* Requires that Eva have the
-    `Audio Server <https://github.com/edouardpoitras/eva-audio-server>`_ plugin enabled
+* Requires the `Audio Server <https://github.com/edouardpoitras/eva-audio-server>`_
+    plugin enabled, or Eva's audio receiver enabled (``enabled = True`` in the
+    ``[audio]`` configuration section) with ``--framed-audio``
 
 Optional
 ++++++++
 
+Silence before and after commands is trimmed on the client (and recording stops
+as soon as you stop talking) when numpy is installed:
+
+    ``pip3 install numpy --user``
+
+The thresholds can be tuned with the ``--vad-*`` options (see ``--help``), or
+the whole recording sent with ``--no-vad``. To check them against your own
+recordings, see ``clients/benchmarks/vad.py``.
+
 You may optionally use `snowboy`_ for keyword
 detection. To do so, you need to get the ``_snowboydetect.so`` binary for your
 platform (the one found at ``clients/snowboy/_snowboydetect.so`` in this repo is
@@ -93,15 +103,21 @@ Or with a snowboy model:
 
 import os
 import time
+import uuid
 import socket
 import argparse
-from threading import Thread, Event
-from multiprocessing import Process
+import subprocess
+from io import BytesIO
+from threading import Thread, Event, Lock
 from respeaker.microphone import Microphone
 from pymongo import MongoClient
 from anypubsub import create_pubsub_from_settings
+from local_pubsub import LocalPubSub
+from audio_protocol import AudioStreamSender
+from multiplexer import Multiplexer
+import pyaudio
 from pydub import AudioSegment
-from pydub.playback import play as pydub_play
+from pydub.utils import which
 
 # Check for Snowboy.
 try:
@@ -109,115 +125,275 @@ try:
 except: #pylint: disable=W0702
     print('WARNING: Could not import Snowboy decoder/model - falling back to Pocketsphinx')
 
+# Check for numpy (used to trim silence from commands).
+try:
+    from vad import Endpointer
+except ImportError:
+    Endpointer = None
+    print('WARNING: Could not import numpy - commands will be sent without trimming silence')
+
 # Arguments passed via command line.
 ARGS = None
 
+# The ID sent with framed audio, so that Eva responds on our own channel.
+CLIENT_ID = 'headless-%s' %uuid.uuid4().hex
+
 # The sound played when Eva recognizes the keyword for recording.
 PING_FILE = os.path.abspath(os.path.dirname(__file__)) + '/resources/ping.wav'
 PONG_FILE = os.path.abspath(os.path.dirname(__file__)) + '/resources/pong.wav'
 
+# Every sound is converted to this format before playback.
+PLAYBACK_RATE = 44100
+PLAYBACK_CHANNELS = 2
+# Bytes of decoded audio written to the output stream at once (~50ms).
+PLAYBACK_CHUNK_SIZE = 8820
+
+# The audio player of the current process (see get_player()).
+PLAYER = None
+
+# The ping/pong sounds, decoded once on startup (see load_cues()).
+CUES = {}
+
 # Pocketsphinx/respeaker configuration.
 os.environ['POCKETSPHINX_DIC'] = os.path.abspath(os.path.dirname(__file__)) + '/dictionary.txt'
 os.environ['POCKETSPHINX_KWS'] = os.path.abspath(os.path.dirname(__file__)) + '/keywords.txt'
 
-class DummyDecoder(object): #pylint: disable=R0903
-    """
-    Fake decoder in order to use respeaker's listen() method without setting
-    up a pocketsphinx decoder.
-    """
-    def start_utt(self):
-        """
-        Overloaded method that simply passes.
-        """
-        pass
-
-
 def listen(quit_event):
     """
-    Utilizes respeaker's Microphone object to listen for keyword and sends audio
-    data to Eva over the network once the keyword is heard.
+    Utilizes respeaker's Microphone object (or a snowboy hotword detector) to
+    listen for keyword and sends audio data to Eva over the network once the
+    keyword is heard.
 
     Audio data will be sent for a maximum of 5 seconds and will stop sending
-    after 1 second of silence.
+    after 1 second of silence (or as soon as speech stops, see
+    :func:`handle_command`).
+
+    The snowboy detector is created once: it pauses detection while the
+    command is recorded from its own input stream, then resumes right away.
+    Its pre-roll is cleared once the ping was played, so that neither the
+    hotword nor the ping are recorded.
 
     :param quit_event: A threading event object used to abort listening.
     :type quit_event: :class:`threading.Event`
     """
     global ARGS
-    global mic
     if ARGS.snowboy_model:
-        mic = Microphone(quit_event=quit_event, decoder=DummyDecoder())
-        while not quit_event.is_set():
-            detector = snowboy.snowboydecoder.HotwordDetector(ARGS.snowboy_model, sensitivity=0.5)
-            detector.start(detected_callback=handle_command,
+        detector = snowboy.snowboydecoder.HotwordDetector(ARGS.snowboy_model, sensitivity=0.5)
+        try:
+            detector.start(detected_callback=lambda: handle_command(detector.listen, detector.clear),
                            interrupt_check=quit_event.is_set,
                            sleep_time=0.03)
+        finally:
             detector.terminate()
     else:
         mic = Microphone(quit_event=quit_event)
         while not quit_event.is_set():
             if mic.wakeup(ARGS.keyword):
-                handle_command()
+                handle_command(mic.listen)
 
-def handle_command():
-    global mic
-    play(PING_FILE)
+def handle_command(record, cued=None):
+    """
+    Plays the ping sound, records the command and streams it to Eva, then
+    plays the pong sound.
+
+    Unless ``--no-vad`` was provided (or numpy is missing), the silence before
+    and after the command is trimmed as it is recorded, and recording stops
+    as soon as speech stops (see ``vad.py``).
+
+    :param record: The function recording the command (such as
+        respeaker.microphone.Microphone.listen()).
+    :type record: function
+    :param cued: The function called once the ping was played (such as
+        snowboy.snowboydecoder.HotwordDetector.clear()).
+    :type cued: function
+    """
+    global ARGS
+    get_player().play_pcm(CUES['ping'])
+    if cued is not None:
+        cued()
     print('Listening...')
-    data = mic.listen(duration=5, timeout=1)
+    data = record(duration=5, timeout=1)
+    if Endpointer is not None and not ARGS.no_vad:
+        endpointer = Endpointer(energy_threshold=ARGS.vad_energy,
+                                noise_margin=ARGS.vad_margin,
+                                zcr_threshold=ARGS.vad_zcr,
+                                silence_timeout=ARGS.vad_silence)
+        data = endpointer.process(data)
     udp_stream(data)
     print('Done')
-    play(PONG_FILE)
+    get_player().play_pcm(CUES['pong'])
 
-def play(filepath, content_type='audio/wav'):
+class AudioPlayer(object):
     """
-    Will attempt to play various audio file types (wav, ogg, mp3).
+    Plays audio through a single output stream that stays open for the life
+    of the process. Everything is converted to the same format
+    (:data:`PLAYBACK_RATE`, :data:`PLAYBACK_CHANNELS`, 16-bit) before playback,
+    so the stream never needs to be re-opened.
     """
-    if 'wav' in content_type:
-        sound = AudioSegment.from_wav(filepath)
-    elif 'ogg' in content_type or 'opus' in content_type:
-        sound = AudioSegment.from_ogg(filepath)
-    elif 'mp3' in content_type or 'mpeg' in content_type:
-        sound = AudioSegment.from_mp3(filepath)
-    pydub_play(sound)
+    def __init__(self):
+        self.pyaudio = pyaudio.PyAudio()
+        self.stream = None
+        self.lock = Lock()
+
+    def get_stream(self):
+        """
+        Opens the output stream on first use.
+        """
+        if self.stream is None:
+            self.stream = self.pyaudio.open(format=pyaudio.paInt16,
+                                            channels=PLAYBACK_CHANNELS,
+                                            rate=PLAYBACK_RATE,
+                                            output=True)
+        return self.stream
+
+    def play_pcm(self, pcm):
+        """
+        Plays PCM audio data that is already in the playback format.
+
+        :param pcm: The audio data.
+        :type pcm: bytes
+        """
+        with self.lock:
+            self.get_stream().write(pcm)
+
+    def play(self, audio, content_type='audio/wav'):
+        """
+        Plays audio data (wav, ogg, mp3) from memory. Playback starts as soon as
+        the first frames are decoded.
+
+        :param audio: The audio file content.
+        :type audio: bytes
+        :param content_type: The content type of the audio.
+        :type content_type: string
+        """
+        with self.lock:
+            stream = self.get_stream()
+            for pcm in decode_audio(audio, content_type):
+                stream.write(pcm)
+
+def get_audio_format(content_type):
+    """
+    Gets the ffmpeg/pydub format name for a content type (wav, ogg, mp3).
+    """
+    if 'ogg' in content_type or 'opus' in content_type:
+        return 'ogg'
+    if 'mp3' in content_type or 'mpeg' in content_type:
+        return 'mp3'
+    return 'wav'
+
+def decode_audio(audio, content_type):
+    """
+    Decodes audio data into the playback format. Uses an ffmpeg process fed
+    from memory so that decoded chunks are yielded as soon as they are ready,
+    falling back to decoding everything at once with pydub.
+
+    :param audio: The audio file content.
+    :type audio: bytes
+    :param content_type: The content type of the audio.
+    :type content_type: string
+    :return: A generator of PCM chunks in the playback format.
+    :rtype: Generator
+    """
+    audio_format = get_audio_format(content_type)
+    ffmpeg = which('ffmpeg')
+    if ffmpeg is None:
+        yield to_playback_format(AudioSegment.from_file(BytesIO(audio), format=audio_format))
+        return
+    process = subprocess.Popen([ffmpeg, '-loglevel', 'error', '-f', audio_format, '-i', 'pipe:0',
+                                '-f', 's16le', '-ac', str(PLAYBACK_CHANNELS),
+                                '-ar', str(PLAYBACK_RATE), 'pipe:1'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # Feed ffmpeg from another thread so that its output can be read meanwhile.
+    feeder = Thread(target=feed_process, args=(process, audio), daemon=True)
+    feeder.start()
+    try:
+        while True:
+            pcm = process.stdout.read(PLAYBACK_CHUNK_SIZE)
+            if not pcm:
+                break
+            yield pcm
+    finally:
+        process.stdout.close()
+        process.wait()
+
+def feed_process(process, data):
+    """
+    Writes data to a process' standard input and closes it.
+    """
+    try:
+        process.stdin.write(data)
+        process.stdin.close()
+    except OSError:
+        pass
+
+def to_playback_format(sound):
+    """
+    Converts a pydub AudioSegment into PCM data in the playback format.
+
+    :param sound: The sound to convert.
+    :type sound: pydub.AudioSegment
+    :rtype: bytes
+    """
+    sound = sound.set_frame_rate(PLAYBACK_RATE).set_channels(PLAYBACK_CHANNELS).set_sample_width(2)
+    return sound.raw_data
+
+def get_player():
+    """
+    Gets the audio player shared by the wake word cues and the message
+    handlers. Sounds are played one at a time.
+
+    :rtype: AudioPlayer
+    """
+    global PLAYER
+    if PLAYER is None:
+        PLAYER = AudioPlayer()
+    return PLAYER
+
+def load_cues():
+    """
+    Decodes the ping/pong sounds into the playback format so that they can be
+    played instantly on every wake word.
+    """
+    CUES['ping'] = to_playback_format(AudioSegment.from_wav(PING_FILE))
+    CUES['pong'] = to_playback_format(AudioSegment.from_wav(PONG_FILE))
 
 def udp_stream(data):
     """
     Simple helper function to send a generator type object containing audio
     data, over to Eva. Uses UDP as protocol.
 
+    The raw PCM chunks are sent as-is (for the Audio Server plugin), unless
+    ``--framed-audio`` was provided, in which case the audio is sent with Eva's
+    framed protocol (see ``audio_protocol.py``) to Eva's audio receiver.
+
     :param data: Generator type object returned from
         respeaker.microphone.Microphone.listen().
     :type data: Generator
     """
     global ARGS
+    if ARGS.framed_audio:
+        AudioStreamSender(ARGS.eva_host, ARGS.audio_port, ARGS.audio_codec,
+                          client_id=CLIENT_ID).send(data)
+        return
     udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     for d in data:
-        udp.sendto(d, (ARGS.eva_host, ARGS.audio_port))
+        udp.sendto(d, (ARGS.eva_host, int(ARGS.audio_port)))
     udp.close()
 
-def start_consumer(queue):
-    """
-    Starts a consumer to listen for pubsub-style messages on the specified
-    queue. Will connect to a MongoDB server specified in the parameters.
-
-    Uses multiprocessing.Process for simplicity.
-
-    :param queue: The message queue to listen for messages on.
-    :type queue: string
-    """
-    process = Process(target=consume_messages, args=(queue,))
-    process.start()
-
 def get_pubsub():
     """
     Helper function to get a anypubsub.MongoPubSub object based on parameters
     specified by command line. Will tail the 'eva' database's 'communications'
     collection for pubsub messages.
 
+    If ``--socket-path`` was provided, Eva's local pubsub socket is used instead.
+
     :return: The anypubsub object used for receiving Eva messages.
-    :rtype: anypubsub.backends.MongoPubSub
+    :rtype: anypubsub.backends.MongoPubSub or local_pubsub.LocalPubSub
     """
     global ARGS
+    if ARGS.socket_path:
+        return LocalPubSub(ARGS.socket_path)
     uri = 'mongodb://'
     if len(ARGS.mongo_username) > 0:
         uri = uri + ARGS.mongo_username
@@ -230,30 +406,19 @@ def get_pubsub():
                                         'database': 'eva',
                                         'collection': 'communications'})
 
-def consume_messages(queue):
+def handle_message(message):
     """
-    The worker function that is spawned in the :func:`start_consumer` function.
-    Will do the work in listening for pubsub messages from Eva and playing
-    the audio responses.
+    Handles a message received from Eva on any channel: audio responses are
+    played to the user.
 
-    :param queue: The pubsub message queue to subscribe to.
-    :type queue: string
+    :param message: The message received.
+    :type message: string or dict
     """
-    # Need to listen for messages and play audio ones to the user.
-    pubsub = get_pubsub()
-    subscriber = pubsub.subscribe(queue)
-    # Subscriber will continuously tail the mongodb collection queue.
-    for message in subscriber:
-        if message is not None:
-            if isinstance(message, dict) and \
-               'output_audio' in message and \
-               message['output_audio'] is not None:
-                audio_data = message['output_audio']['audio']
-                f = open('/tmp/eva_audio', 'wb')
-                f.write(audio_data)
-                f.close()
-                play('/tmp/eva_audio', message['output_audio']['content_type'])
-        time.sleep(0.1)
+    if isinstance(message, dict) and \
+       'output_audio' in message and \
+       message['output_audio'] is not None:
+        get_player().play(message['output_audio']['audio'],
+                          message['output_audio']['content_type'])
 
 def main():
     """
@@ -269,16 +434,28 @@ def main():
     parser.add_argument("--snowboy-model", help="Alternatively specify a Snowboy model instead of using Pocketsphinx for keyword detection")
     parser.add_argument("--eva-host", help="Eva server hostname or IP", default='localhost')
     parser.add_argument("--audio-port", help="Port that Eva is listening for Audio", default=8800)
+    parser.add_argument("--framed-audio", help="Send framed audio to Eva's audio receiver (instead of raw PCM for the Audio Server plugin)", action='store_true')
+    parser.add_argument("--audio-codec", help="Codec used to send framed audio (zlib is lossless and smaller)", choices=['pcm', 'zlib'], default='zlib')
+    parser.add_argument("--no-vad", help="Send the whole recording instead of trimming silence", action='store_true')
+    parser.add_argument("--vad-energy", help="Minimum energy of speech, in dBFS", type=float, default=-45.0)
+    parser.add_argument("--vad-margin", help="How much louder than the background noise speech is, in dB", type=float, default=10.0)
+    parser.add_argument("--vad-zcr", help="Maximum zero-crossing rate of speech (0 to 1)", type=float, default=0.35)
+    parser.add_argument("--vad-silence", help="Seconds of silence that end the command", type=float, default=0.5)
     parser.add_argument("--mongo-host", help="MongoDB hostname or IP (typically same as Eva)", default='localhost')
     parser.add_argument("--mongo-port", help="MongoDB port", default=27017)
     parser.add_argument("--mongo-username", help="MongoDB username", default='')
     parser.add_argument("--mongo-password", help="MongoDB password", default='')
+    parser.add_argument("--socket-path", help="Eva's local pubsub socket (instead of MongoDB, same machine only)")
     global ARGS
     ARGS = parser.parse_args()
-    # Start the message consumers.
-    start_consumer('eva_messages')
-    start_consumer('eva_responses')
+    # Listen for messages and responses with a single subscriber.
+    multiplexer = Multiplexer(get_pubsub())
+    multiplexer.register('eva_messages', handle_message)
+    multiplexer.register('eva_responses', handle_message)
+    multiplexer.register('eva_responses_%s' %CLIENT_ID, handle_message)
+    multiplexer.start()
     # Ready listening thread.
+    load_cues()
     quit_event = Event()
     thread = Thread(target=listen, args=(quit_event,))
     thread.start()
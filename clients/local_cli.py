@@ -26,8 +26,9 @@ class LocalCLI(CLI):
     Does not require a running Eva server as it bootstraps Eva on every command.
     """
     def __init__(self):
-        super(LocalCLI).__init__()
+        super(LocalCLI, self).__init__()
         director.boot()
+        director.start_scheduler()
 
     def get_pubsub(self):
         return get_pubsub()
@@ -0,0 +1 @@
+../eva/local_pubsub.py
\ No newline at end of file
@@ -0,0 +1,164 @@
+"""
+A single subscriber that listens to several Eva channels at once and hands
+every message to the handler registered for its channel.
+
+Clients used to start one process per channel, each with its own MongoDB
+connection and tailable cursor. The multiplexer uses one thread, one
+connection, and one cursor (or one local pubsub socket) for every channel::
+
+    from multiplexer import Multiplexer
+    multiplexer = Multiplexer(pubsub)
+    multiplexer.register('eva_messages', print_message)
+    multiplexer.register('eva_responses', play_response)
+    multiplexer.start()
+
+Handlers run on the multiplexer thread - slow handlers delay the messages of
+every channel. :func:`Multiplexer.register` returns an event that is set once
+the channel is live; wait for it before sending anything that expects a reply
+on that channel::
+
+    multiplexer.register('eva_responses_<client_id>', handle_response).wait()
+"""
+
+import time
+import threading
+from pymongo import CursorType
+
+class Multiplexer(object):
+    """
+    Dispatches the messages of several channels to per-channel handlers from
+    a single background thread.
+    """
+    def __init__(self, pubsub):
+        """
+        :param pubsub: The anypubsub MongoDB pubsub object or a
+            local_pubsub.LocalPubSub object.
+        """
+        self.pubsub = pubsub
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        # (channel, event) tuples of the channels waiting to be subscribed to.
+        self.waiting = []
+        # The local pubsub subscriber (channels are added to it directly).
+        self.subscriber = None
+        # The ID of the last MongoDB document received (cursors resume from it).
+        self.last_id = None
+        self.thread = None
+
+    def register(self, channel, handler):
+        """
+        Registers the handler of a channel. Channels can be registered after
+        the multiplexer started without missing messages on the others.
+
+        :param channel: The channel to listen to.
+        :type channel: string
+        :param handler: Called with every message published on the channel.
+        :type handler: function
+        :return: An event set once the channel is live - messages published
+            on it before then may be missed.
+        :rtype: :class:`threading.Event`
+        """
+        ready = threading.Event()
+        with self.lock:
+            self.handlers[channel] = handler
+            subscriber = self.subscriber
+            if subscriber is None:
+                self.waiting.append((channel, ready))
+        if subscriber is not None:
+            # Added to the live connection, no need to resubscribe.
+            subscriber.add_channels([channel], ready)
+        else:
+            self.changed.set()
+        return ready
+
+    def start(self):
+        """
+        Starts dispatching messages in a background thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        """
+        The dispatch loop.
+        """
+        if getattr(self.pubsub, 'collection', None) is None:
+            messages = self.receive_local()
+        else:
+            messages = self.receive_mongo()
+        for received in messages:
+            if received is not None:
+                channel, message = received
+                handler = self.handlers.get(channel)
+                if handler is not None:
+                    try:
+                        handler(message)
+                    except Exception as err: #pylint: disable=W0703
+                        print('Could not handle message on %s: %s' %(channel, err))
+
+    def receive_local(self):
+        """
+        Receives the messages of every registered channel from the local
+        pubsub. A single connection is used - channels registered later are
+        added to it (see :func:`register`).
+
+        :return: A generator of ``(channel, message)`` tuples, or ``None``
+            whenever no message arrived within a second.
+        :rtype: Generator
+        """
+        subscriber = self.pubsub.subscribe()
+        with self.lock:
+            self.subscriber = subscriber
+            waiting, self.waiting = self.waiting, []
+        for channel, ready in waiting:
+            subscriber.add_channels([channel], ready)
+        try:
+            while True:
+                yield subscriber.receive()
+        finally:
+            subscriber.close()
+
+    def receive_mongo(self):
+        """
+        Receives the messages of every registered channel from MongoDB with a
+        single tailable cursor.
+
+        The cursor is replaced whenever a channel is registered. Every cursor
+        resumes right after the last document received (or the newest
+        document of the collection when the multiplexer started), so nothing
+        published in the meantime is missed.
+
+        :return: A generator of ``(channel, message)`` tuples, or ``None``
+            whenever no message arrived within a second.
+        :rtype: Generator
+        """
+        collection = self.pubsub.collection
+        newest = collection.find_one({}, sort=[('$natural', -1)])
+        if newest is not None:
+            self.last_id = newest['_id']
+        while True:
+            self.changed.clear()
+            with self.lock:
+                channels = list(self.handlers)
+                waiting, self.waiting = self.waiting, []
+            query = {'type': 'message', 'channel': {'$in': channels}}
+            if self.last_id is not None:
+                query['_id'] = {'$gt': self.last_id}
+            # A single tailable cursor waits server-side for the next message.
+            cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            for _, ready in waiting:
+                ready.set()
+            while cursor.alive and not self.changed.is_set():
+                try:
+                    document = next(cursor)
+                except StopIteration:
+                    yield None
+                    continue
+                self.last_id = document['_id']
+                yield document['channel'], document['message']
+            cursor.close()
+            if not self.changed.is_set():
+                time.sleep(0.1)
+                yield None
@@ -15,12 +15,21 @@ remotely accessible MongoDB instance that Eva is using::
 		from clients.remote_cli import RemoteCLI
 		cli = RemoteCLI(host='remote.host', port=27017, username='', password='')
 		cli.start_consumer('eva_messages')
-		cli.start_consumer('eva_responses')
 		cli.interact()
+
+Every RemoteCLI instance has its own client ID and only receives the responses
+to its own commands (on the ``eva_responses_<client_id>`` channel). Scripts
+that need to wait on (or pipeline) many requests should use the
+:class:`eva_client.EvaClient` it is built on directly.
+
+If the Eva server runs on the same machine with the ``local`` pubsub backend,
+point the client at the server's Unix domain socket instead::
+
+		python3 clients/remote_cli.py --socket-path=/tmp/eva.sock
 """
 
-from pymongo import MongoClient
-from anypubsub import create_pubsub_from_settings
+import argparse
+import eva_client
 from cli import CLI
 
 class RemoteCLI(CLI):
@@ -28,13 +37,18 @@ class RemoteCLI(CLI):
     Very similar to the LocalCLI class except that it requires a working Eva
     server and an accessible MongoDB instance holding the Eva database.
     """
-    def __init__(self, host='localhost', port=27017, username='', password=''):
+    def __init__(self, host='localhost', port=27017, username='', password='',
+                 socket_path=None, timeout=30):
         super(RemoteCLI, self).__init__()
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.socket_path = socket_path
+        self.timeout = timeout
         self.pubsub = self.get_pubsub()
+        self.client = eva_client.EvaClient(self.pubsub, timeout, self.get_multiplexer())
+        self.client_id = self.client.client_id
 
     def get_pubsub(self):
         """
@@ -44,40 +58,43 @@ class RemoteCLI(CLI):
         :return: The pubsub object used to publish Eva messages to the clients.
         :rtype: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
         """
-        uri = 'mongodb://'
-        if len(self.username) > 0:
-            uri = uri + self.username
-            if len(self.password) > 0:
-                uri = uri + ':' + self.password + '@'
-            else:
-                uri = uri + '@'
-        uri = '%s%s:%s' %(uri, self.host, self.port)
-        client = MongoClient(uri)
-        return create_pubsub_from_settings({'backend': 'mongodb',
-                                            'client': client,
-                                            'database': 'eva',
-                                            'collection': 'communications'})
+        return eva_client.get_pubsub(self.host, self.port, self.username,
+                                     self.password, self.socket_path)
 
     def get_results(self, command):
         """
         Overriden method that handles user input by sending the query/command
-        to the Eva MongoDB instance. These messages are processed by Eva and
-        a response is generated - which is then picked up by the client in
-        a consumer thread.
+        to Eva and waiting for the matching response.
 
         :param command: The query/command to send Eva.
         :type command: string
+        :return: Eva's response, or ``None`` if it did not arrive in time.
+        :rtype: dict
         """
-        self.pubsub.publish('eva_commands', {'input_text': command})
+        try:
+            return self.client.interact(command)
+        except TimeoutError:
+            print('Eva did not respond within %s seconds' %self.timeout)
+            return None
 
 def main():
     """
     Start a RemoteCLI instance.
     """
-    cli = RemoteCLI()
-    # Subscribe to messages and command responses.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo-host", help="MongoDB hostname or IP (typically same as Eva)", default='localhost')
+    parser.add_argument("--mongo-port", help="MongoDB port", default=27017)
+    parser.add_argument("--mongo-username", help="MongoDB username", default='')
+    parser.add_argument("--mongo-password", help="MongoDB password", default='')
+    parser.add_argument("--socket-path", help="Eva's local pubsub socket (instead of MongoDB)")
+    args = parser.parse_args()
+    cli = RemoteCLI(host=args.mongo_host,
+                    port=args.mongo_port,
+                    username=args.mongo_username,
+                    password=args.mongo_password,
+                    socket_path=args.socket_path)
+    # Subscribe to messages - command responses are received by get_results().
     cli.start_consumer('eva_messages')
-    cli.start_consumer('eva_responses', 'Eva Response: ')
     cli.interact()
 
 if __name__ == '__main__':
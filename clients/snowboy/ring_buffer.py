@@ -0,0 +1,85 @@
+"""
+A fixed-size circular byte buffer holding the audio captured by PortAudio
+until the hotword detector reads it.
+"""
+
+import threading
+
+class RingBuffer(object):
+    """
+    Ring buffer to hold audio from PortAudio.
+
+    The storage is a single preallocated bytearray written and read with slice
+    copies, so no Python object is created per audio sample. When the buffer is
+    full the oldest audio is overwritten.
+    """
+    def __init__(self, size=4096):
+        """
+        :param size: The capacity of the buffer in bytes.
+        :type size: integer
+        """
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._size = size
+        self._start = 0
+        self._length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._length
+
+    def extend(self, data):
+        """
+        Adds data to the end of the buffer, overwriting the oldest data if the
+        buffer is full.
+
+        :param data: The audio data.
+        :type data: bytes
+        """
+        data = memoryview(data).cast('B')
+        if len(data) >= self._size:
+            # Only the most recent audio fits.
+            with self._lock:
+                self._view[:] = data[len(data) - self._size:]
+                self._start = 0
+                self._length = self._size
+            return
+        with self._lock:
+            end = (self._start + self._length) % self._size
+            first = min(len(data), self._size - end)
+            self._view[end:end + first] = data[:first]
+            self._view[:len(data) - first] = data[first:]
+            overflow = self._length + len(data) - self._size
+            if overflow > 0:
+                self._start = (self._start + overflow) % self._size
+                self._length = self._size
+            else:
+                self._length += len(data)
+
+    def peek(self):
+        """
+        Retrieves the data from the beginning of the buffer without clearing it.
+
+        :return: The buffered audio data.
+        :rtype: bytes
+        """
+        with self._lock:
+            end = self._start + self._length
+            if end <= self._size:
+                return self._view[self._start:end].tobytes()
+            return self._view[self._start:].tobytes() + self._view[:end - self._size].tobytes()
+
+    def get(self):
+        """
+        Retrieves the data from the beginning of the buffer and clears it.
+
+        :return: The buffered audio data.
+        :rtype: bytes
+        """
+        with self._lock:
+            if self._length == 0:
+                return b''
+            data = self.peek()
+            self._start = 0
+            self._length = 0
+            return data
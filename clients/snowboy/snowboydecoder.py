@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
-import collections
 import pyaudio
+import queue
 import snowboy.snowboydetect
+from snowboy.ring_buffer import RingBuffer
 import time
 import wave
 import os
 import logging
 
+try:
+    import webrtcvad
+except ImportError:
+    webrtcvad = None
+
 logging.basicConfig()
 logger = logging.getLogger("snowboy")
 logger.setLevel(logging.INFO)
@@ -15,22 +21,6 @@ TOP_DIR = os.path.dirname(os.path.abspath(__file__))
 
 RESOURCE_FILE = os.path.join(TOP_DIR, "common.res")
 
-class RingBuffer(object):
-    """Ring buffer to hold audio from PortAudio"""
-    def __init__(self, size = 4096):
-        self._buf = collections.deque(maxlen=size)
-
-    def extend(self, data):
-        """Adds data to the end of buffer"""
-        self._buf.extend(data)
-
-    def get(self):
-        """Retrieves data from the beginning of buffer and clears it"""
-        tmp = bytes(bytearray(self._buf))
-        self._buf.clear()
-        return tmp
-
-
 def play_audio_file(fname=None):
     """Simple callback function to play a wave file. By default it plays
     a Ding sound.
@@ -65,16 +55,31 @@ class HotwordDetector(object):
                               decoder. If an empty list is provided, then the
                               default sensitivity in the model will be used.
     :param audio_gain: multiply input volume by this factor.
+    :param pre_roll: seconds of audio captured before `listen` is called
+                     (but after the hotword, see `pause` and `clear`) that
+                     are included in the recording.
+
+    The detector is meant to live as long as the microphone is used: detection
+    is paused while the hotword callback runs (recording a command from the
+    same input stream with `listen`) and resumes when it returns.
     """
     def __init__(self, decoder_model,
                  resource=RESOURCE_FILE,
                  sensitivity=[],
-                 audio_gain=1):
+                 audio_gain=1,
+                 pre_roll=0.3):
 
         def audio_callback(in_data, frame_count, time_info, status):
-            self.ring_buffer.extend(in_data)
-            play_data = chr(0) * len(in_data)
-            return play_data, pyaudio.paContinue
+            recording = self.recording
+            if recording is not None:
+                recording.put(in_data)
+                return None, pyaudio.paContinue
+            if not self.paused:
+                self.ring_buffer.extend(in_data)
+            if self.pre_roll is not None:
+                self.pre_roll.extend(in_data)
+            # Input-only stream - there is no output data to return.
+            return None, pyaudio.paContinue
 
         tm = type(decoder_model)
         ts = type(sensitivity)
@@ -101,6 +106,15 @@ class HotwordDetector(object):
 
         self.ring_buffer = RingBuffer(
             self.detector.NumChannels() * self.detector.SampleRate() * 5)
+        self.bytes_per_second = self.detector.NumChannels() * \
+            self.detector.SampleRate() * self.detector.BitsPerSample() // 8
+        self.pre_roll = None
+        if pre_roll > 0:
+            self.pre_roll = RingBuffer(int(self.bytes_per_second * pre_roll))
+        # Whether detection is paused (see `pause`).
+        self.paused = False
+        # Queue of audio recorded by `listen`.
+        self.recording = None
         self.audio = pyaudio.PyAudio()
         self.stream_in = self.audio.open(
             input=True, output=False,
@@ -165,11 +179,98 @@ class HotwordDetector(object):
                                          time.localtime(time.time()))
                 logger.info(message)
                 callback = detected_callback[ans-1]
+                self.pause()
                 if callback is not None:
                     callback()
+                self.resume()
 
         logger.debug("finished.")
 
+    def pause(self):
+        """
+        Pauses detection. The audio captured so far (including the hotword) is
+        discarded, so the pre-roll of `listen` only holds audio captured after
+        this call.
+        :return: None
+        """
+        if self.paused:
+            return
+        self.paused = True
+        self.ring_buffer.get()
+        self.clear()
+
+    def clear(self):
+        """
+        Discards the pre-roll captured so far. Call it once a cue played after
+        the hotword (such as a ping) is over, so that `listen` doesn't record
+        it.
+        :return: None
+        """
+        if self.pre_roll is not None:
+            self.pre_roll.get()
+
+    def resume(self):
+        """
+        Resumes detection after `pause`. Audio captured in the meantime is
+        discarded.
+        :return: None
+        """
+        if not self.paused:
+            return
+        self.recording = None
+        self.paused = False
+        self.ring_buffer.get()
+        self.detector.Reset()
+
+    def listen(self, duration=5, timeout=1):
+        """
+        Records a command from the detector's input stream, pausing detection
+        if needed. The recording starts with the pre-roll (see `clear`) and
+        stops after `duration` seconds, or after `timeout` seconds of silence
+        following speech (when webrtcvad is installed). Detection stays paused
+        until the hotword callback returns (or `resume` is called).
+
+        :param float duration: maximum seconds of audio to record.
+        :param float timeout: seconds of silence that end the recording.
+        :return: a generator of audio chunks.
+        """
+        self.pause()
+        recording = queue.Queue()
+        if self.pre_roll is not None:
+            recording.put(self.pre_roll.get())
+        self.recording = recording
+        rate = self.detector.SampleRate()
+        vad = webrtcvad.Vad(2) if webrtcvad is not None and \
+            self.detector.NumChannels() == 1 else None
+        frame_size = int(rate * 0.03) * self.detector.BitsPerSample() // 8
+        pending = b''
+        recorded = 0.0
+        silence = 0.0
+        heard_speech = False
+        try:
+            while recorded < duration:
+                try:
+                    data = recording.get(timeout=1)
+                except queue.Empty:
+                    logger.warning("No audio received from the input stream")
+                    break
+                yield data
+                recorded += len(data) / float(self.bytes_per_second)
+                if vad is None:
+                    continue
+                pending += data
+                while len(pending) >= frame_size:
+                    frame, pending = pending[:frame_size], pending[frame_size:]
+                    if vad.is_speech(frame, rate):
+                        heard_speech = True
+                        silence = 0.0
+                    elif heard_speech:
+                        silence += 0.03
+                if silence >= timeout:
+                    break
+        finally:
+            self.recording = None
+
     def terminate(self):
         """
         Terminate audio stream. Users cannot call start() again to detect.
@@ -0,0 +1,240 @@
+"""
+Energy/zero-crossing voice activity detection and endpointing for voice
+clients.
+
+Microphone recordings start with silence (the time it takes to start talking
+after the ping) and keep recording well after the command was spoken. The
+:class:`Endpointer` trims that silence frame by frame and ends the utterance as
+soon as speech stops, so less audio is sent to Eva and recognized::
+
+    from vad import Endpointer
+    endpointer = Endpointer(sample_rate=16000)
+    udp_stream(endpointer.process(mic.listen(duration=5, timeout=1)))
+
+Frames are classified in batches with NumPy: a frame is speech when it is loud
+enough (above a fixed threshold, and above the estimated noise floor by a
+margin) and its zero-crossing rate is low enough (hiss and fricative-only noise
+cross zero far more often than voiced speech). The noise floor is seeded from
+the first :data:`NOISE_SEED` seconds of audio, which are held back until then.
+
+Requires numpy (``pip3 install numpy``).
+"""
+
+import numpy
+
+# Full scale of 16-bit PCM audio.
+FULL_SCALE = 32768.0
+
+# How fast the noise floor estimate may rise, in dB per frame (it drops
+# immediately to the quietest frame).
+NOISE_RISE = 0.05
+
+# Seconds of audio the noise floor is first estimated from (several
+# microphone chunks, so that a single loud or muted chunk can't skew it).
+NOISE_SEED = 0.5
+
+# The percentile of the frame energies of the first NOISE_SEED seconds used as
+# the initial noise floor (capped at the energy threshold, in case speech fills
+# them).
+NOISE_PERCENTILE = 50
+
+def frame_features(frames):
+    """
+    Computes the energy and zero-crossing rate of every frame.
+
+    :param frames: 16-bit PCM samples, one frame per row.
+    :type frames: numpy.ndarray
+    :return: The energy of every frame (in dBFS) and the fraction of
+        consecutive samples that cross zero in every frame.
+    :rtype: tuple
+    """
+    samples = frames.astype(numpy.float64) / FULL_SCALE
+    power = numpy.mean(samples * samples, axis=1)
+    energy = 10 * numpy.log10(power + 1e-10)
+    signs = numpy.signbit(frames)
+    crossings = numpy.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+    return energy, crossings
+
+class Endpointer(object):
+    """
+    Trims the silence around an utterance and detects its end.
+
+    The endpointer waits for ``min_speech`` seconds of consecutive speech
+    before considering that the utterance started, keeping ``padding`` seconds
+    of audio before it (so that soft onsets aren't cut). Once started, silent
+    frames are held back until speech resumes; after ``silence_timeout``
+    seconds of silence the utterance ends, with ``padding`` seconds of trailing
+    audio. If nobody talks within ``wait_timeout`` seconds, nothing is kept.
+    """
+    def __init__(self, sample_rate=16000, frame_duration=0.03,
+                 energy_threshold=-45.0, noise_margin=10.0, zcr_threshold=0.35,
+                 min_speech=0.09, padding=0.3, silence_timeout=0.5, wait_timeout=3.0):
+        """
+        :param sample_rate: The sample rate of the 16-bit mono audio.
+        :type sample_rate: integer
+        :param frame_duration: The duration of a frame, in seconds.
+        :type frame_duration: float
+        :param energy_threshold: The minimum energy of speech, in dBFS.
+        :type energy_threshold: float
+        :param noise_margin: How much louder than the noise floor speech
+            is (in dB).
+        :type noise_margin: float
+        :param zcr_threshold: The maximum zero-crossing rate of speech.
+        :type zcr_threshold: float
+        :param min_speech: Seconds of consecutive speech that start the
+            utterance.
+        :type min_speech: float
+        :param padding: Seconds of silence kept before and after speech.
+        :type padding: float
+        :param silence_timeout: Seconds of silence that end the utterance.
+        :type silence_timeout: float
+        :param wait_timeout: Seconds to wait for speech to start.
+        :type wait_timeout: float
+        """
+        self.sample_rate = sample_rate
+        self.frame_samples = int(sample_rate * frame_duration)
+        self.frame_duration = self.frame_samples / float(sample_rate)
+        self.energy_threshold = energy_threshold
+        self.noise_margin = noise_margin
+        self.zcr_threshold = zcr_threshold
+        self.min_speech_frames = max(1, int(round(min_speech / self.frame_duration)))
+        self.padding_frames = int(round(padding / self.frame_duration))
+        self.silence_frames = max(1, int(round(silence_timeout / self.frame_duration)))
+        self.wait_frames = int(round(wait_timeout / self.frame_duration))
+        self.seed_frames = max(1, int(round(NOISE_SEED / self.frame_duration)))
+        self.reset()
+
+    def reset(self):
+        """
+        Gets ready for a new utterance.
+        """
+        self.noise_floor = None
+        # Audio held back until the noise floor is seeded.
+        self.seed = b''
+        self.started = False
+        self.ended = False
+        self.frames = 0
+        # Frames held back: before speech starts, or since speech stopped.
+        self.held = []
+        self.speech_run = 0
+        self.speech_start = None
+        self.speech_end = None
+
+    def classify(self, pcm):
+        """
+        Classifies the frames of a chunk of audio as speech or silence, after
+        updating the noise floor estimate. The first chunk seeds the noise
+        floor with the :data:`NOISE_PERCENTILE` percentile of its energies,
+        capped at ``energy_threshold`` (see :func:`feed`).
+
+        :param pcm: Whole frames of 16-bit little-endian PCM audio.
+        :type pcm: bytes
+        :return: Whether or not every frame is speech.
+        :rtype: numpy.ndarray
+        """
+        frames = numpy.frombuffer(pcm, dtype='<i2').reshape(-1, self.frame_samples)
+        energy, crossings = frame_features(frames)
+        if self.noise_floor is None:
+            seed = float(numpy.percentile(energy, NOISE_PERCENTILE))
+            self.noise_floor = min(seed, self.energy_threshold)
+        else:
+            quietest = float(numpy.min(energy))
+            self.noise_floor = min(self.noise_floor + NOISE_RISE * len(frames), quietest)
+        threshold = max(self.energy_threshold, self.noise_floor + self.noise_margin)
+        return (energy > threshold) & (crossings < self.zcr_threshold)
+
+    def feed(self, pcm, final=False):
+        """
+        Processes whole frames of audio. The first :data:`NOISE_SEED` seconds
+        are held back until the noise floor can be seeded from all of them.
+
+        :param pcm: Whole frames of 16-bit little-endian PCM audio.
+        :type pcm: bytes
+        :param final: Whether or not this is the last audio (processing the
+            audio held back even if there is less than :data:`NOISE_SEED`
+            seconds of it).
+        :type final: boolean
+        :return: The audio to keep (possibly empty).
+        :rtype: bytes
+        """
+        frame_size = self.frame_samples * 2
+        if self.noise_floor is None:
+            self.seed += pcm
+            if len(self.seed) < self.seed_frames * frame_size and not final:
+                return b''
+            pcm, self.seed = self.seed, b''
+            if not pcm:
+                return b''
+        kept = []
+        for index, is_speech in enumerate(self.classify(pcm)):
+            if self.ended:
+                break
+            frame = pcm[index * frame_size:(index + 1) * frame_size]
+            self.frames += 1
+            if not self.started:
+                self.held.append(frame)
+                self.speech_run = self.speech_run + 1 if is_speech else 0
+                if self.speech_run >= self.min_speech_frames:
+                    self.started = True
+                    self.speech_start = self.frames - self.speech_run
+                    self.speech_end = self.frames
+                    kept.extend(self.held[-(self.speech_run + self.padding_frames):])
+                    self.held = []
+                else:
+                    del self.held[:-(self.min_speech_frames + self.padding_frames)]
+                    if self.frames >= self.wait_frames:
+                        self.ended = True
+            elif is_speech:
+                kept.extend(self.held)
+                kept.append(frame)
+                self.held = []
+                self.speech_end = self.frames
+            else:
+                self.held.append(frame)
+                if len(self.held) >= self.silence_frames:
+                    kept.extend(self.held[:self.padding_frames])
+                    self.held = []
+                    self.ended = True
+        return b''.join(kept)
+
+    def process(self, chunks):
+        """
+        Trims an utterance as it is recorded. Stops reading ``chunks`` as soon
+        as the utterance ends (closing the generator stops the recording).
+
+        :param chunks: The recorded 16-bit little-endian PCM audio chunks
+            (such as the generator returned by
+            respeaker.microphone.Microphone.listen()).
+        :type chunks: iterable
+        :return: A generator of the audio to send.
+        :rtype: Generator
+        """
+        self.reset()
+        frame_size = self.frame_samples * 2
+        pending = b''
+        try:
+            for chunk in chunks:
+                pending += chunk
+                whole = len(pending) - len(pending) % frame_size
+                if whole == 0:
+                    continue
+                kept = self.feed(pending[:whole])
+                pending = pending[whole:]
+                if kept:
+                    yield kept
+                if self.ended:
+                    break
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        if self.seed:
+            # Recording stopped before the noise floor was seeded.
+            kept = self.feed(b'', final=True)
+            if kept:
+                yield kept
+        if self.started and not self.ended:
+            # Recording stopped first - keep the trailing padding.
+            trailing = b''.join(self.held[:self.padding_frames])
+            if trailing:
+                yield trailing
@@ -15,6 +15,10 @@ conf = get_config()
 from eva.logger import Logger
 log = Logger()
 
+# Shortcut for plugins to access Eva's runtime metrics.
+from eva.metrics import Metrics
+metrics = Metrics()
+
 # Shortcut for plugins to access the Eva scheduler.
 from eva.scheduler import get_scheduler
 scheduler = get_scheduler()
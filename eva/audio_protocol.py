@@ -0,0 +1,212 @@
+"""
+Holds Eva's framed audio streaming protocol, used by voice clients (see
+``clients/headless.py``) to send utterances to the audio receiver (see
+:mod:`eva.audio_stream`) over UDP.
+
+This module only depends on the Python standard library, so that clients can
+use it without installing Eva itself (``clients/audio_protocol.py`` is a link
+to this file)::
+
+    from audio_protocol import AudioStreamSender
+    sender = AudioStreamSender('localhost', 8800, client_id='kitchen')
+    sender.send(chunks)
+
+Every UDP datagram holds a single frame: a 15 byte header followed by the
+(possibly compressed) audio payload. The header holds, in network byte order:
+
+    * The ``EV`` magic bytes
+    * The protocol version (1 byte)
+    * The codec of the payload (1 byte, see :data:`CODECS`)
+    * Flags (1 byte, see :data:`FLAG_END`)
+    * The utterance ID (4 bytes) - random, chosen by the client for every utterance
+    * The sequence number of the frame within the utterance (4 bytes)
+    * The sample rate (2 bytes) - the audio is always 16-bit mono PCM once decoded
+
+The client ends every utterance with a frame flagged with :data:`FLAG_END`,
+whose sequence number is the number of audio frames sent. Its payload is the
+client ID (UTF-8, possibly empty) that Eva uses to send the response to the
+client's own channel.
+"""
+
+import zlib
+import random
+import socket
+import struct
+
+#: The frame header format (see the module documentation).
+HEADER = struct.Struct('!2sBBBIIH')
+#: The magic bytes starting every frame.
+MAGIC = b'EV'
+#: The protocol version.
+VERSION = 2
+#: Raw 16-bit little-endian PCM.
+CODEC_PCM = 0
+#: 16-bit little-endian PCM, zlib-compressed (lossless).
+CODEC_ZLIB = 1
+#: The supported codecs, keyed by name.
+CODECS = {'pcm': CODEC_PCM, 'zlib': CODEC_ZLIB}
+#: Flag set on the frame ending an utterance.
+FLAG_END = 0x01
+#: The maximum size of the decoded audio data of a frame, in bytes (larger
+#: than any uncompressed payload that fits in a UDP datagram). Compressed frames
+#: decoding to more are rejected.
+MAX_CHUNK = 65536
+
+def pack_frame(utterance_id, sequence, pcm, codec=CODEC_ZLIB, sample_rate=16000):
+    """
+    Encodes a single audio frame.
+
+    :param utterance_id: The ID of the utterance.
+    :type utterance_id: integer
+    :param sequence: The sequence number of the frame.
+    :type sequence: integer
+    :param pcm: The 16-bit little-endian PCM audio data.
+    :type pcm: bytes
+    :param codec: The codec used to encode the audio (see :data:`CODECS`).
+    :type codec: integer
+    :param sample_rate: The sample rate of the audio.
+    :type sample_rate: integer
+    :return: The encoded frame.
+    :rtype: bytes
+    """
+    header = HEADER.pack(MAGIC, VERSION, codec, 0, utterance_id, sequence, sample_rate)
+    return header + encode(pcm, codec)
+
+def pack_end_frame(utterance_id, sequence, client_id=None, sample_rate=16000):
+    """
+    Encodes the frame ending an utterance.
+
+    :param utterance_id: The ID of the utterance.
+    :type utterance_id: integer
+    :param sequence: The number of audio frames sent.
+    :type sequence: integer
+    :param client_id: The ID of the client (responses are sent to its channel).
+    :type client_id: string
+    :param sample_rate: The sample rate of the audio.
+    :type sample_rate: integer
+    :return: The encoded frame.
+    :rtype: bytes
+    """
+    header = HEADER.pack(MAGIC, VERSION, CODEC_PCM, FLAG_END, utterance_id, sequence, sample_rate)
+    return header + (client_id or '').encode('utf-8')
+
+def unpack_frame(frame):
+    """
+    Decodes a single frame.
+
+    :param frame: The frame received from a client.
+    :type frame: bytes
+    :return: The utterance ID, sequence number, sample rate, end flag, and
+        either the decoded PCM audio data, or the client ID (``None`` if not
+        provided) for end frames.
+    :rtype: tuple
+    :raises ValueError: If the frame is not a valid frame.
+    """
+    if len(frame) < HEADER.size:
+        raise ValueError('Frame too short')
+    magic, version, codec, flags, utterance_id, sequence, sample_rate = HEADER.unpack_from(frame)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unknown frame format')
+    payload = frame[HEADER.size:]
+    if flags & FLAG_END:
+        try:
+            return utterance_id, sequence, sample_rate, True, payload.decode('utf-8') or None
+        except UnicodeDecodeError:
+            raise ValueError('Invalid client ID')
+    return utterance_id, sequence, sample_rate, False, decode(payload, codec)
+
+def encode(pcm, codec):
+    """
+    Encodes 16-bit little-endian PCM audio data.
+
+    :param pcm: The audio data.
+    :type pcm: bytes
+    :param codec: The codec to use (see :data:`CODECS`).
+    :type codec: integer
+    :return: The encoded audio data.
+    :rtype: bytes
+    :raises ValueError: If the audio data is larger than :data:`MAX_CHUNK`.
+    """
+    if len(pcm) > MAX_CHUNK:
+        raise ValueError('Audio chunk too large (%s bytes)' %len(pcm))
+    if codec == CODEC_PCM or not pcm:
+        return pcm
+    if codec != CODEC_ZLIB:
+        raise ValueError('Unknown codec: %s' %codec)
+    return zlib.compress(pcm, 6)
+
+def decode(payload, codec):
+    """
+    Decodes audio data encoded with :func:`encode`.
+
+    :param payload: The encoded audio data.
+    :type payload: bytes
+    :param codec: The codec used (see :data:`CODECS`).
+    :type codec: integer
+    :return: 16-bit little-endian PCM audio data.
+    :rtype: bytes
+    :raises ValueError: If the payload is corrupt, or decodes to more than
+        :data:`MAX_CHUNK` bytes.
+    """
+    if codec == CODEC_PCM or not payload:
+        return payload
+    if codec != CODEC_ZLIB:
+        raise ValueError('Unknown codec: %s' %codec)
+    # Frames come from unauthenticated clients: never inflate more than
+    # MAX_CHUNK bytes.
+    decompressor = zlib.decompressobj()
+    try:
+        pcm = decompressor.decompress(payload, MAX_CHUNK)
+    except zlib.error as err:
+        raise ValueError('Corrupt frame: %s' %err)
+    if decompressor.unconsumed_tail:
+        raise ValueError('Frame too large')
+    if not decompressor.eof:
+        raise ValueError('Corrupt frame: truncated payload')
+    return pcm
+
+class AudioStreamSender(object):
+    """
+    Sends utterances to Eva as sequences of frames. Every utterance gets a
+    random ID, and ends with an end-of-utterance frame.
+    """
+    def __init__(self, host, port, codec='zlib', sample_rate=16000, client_id=None):
+        """
+        :param host: The Eva server hostname or IP.
+        :type host: string
+        :param port: The port Eva is listening for audio on.
+        :type port: integer
+        :param codec: Either ``pcm`` or ``zlib``.
+        :type codec: string
+        :param sample_rate: The sample rate of the audio.
+        :type sample_rate: integer
+        :param client_id: The ID of the client, so that Eva responds on the
+            ``eva_responses_<client_id>`` channel (``eva_responses`` otherwise).
+        :type client_id: string
+        """
+        self.address = (host, int(port))
+        self.codec = CODECS[codec]
+        self.sample_rate = sample_rate
+        self.client_id = client_id
+
+    def send(self, chunks):
+        """
+        Sends an utterance.
+
+        :param chunks: The audio data, as an iterable of 16-bit little-endian
+            PCM chunks (such as the generator returned by
+            respeaker.microphone.Microphone.listen()).
+        :type chunks: iterable
+        """
+        utterance_id = random.getrandbits(32)
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sequence = 0
+        try:
+            for chunk in chunks:
+                udp.sendto(pack_frame(utterance_id, sequence, chunk, self.codec, self.sample_rate),
+                           self.address)
+                sequence += 1
+            udp.sendto(pack_end_frame(utterance_id, sequence, self.client_id, self.sample_rate),
+                       self.address)
+        finally:
+            udp.close()
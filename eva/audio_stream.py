@@ -0,0 +1,252 @@
+"""
+Holds the AudioReceiver class that reassembles the audio sent by voice clients
+(see ``clients/headless.py``) over UDP, with Eva's framed audio streaming
+protocol (see :mod:`eva.audio_protocol`).
+"""
+
+import time
+import wave
+import socket
+import threading
+from io import BytesIO
+from collections import deque
+from eva.audio_protocol import unpack_frame
+from eva import log
+from eva import metrics
+from eva import hooks
+
+def pcm_to_wav(pcm, sample_rate):
+    """
+    Wraps 16-bit mono PCM audio data in a WAV container.
+
+    :param pcm: The audio data.
+    :type pcm: bytes
+    :param sample_rate: The sample rate of the audio.
+    :type sample_rate: integer
+    :return: The WAV file content.
+    :rtype: bytes
+    """
+    buffer = BytesIO()
+    wav = wave.open(buffer, 'wb')
+    wav.setnchannels(1)
+    wav.setsampwidth(2)
+    wav.setframerate(sample_rate)
+    wav.writeframes(pcm)
+    wav.close()
+    return buffer.getvalue()
+
+class UtteranceBuffer(object):
+    """
+    Reorders the frames of a single utterance.
+
+    Frames are released in sequence order. A frame that arrives early waits in
+    the buffer until the missing frames arrive, or until more than ``window``
+    frames are waiting, in which case the missing frames are considered lost
+    and skipped. Duplicate and late frames are ignored.
+    """
+    def __init__(self, sample_rate, window=8):
+        """
+        :param sample_rate: The sample rate of the utterance.
+        :type sample_rate: integer
+        :param window: The number of frames to wait for a missing frame.
+        :type window: integer
+        """
+        self.sample_rate = sample_rate
+        self.window = window
+        self.frames = {}
+        self.next_sequence = 0
+        self.total = None
+        self.chunks = []
+        self.lost = 0
+        #: The ID of the client, sent with the end frame.
+        self.client_id = None
+        self.last_frame = time.time()
+
+    def add(self, sequence, pcm, end=False):
+        """
+        Adds a frame to the buffer.
+
+        :param sequence: The sequence number of the frame.
+        :type sequence: integer
+        :param pcm: The decoded audio data of the frame.
+        :type pcm: bytes
+        :param end: Whether or not this frame ends the utterance.
+        :type end: boolean
+        :return: The audio data released in order by this frame.
+        :rtype: list
+        """
+        self.last_frame = time.time()
+        if end:
+            self.total = sequence
+        elif sequence >= self.next_sequence and sequence not in self.frames:
+            self.frames[sequence] = pcm
+        return self.release()
+
+    def release(self, force=False):
+        """
+        Releases the frames that are next in sequence, skipping missing frames
+        once the buffer is full (or when ``force`` is set).
+
+        :param force: Skip every missing frame.
+        :type force: boolean
+        :return: The audio data released.
+        :rtype: list
+        """
+        released = []
+        while True:
+            while self.next_sequence in self.frames:
+                released.append(self.frames.pop(self.next_sequence))
+                self.next_sequence += 1
+            if not self.frames or (len(self.frames) <= self.window and not force):
+                break
+            skip_to = min(self.frames)
+            self.lost += skip_to - self.next_sequence
+            self.next_sequence = skip_to
+        if force and self.total is not None and self.next_sequence < self.total:
+            self.lost += self.total - self.next_sequence
+            self.next_sequence = self.total
+        self.chunks.extend(released)
+        return released
+
+    def is_complete(self):
+        """
+        :return: ``True`` once the end frame and every audio frame were received.
+        :rtype: boolean
+        """
+        return self.total is not None and self.next_sequence >= self.total
+
+    def get_audio(self):
+        """
+        :return: The utterance audio data (in order, without missing frames).
+        :rtype: bytes
+        """
+        return b''.join(self.chunks)
+
+class AudioReceiver(object):
+    """
+    Receives framed audio from voice clients over UDP and reassembles every
+    utterance with a reorder buffer (see :class:`UtteranceBuffer`).
+
+    Audio released in order is passed to the ``eva.audio_chunk`` trigger as it
+    arrives, so that plugins can start streaming recognition early. Complete
+    utterances (or incomplete ones, ``utterance_timeout`` seconds after their
+    last frame) are handed to the ``handler`` as WAV audio, along with the ID of
+    the client (if it sent one) so that the response goes to the client's own
+    channel.
+    """
+    def __init__(self, handler, host='0.0.0.0', port=8800, window=8, utterance_timeout=1.0):
+        """
+        :param handler: Called with the client data for every utterance, in
+            the format expected by :func:`eva.director.interact`.
+        :type handler: function
+        :param host: The address to listen on.
+        :type host: string
+        :param port: The UDP port to listen on.
+        :type port: integer
+        :param window: The number of frames to wait for a missing frame.
+        :type window: integer
+        :param utterance_timeout: Seconds without frames before an utterance
+            is considered done.
+        :type utterance_timeout: float
+        """
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.window = window
+        self.utterance_timeout = utterance_timeout
+        self.utterances = {}
+        # Late or duplicate frames of recently finished utterances are ignored.
+        self.finished = deque(maxlen=64)
+        self.sock = None
+
+    def start(self):
+        """
+        Binds the UDP socket and starts receiving audio in a background thread.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.host, self.port))
+        self.sock.settimeout(0.1)
+        thread = threading.Thread(target=self.receive, daemon=True)
+        thread.start()
+        log.info('Listening for audio on %s:%s' %(self.host, self.port))
+
+    def receive(self):
+        """
+        The receiver loop.
+        """
+        while True:
+            try:
+                frame, address = self.sock.recvfrom(65535)
+            except socket.timeout:
+                frame = None
+            if frame is not None:
+                try:
+                    utterance_id, sequence, sample_rate, end, payload = unpack_frame(frame)
+                except ValueError as err:
+                    log.debug('Dropping audio frame from %s: %s' %(address[0], err))
+                    metrics.increment('audio.frames_invalid')
+                    continue
+                key = (address[0], utterance_id)
+                if key in self.finished:
+                    continue
+                buffer = self.utterances.get(key)
+                if buffer is None:
+                    buffer = UtteranceBuffer(sample_rate, self.window)
+                    self.utterances[key] = buffer
+                if end:
+                    buffer.client_id = payload
+                    payload = b''
+                for chunk in buffer.add(sequence, payload, end):
+                    self.trigger_chunk(utterance_id, chunk, sample_rate)
+                if buffer.is_complete():
+                    self.finish(key)
+            cutoff = time.time() - self.utterance_timeout
+            for key in [key for key, buffer in self.utterances.items() if buffer.last_frame < cutoff]:
+                self.finish(key, force=True)
+
+    def trigger_chunk(self, utterance_id, chunk, sample_rate): #pylint: disable=R0201
+        """
+        Fires the `eva.audio_chunk` trigger (see :func:`eva.hooks.trigger`).
+        A failing hook never stops the receiver thread.
+
+        :param utterance_id: The ID of the utterance.
+        :type utterance_id: integer
+        :param chunk: The audio data received in order.
+        :type chunk: bytes
+        :param sample_rate: The sample rate of the audio.
+        :type sample_rate: integer
+        """
+        try:
+            hooks.trigger('eva.audio_chunk', utterance_id=utterance_id,
+                          audio=chunk, sample_rate=sample_rate)
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not handle audio chunk of utterance %s: %s' %(utterance_id, err))
+            metrics.increment('audio.chunk_errors')
+
+    def finish(self, key, force=False):
+        """
+        Hands a finished utterance to the handler.
+
+        :param key: The client address and utterance ID.
+        :type key: tuple
+        :param force: Skip the frames that are still missing.
+        :type force: boolean
+        """
+        buffer = self.utterances.pop(key)
+        self.finished.append(key)
+        buffer.release(force)
+        if buffer.lost:
+            log.warning('Lost %s audio frames from %s' %(buffer.lost, key[0]))
+            metrics.increment('audio.frames_lost', buffer.lost)
+        audio = buffer.get_audio()
+        if not audio:
+            return
+        metrics.increment('audio.utterances')
+        data = {'input_audio': {'audio': pcm_to_wav(audio, buffer.sample_rate),
+                                'content_type': 'audio/wav'}}
+        if buffer.client_id:
+            data['client_id'] = buffer.client_id
+        try:
+            self.handler(data)
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not handle utterance from %s: %s' %(key[0], err))
@@ -0,0 +1,147 @@
+"""
+Holds the CommandLog class used to record the commands received by
+:func:`eva.director.serve`, and the function used to read them back (see
+:mod:`eva.replay`).
+
+Commands are appended to a file as consecutive BSON documents (the same
+encoding as MongoDB and the local pubsub transport), each holding the time the
+command was received and its data::
+
+    {'time': 1508421600.25, 'data': {'input_text': 'What time is it?', ...}}
+"""
+
+import os
+import time
+import queue
+import atexit
+import threading
+from bson import BSON, decode_file_iter
+from bson.errors import InvalidBSON
+from eva import conf
+from eva import log
+from eva import metrics
+
+class CommandLog(object):
+    """
+    Appends received commands to a file.
+
+    Commands are buffered in memory and written by a background thread every
+    ``flush_interval`` seconds, so the director never waits on the disk. When
+    the disk can't keep up and the buffer is full, new commands are dropped
+    (see the ``command_log.records_dropped`` metric).
+    """
+    def __init__(self, path, flush_interval=1.0, max_buffer=10000):
+        """
+        :param path: The file commands are appended to.
+        :type path: string
+        :param flush_interval: Seconds between writes.
+        :type flush_interval: float
+        :param max_buffer: The maximum number of commands waiting to be written.
+        :type max_buffer: integer
+        """
+        self.path = os.path.expanduser(path)
+        self.flush_interval = flush_interval
+        self.buffer = queue.Queue(maxsize=max_buffer)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the writer thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def record(self, data):
+        """
+        Buffers a received command.
+
+        :param data: The data received from the client.
+        :type data: dict
+        """
+        try:
+            self.buffer.put_nowait({'time': time.time(), 'data': data})
+        except queue.Full:
+            metrics.increment('command_log.records_dropped')
+
+    def run(self):
+        """
+        The writer loop.
+        """
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered command immediately.
+        """
+        records = []
+        while True:
+            try:
+                records.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+        if records:
+            self.write(records)
+
+    def write(self, records):
+        """
+        Appends commands to the file with a single write, logging any error.
+        Commands that can't be encoded are skipped.
+
+        :param records: The commands to write.
+        :type records: list
+        """
+        encoded = []
+        for record in records:
+            try:
+                encoded.append(BSON.encode(record))
+            except Exception as err: #pylint: disable=W0703
+                log.warning('Could not encode command for the command log: %s' %err)
+                metrics.increment('command_log.records_dropped')
+        with self.lock:
+            try:
+                with open(self.path, 'ab') as log_file:
+                    log_file.write(b''.join(encoded))
+                metrics.increment('command_log.records_written', len(encoded))
+            except Exception as err: #pylint: disable=W0703
+                log.error('Could not write %s commands to %s: %s' %(len(encoded), self.path, err))
+
+def read_command_log(path):
+    """
+    Reads the commands recorded in a command log file. A truncated last
+    command (if Eva was killed while writing) is ignored.
+
+    :param path: The command log file.
+    :type path: string
+    :return: A generator of ``{'time': <seconds since epoch>, 'data': <dict>}``
+        records, oldest first.
+    :rtype: Generator
+    """
+    with open(os.path.expanduser(path), 'rb') as log_file:
+        try:
+            for record in decode_file_iter(log_file):
+                yield record
+        except InvalidBSON as err:
+            log.warning('Stopped reading %s at an invalid record: %s' %(path, err))
+
+#: The command log used by :func:`eva.director.serve` (see :func:`get_command_log`).
+COMMAND_LOG = None
+
+def get_command_log():
+    """
+    Gets the command log, creating (and starting) it from the ``[command_log]``
+    configuration section on first use.
+
+    :return: The command log, or ``None`` if disabled.
+    :rtype: :class:`CommandLog`
+    """
+    global COMMAND_LOG #pylint: disable=W0603
+    if COMMAND_LOG is None and conf['command_log']['enabled']:
+        COMMAND_LOG = CommandLog(conf['command_log']['path'],
+                                 conf['command_log']['flush_interval'])
+        COMMAND_LOG.start()
+        atexit.register(COMMAND_LOG.flush)
+    return COMMAND_LOG
@@ -0,0 +1,254 @@
+"""
+Holds the CommandQueue class used when several Eva servers share the commands
+sent by the clients (``consumer_mode = competing`` in the ``[director]``
+configuration section).
+"""
+
+import os
+import time
+import uuid
+import socket
+import datetime
+import threading
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from eva.util import get_mongo_client
+from eva import conf
+from eva import log
+
+class CommandQueue(object):
+    """
+    A command queue shared by every Eva server connected to the same MongoDB
+    database.
+
+    Every server tails the ``eva_commands`` channel and copies the commands it
+    sees into the ``director_queue`` collection (using the command ID as the
+    document ID, so a command is only queued once). Commands are partitioned by
+    ``client_id``: a server must hold the lease of a partition (a document in
+    the ``director_leases`` collection, claimed atomically with findAndModify)
+    before handling its commands, one at a time and in order. Leases that are
+    not renewed within ``lease_timeout`` seconds expire, and the partition is
+    picked up by another server. A heartbeat thread renews the leases of the
+    partitions this server is handling every ``lease_timeout / 3`` seconds,
+    so that long interactions don't lose their lease (see :func:`heartbeat`).
+
+    Every queued command keeps the deadline it was given when first queued,
+    so commands that waited too long are dropped by whichever server handles
+    them.
+
+    A command that was being handled by a server that died is handled again by
+    the next lease owner. Completed commands are kept for an hour so that late
+    servers don't queue them again.
+    """
+    def __init__(self, lease_timeout=60.0):
+        """
+        :param lease_timeout: Seconds a lease is held without being renewed.
+        :type lease_timeout: float
+        """
+        database = get_mongo_client()[conf['mongodb']['database']]
+        self.commands = database['director_queue']
+        self.leases = database['director_leases']
+        self.lease_timeout = lease_timeout
+        self.instance_id = '%s-%s-%s' %(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.active = set()
+        self.lock = threading.Lock()
+
+    def setup(self):
+        """
+        Creates the indexes used to find pending commands and expire completed ones.
+        """
+        self.commands.create_index([('partition', ASCENDING), ('completed', ASCENDING), ('_id', ASCENDING)])
+        self.commands.create_index('completed', expireAfterSeconds=3600)
+        self.commands.create_index('queued')
+
+    def last_command(self):
+        """
+        Finds the command most recently queued by any server (according to the
+        servers' clocks - command IDs come from the clients' clocks). Used to
+        resume tailing the ``eva_commands`` channel after every server was
+        stopped.
+
+        :return: The ID of the latest queued command and the time it was
+            queued, or ``(None, None)``.
+        :rtype: tuple
+        """
+        document = self.commands.find_one({}, sort=[('queued', DESCENDING)])
+        if document is None:
+            return None, None
+        return document['_id'], document.get('queued')
+
+    def start_heartbeat(self):
+        """
+        Starts renewing the leases of the partitions handled by this server in
+        a background thread.
+        """
+        thread = threading.Thread(target=self.heartbeat, daemon=True)
+        thread.start()
+
+    def heartbeat(self):
+        """
+        Renews the lease of every partition this server is handling (including
+        while a command is being handled) every ``lease_timeout / 3`` seconds.
+        """
+        while True:
+            time.sleep(self.lease_timeout / 3.0)
+            with self.lock:
+                for partition in list(self.active):
+                    try:
+                        if not self.acquire(partition):
+                            log.warning('Lost the lease of partition %s' %partition)
+                    except Exception as err: #pylint: disable=W0703
+                        log.warning('Could not renew the lease of partition %s: %s' %(partition, err))
+
+    def enqueue(self, command_id, data, deadline):
+        """
+        Queues a command unless another server already did.
+
+        :param command_id: The ID of the command (see :func:`eva.director.subscribe_commands`).
+        :param data: The data received from Eva clients.
+        :type data: dict
+        :param deadline: The time (as returned by ``time.time()``) after which
+            the command should be dropped.
+        :type deadline: float
+        :return: The partition of the command.
+        :rtype: string
+        """
+        partition = get_partition(data)
+        try:
+            self.commands.insert_one({'_id': command_id,
+                                      'partition': partition,
+                                      'data': data,
+                                      'deadline': deadline,
+                                      'queued': time.time(),
+                                      'completed': None})
+        except DuplicateKeyError:
+            pass
+        return partition
+
+    def pending_partitions(self):
+        """
+        :return: The partitions that have commands waiting to be handled.
+        :rtype: list
+        """
+        return self.commands.distinct('partition', {'completed': None})
+
+    def acquire(self, partition):
+        """
+        Claims (or renews) the lease of a partition for this server.
+
+        :param partition: The partition to claim.
+        :type partition: string
+        :return: ``True`` if this server now holds the lease.
+        :rtype: boolean
+        """
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=self.lease_timeout)
+        try:
+            lease = self.leases.find_one_and_update(
+                {'_id': partition, '$or': [{'owner': self.instance_id}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': self.instance_id, 'expires': expires}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Another server holds a valid lease on this partition.
+            return False
+        return lease is not None and lease['owner'] == self.instance_id
+
+    def release(self, partition):
+        """
+        Gives up the lease of a partition.
+
+        :param partition: The partition to release.
+        :type partition: string
+        """
+        self.leases.delete_one({'_id': partition, 'owner': self.instance_id})
+
+    def activate(self, partition):
+        """
+        Marks a partition as being handled by this server if its lease could be
+        claimed and no worker is handling it already.
+
+        :param partition: The partition to handle.
+        :type partition: string
+        :return: ``True`` if the partition should be handed to a worker.
+        :rtype: boolean
+        """
+        with self.lock:
+            if partition in self.active:
+                return False
+            if not self.acquire(partition):
+                return False
+            self.active.add(partition)
+            return True
+
+    def deactivate(self, partition):
+        """
+        Releases a partition once a worker is done with it.
+
+        :param partition: The partition to release.
+        :type partition: string
+        """
+        with self.lock:
+            self.active.discard(partition)
+            try:
+                self.release(partition)
+            except Exception as err: #pylint: disable=W0703
+                log.warning('Could not release partition %s: %s' %(partition, err))
+
+    def reject(self, command_id, partition):
+        """
+        Marks a command as handled without handling it, unless the partition is
+        being handled (by this server or another one).
+
+        :param command_id: The ID of the command.
+        :param partition: The partition of the command.
+        :type partition: string
+        :return: ``True`` if the command was rejected (and should be answered
+            with the busy response).
+        :rtype: boolean
+        """
+        with self.lock:
+            # Holding the lease keeps every other server away from the command.
+            if partition in self.active or not self.acquire(partition):
+                return False
+            try:
+                result = self.commands.update_one({'_id': command_id, 'completed': None},
+                                                  {'$set': {'completed': datetime.datetime.utcnow(),
+                                                            'rejected': True}})
+                return result.modified_count == 1
+            finally:
+                self.release(partition)
+
+    def next_command(self, partition):
+        """
+        Gets the oldest command waiting in a partition.
+
+        :param partition: The partition to look in.
+        :type partition: string
+        :return: The queued document (with ``_id``, ``data`` and ``deadline``
+            keys), or ``None``.
+        :rtype: dict
+        """
+        return self.commands.find_one({'partition': partition, 'completed': None},
+                                      sort=[('_id', ASCENDING)])
+
+    def complete(self, command_id):
+        """
+        Marks a command as handled.
+
+        :param command_id: The ID of the command.
+        """
+        self.commands.update_one({'_id': command_id},
+                                 {'$set': {'completed': datetime.datetime.utcnow()}})
+
+def get_partition(data):
+    """
+    Gets the partition a command belongs to. Commands from the same client are
+    always handled in order by a single server.
+
+    :param data: The data received from Eva clients.
+    :type data: dict
+    :return: The client ID, or ``'default'`` for clients without one.
+    :rtype: string
+    """
+    return data.get('client_id') or 'default'
@@ -2,10 +2,202 @@
 Holds functions related to Eva and plugins configuration.
 """
 import os
+import time
+import atexit
 import inspect
-from configobj import ConfigObj
+import tempfile
+import threading
+from configobj import ConfigObj, flatten_errors
 from validate import Validator
 
+#: The current :class:`ConfigSnapshot` (see :func:`get_snapshot`).
+SNAPSHOT = None
+#: Serializes configuration writers (see :func:`update_config`).
+SNAPSHOT_LOCK = threading.RLock()
+#: Functions called with the ``values``, ``section``, ``plugin_id`` and
+#: ``save`` arguments of every :func:`update_config` call (used to keep worker
+#: processes in sync).
+UPDATE_LISTENERS = []
+#: Whether or not :func:`update_config` saves changes itself (worker processes
+#: leave it to the main process).
+SAVE_LOCALLY = True
+
+class ConfigSnapshot(object):
+    """
+    An immutable, attribute-accessible copy of the Eva configuration.
+
+    Snapshots are never modified once built. Changes go through
+    :func:`update_config`, which builds a new snapshot (sharing every untouched
+    section with the previous one) and swaps it in atomically. Readers can
+    therefore hold on to a snapshot and read it without any locking::
+
+        from eva.config import get_snapshot
+        config = get_snapshot()
+        plugin_directory = config.eva.plugin_directory
+        location = config['plugins']['weather']['config']['location']
+
+    Keys that clash with method names (``get``, ``keys``, ``items``) are only
+    accessible with the ``[]`` syntax.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, values):
+        """
+        :param values: The (possibly nested) configuration values to freeze.
+        :type values: dict
+        """
+        object.__setattr__(self, 'data', {key: freeze(value) for key, value in values.items()})
+
+    def __getattr__(self, name):
+        try:
+            return self.data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise TypeError('Configuration snapshots are read-only, use eva.config.update_config()')
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return 'ConfigSnapshot(%r)' %self.data
+
+    def __reduce__(self):
+        return (ConfigSnapshot, (self.data,))
+
+    def get(self, key, default=None):
+        """
+        Same as ``dict.get()``.
+        """
+        return self.data.get(key, default)
+
+    def keys(self):
+        """
+        Same as ``dict.keys()``.
+        """
+        return self.data.keys()
+
+    def items(self):
+        """
+        Same as ``dict.items()``.
+        """
+        return self.data.items()
+
+    def replace(self, path, value):
+        """
+        Returns a new snapshot with the value at ``path`` replaced. Every
+        section that is not on the path is shared with this snapshot.
+
+        :param path: The keys leading to the value to replace.
+        :type path: tuple
+        :param value: The new value.
+        :return: The new snapshot.
+        :rtype: :class:`ConfigSnapshot`
+        """
+        values = dict(self.data)
+        if len(path) == 1:
+            values[path[0]] = value
+        else:
+            child = values.get(path[0])
+            if not isinstance(child, ConfigSnapshot):
+                child = ConfigSnapshot({})
+            values[path[0]] = child.replace(path[1:], value)
+        return ConfigSnapshot(values)
+
+def freeze(value):
+    """
+    Converts a configuration value into its immutable equivalent: dicts (and
+    ConfigObj sections) become :class:`ConfigSnapshot` objects and lists
+    become tuples. Everything else is returned as is.
+
+    :param value: The value to convert.
+    :return: The immutable value.
+    """
+    if isinstance(value, ConfigSnapshot):
+        return value
+    if isinstance(value, dict):
+        return ConfigSnapshot(value)
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def get_snapshot():
+    """
+    Returns the current configuration snapshot. This is a lock-free read that
+    is safe to use from interactions, scheduler jobs, and plugin threads.
+
+    :return: The current configuration snapshot.
+    :rtype: :class:`ConfigSnapshot`
+    """
+    if SNAPSHOT is None:
+        return refresh_snapshot()
+    return SNAPSHOT
+
+def refresh_snapshot():
+    """
+    Rebuilds the configuration snapshot from the ``conf`` singleton.
+
+    Eva calls this once plugins are loaded. Code that modifies the ``conf``
+    singleton directly (instead of using :func:`update_config`) must call this
+    function for the changes to become visible in snapshots.
+
+    :return: The new configuration snapshot.
+    :rtype: :class:`ConfigSnapshot`
+    """
+    global SNAPSHOT #pylint: disable=W0603
+    from eva import conf
+    with SNAPSHOT_LOCK:
+        SNAPSHOT = ConfigSnapshot(conf)
+        return SNAPSHOT
+
+def update_config(values, section=None, plugin_id=None, save=False):
+    """
+    Thread-safe way of changing Eva or plugin configuration values.
+
+    The values are applied to the ``conf`` singleton and a new snapshot is
+    published. Readers holding the previous snapshot are unaffected.
+
+    :param values: The configuration keys and their new values.
+    :type values: dict
+    :param section: The Eva configuration section to update when ``plugin_id``
+        is ``None``.
+    :type section: string
+    :param plugin_id: The plugin whose configuration should be updated.
+    :type plugin_id: string
+    :param save: Whether or not to persist the changes with :func:`save_config`.
+    :type save: boolean
+    :return: The new configuration snapshot.
+    :rtype: :class:`ConfigSnapshot`
+    """
+    global SNAPSHOT #pylint: disable=W0603
+    from eva import conf
+    with SNAPSHOT_LOCK:
+        if plugin_id is None:
+            assert section is not None, 'Must provide a section to update eva core configuration.'
+            target = conf[section]
+            path = (section,)
+        else:
+            target = conf['plugins'][plugin_id]['config']
+            path = ('plugins', plugin_id, 'config')
+        target.update(values)
+        SNAPSHOT = get_snapshot().replace(path, target)
+        snapshot = SNAPSHOT
+    for listener in list(UPDATE_LISTENERS):
+        listener(values, section, plugin_id, save)
+    if save and SAVE_LOCALLY:
+        save_config(plugin_id, section)
+    return snapshot
+
 def get_config(config_file=None, spec_file=None, **kwargs):
     """
     Function used to fetch Eva core and plugin configurations on startup.
@@ -33,19 +225,16 @@ def get_config(config_file=None, spec_file=None, **kwargs):
         config_file = get_eva_config_file()
     config = ConfigObj(config_file, configspec=get_config_spec(spec_file), **kwargs)
     # First round of validation to see if everything is OK.
+    # validate() returns True on success and a dict of results otherwise.
     results = config.validate(Validator())
-    if results:
+    if results is True:
         # Everything OK, return the config.
         return config
     # Something went wrong, re-validate and preserve errors.
     results = config.validate(Validator(), preserve_errors=True)
     invalid = []
-    for section_name, section in results.items():
-        print(section_name)
-        print(section)
-        for key, value in section.items():
-            if value is False:
-                invalid.append('[' + section_name + '] - ' + key)
+    for sections, key, _ in flatten_errors(config, results):
+        invalid.append('[' + ']['.join(sections) + '] - ' + str(key))
     raise Exception('Invalid config values in %s for: %s' %(config_file, ', '.join(invalid)))
 
 def get_plugin_config(plugin_id, config_dir):
@@ -122,6 +311,167 @@ def get_eva_config_file():
     if os.path.isfile('/etc/eva/eva.conf'):
         return '/etc/eva/eva.conf'
 
+class SaveQueue(object):
+    """
+    Debounces configuration saves and writes them to disk atomically.
+
+    Saves are coalesced per file: a file is written once, ``delay`` seconds
+    after the first save request, no matter how many saves were requested in
+    the meantime. The file content is rendered from the in-memory configuration
+    when it is written (the file on disk is never re-parsed), written to a
+    temporary file, and renamed over the original.
+    """
+    def __init__(self, delay=1.0):
+        """
+        :param delay: Seconds to wait before writing a file. Files are written
+            synchronously if set to 0.
+        :type delay: float
+        """
+        self.delay = delay
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, path, render):
+        """
+        Schedules a file to be written.
+
+        :param path: The file to write.
+        :type path: string
+        :param render: A function returning the lines to write, called when the
+            file is written.
+        :type render: callable
+        """
+        if self.delay <= 0:
+            write_atomically(path, render())
+            return
+        with self.condition:
+            if path not in self.pending:
+                self.pending[path] = (time.time() + self.delay, render)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        """
+        Writes pending files once their delay expires.
+        """
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                now = time.time()
+                due = [path for path, (when, _) in self.pending.items() if when <= now]
+                if not due:
+                    self.condition.wait(min(when for when, _ in self.pending.values()) - now)
+                    continue
+                renders = [(path, self.pending.pop(path)[1]) for path in due]
+            for path, render in renders:
+                self.write(path, render)
+
+    def flush(self):
+        """
+        Writes every pending file immediately.
+        """
+        with self.condition:
+            renders = [(path, render) for path, (_, render) in self.pending.items()]
+            self.pending.clear()
+        for path, render in renders:
+            self.write(path, render)
+
+    def write(self, path, render): #pylint: disable=R0201
+        """
+        Renders and writes a single file, logging any error.
+        """
+        from eva import log
+        try:
+            write_atomically(path, render())
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not save configuration file %s: %s' %(path, err))
+
+#: Pending configuration saves (see :func:`save_config`).
+SAVE_QUEUE = SaveQueue()
+atexit.register(SAVE_QUEUE.flush)
+#: The Eva core configuration as it should be written to disk (see :func:`get_saved_config`).
+SAVED_CONFIG = None
+#: The modification time of the configuration files written by Eva, by path
+#: (see :func:`is_written_by_eva`).
+WRITTEN_MTIMES = {}
+WRITTEN_MTIMES_LOCK = threading.Lock()
+
+def write_atomically(path, lines):
+    """
+    Writes lines to a file through a temporary file in the same directory,
+    which is then renamed over the destination. Readers never see a partially
+    written file. The modification time of the file is recorded so that the
+    configuration watcher doesn't reload it (see :func:`is_written_by_eva`).
+
+    :param path: The file to write.
+    :type path: string
+    :param lines: The lines to write.
+    :type lines: list
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except FileExistsError:
+        pass
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(handle, 'w') as temp_file:
+            temp_file.write('\n'.join(lines) + '\n')
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        with WRITTEN_MTIMES_LOCK:
+            os.replace(temp_path, path)
+            WRITTEN_MTIMES[os.path.abspath(path)] = os.stat(path).st_mtime_ns
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+def is_written_by_eva(path, mtime):
+    """
+    Whether or not a configuration file is as Eva last wrote it (with
+    :func:`write_atomically`), as opposed to changed by someone else.
+
+    :param path: The path of the file.
+    :type path: string
+    :param mtime: The modification time of the file, in nanoseconds
+        (``st_mtime_ns``).
+    :type mtime: integer
+    :rtype: boolean
+    """
+    with WRITTEN_MTIMES_LOCK:
+        return WRITTEN_MTIMES.get(os.path.abspath(path)) == mtime
+
+def copy_saved_values(source, target, defaults=True):
+    """
+    Copies the values of a configuration section, along with their comments.
+
+    Saved configurations include the values filled in from the specification
+    defaults, so that saving a configuration that was never changed still
+    writes out every value (as Eva always did). Copies of the configuration
+    file as it is on disk leave them out.
+
+    :param source: The configuration section to copy.
+    :type source: `configobj.Section  <https://configobj.readthedocs.io/en/latest/>`_
+    :param target: The (empty) configuration section to copy to.
+    :type target: `configobj.Section  <https://configobj.readthedocs.io/en/latest/>`_
+    :param defaults: Whether or not to copy the values filled in from the
+        specification defaults.
+    :type defaults: boolean
+    """
+    for key in source.scalars:
+        if defaults or key not in source.defaults:
+            target[key] = source[key]
+    for key in source.sections:
+        target[key] = {}
+        copy_saved_values(source[key], target[key], defaults)
+    for key in target:
+        target.comments[key] = list(source.comments.get(key, []))
+        target.inline_comments[key] = source.inline_comments.get(key)
+
 def save_config(plugin_id=None, section=None):
     """
     Save current active plugin configuration to disk.
@@ -133,6 +483,10 @@ def save_config(plugin_id=None, section=None):
     If Eva can't find it's core configuration object when saving, it will write
     out it's current configurations to ``~/eva/eva.conf``.
 
+    Saves are queued and written to disk ``save_delay`` seconds later (see
+    :class:`SaveQueue`), so frequent saves of the same file result in a single
+    write.
+
     :param plugin_id: The plugin ID to have it's configurations preserved.
         If ``None``, assumes Eva's core configurations - in which case ``section`` is required.
     :type plugin_id: string
@@ -142,36 +496,87 @@ def save_config(plugin_id=None, section=None):
     """
     # Load up the active singleton.
     from eva import conf
+    SAVE_QUEUE.delay = conf['eva']['save_delay']
     # Only save the relevant sections.
     if plugin_id is None:
         assert section is not None, 'Must provide a section to update eva core configuration.'
-        # Save eva core configuration.
-        old_configuration = get_config()
-        old_configuration[section] = conf[section]
-        if old_configuration.filename is None:
-            save_location = os.path.expanduser('~') + '/eva'
-            try:
-                os.makedirs(save_location)
-            except FileExistsError:
-                pass
-            old_configuration.write(open(save_location + '/eva.conf', 'wb'))
-        else:
-            old_configuration.write()
+        mark_section_saved(section, conf[section])
+        save_location = conf.filename
+        if save_location is None:
+            save_location = os.path.expanduser('~') + '/eva/eva.conf'
+        SAVE_QUEUE.schedule(save_location, render_core_config)
     else:
         plugin_config_directory = os.path.expanduser(conf['eva']['config_directory'])
-        # Ensure the configs directory exists.
-        try:
-            os.makedirs(plugin_config_directory)
-        except FileExistsError:
-            pass
-        old_configuration = get_plugin_config(plugin_id, plugin_config_directory)
-        if old_configuration.filename is None:
-            # We're still using default values - create config file for plugin.
-            # Update all default values.
-            for configuration in conf['plugins'][plugin_id]['config']:
-                old_configuration[configuration] = \
-                    conf['plugins'][plugin_id]['config'][configuration]
-            old_configuration.write(open(plugin_config_directory + '/' + plugin_id + '.conf', 'wb'))
+        save_location = plugin_config_directory + '/' + plugin_id + '.conf'
+        def render_plugin_config():
+            """
+            Renders the plugin configuration as it is when written to disk.
+            """
+            with SNAPSHOT_LOCK:
+                plugin_config = conf['plugins'][plugin_id]['config']
+                saved_config = ConfigObj()
+                saved_config.indent_type = plugin_config.indent_type
+                saved_config.initial_comment = list(plugin_config.initial_comment)
+                copy_saved_values(plugin_config, saved_config)
+                return saved_config.write()
+        SAVE_QUEUE.schedule(save_location, render_plugin_config)
+
+def mark_section_saved(section, values, defaults=True):
+    """
+    Records the values of an Eva core configuration section as the ones to
+    write to disk. Used by :func:`save_config`, and by the configuration
+    watcher when a section was changed on disk.
+
+    :param section: The name of the section.
+    :type section: string
+    :param values: The section values.
+    :type values: `configobj.Section  <https://configobj.readthedocs.io/en/latest/>`_
+    :param defaults: Whether or not to write the values filled in from the
+        specification defaults (``False`` to keep the section as it is on disk).
+    :type defaults: boolean
+    """
+    with SNAPSHOT_LOCK:
+        saved_config = get_saved_config()
+        saved_config[section] = {}
+        copy_saved_values(values, saved_config[section], defaults)
+        if saved_config[section]:
+            saved_config.comments[section] = list(values.parent.comments.get(section, []))
         else:
-            # We already have a config file for this plugin, save to disk.
-            conf['plugins'][plugin_id]['config'].write()
+            del saved_config[section]
+
+def get_saved_config():
+    """
+    Returns the Eva core configuration as it should be written to disk.
+
+    Eva captures it on boot (before plugins get a chance to modify the ``conf``
+    singleton), after which sections only change through
+    :func:`mark_section_saved`. This way, saving a section never writes out
+    unsaved changes made to other sections, and the configuration file never
+    needs to be re-parsed.
+
+    :return: The configuration to write to disk.
+    :rtype: `ConfigObj  <https://configobj.readthedocs.io/en/latest/>`_
+    """
+    global SAVED_CONFIG #pylint: disable=W0603
+    from eva import conf
+    with SNAPSHOT_LOCK:
+        if SAVED_CONFIG is None:
+            SAVED_CONFIG = ConfigObj()
+            SAVED_CONFIG.indent_type = conf.indent_type
+            SAVED_CONFIG.initial_comment = list(conf.initial_comment)
+            SAVED_CONFIG.final_comment = list(conf.final_comment)
+            for section in conf.sections:
+                # The plugins section is built on boot and never saved.
+                if section != 'plugins':
+                    mark_section_saved(section, conf[section], defaults=False)
+        return SAVED_CONFIG
+
+def render_core_config():
+    """
+    Renders the Eva core configuration file from :func:`get_saved_config`.
+
+    :return: The configuration file lines.
+    :rtype: list
+    """
+    with SNAPSHOT_LOCK:
+        return get_saved_config().write()
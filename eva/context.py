@@ -22,6 +22,10 @@ class EvaContext(object):
         The data attribute is typically a dict with the following structure::
 
             dict {
+                'client_id': The ID of the client that sent the query (optional)
+                'request_id': The client's ID for this query (optional)
+                'session_id': The conversation this query belongs to (optional,
+                              defaults to the client ID)
                 'input_text': The text/query provided by the client
                 'input_audio': dict {
                     'audio': The binary audio data of the query (optional)
@@ -45,6 +49,10 @@ class EvaContext(object):
         :param data: The data received from an Eva client.
         :type data: dict
         """
+        #: The ID of the Eva client that sent the query or command (if provided).
+        self.client_id = None
+        #: The client's ID for this query or command (if provided).
+        self.request_id = None
         #: The input text (query or command) from an Eva client.
         self.input_text = None
         #: The input audio binary data from an Eva client.
@@ -59,7 +67,13 @@ class EvaContext(object):
         self.output_audio_content_type = None
         #: True if a plugin has already handled the response, False otherwise.
         self.responded = False
+        #: The conversation state shared across interactions with the same
+        #: client (see :class:`eva.session.Session`). Set by
+        #: :func:`eva.director.interact`.
+        self.session = None
         if data is not None:
+            self.client_id = data.get('client_id')
+            self.request_id = data.get('request_id')
             if 'input_text' in data:
                 self.input_text = data['input_text']
             if 'input_audio' in data:
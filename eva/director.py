@@ -4,11 +4,50 @@ all the plugins, and begin interactions with the clients.
 """
 
 import time
+import queue
+import calendar
+import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import gossip
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+import eva.config
+import eva.session
+import eva.history
+import eva.command_log
 from eva.plugin import load_plugins
-from eva.util import get_pubsub
+from eva.config import get_snapshot, refresh_snapshot, get_saved_config, SaveQueue
+from eva.util import get_pubsub, get_mongo_client, exec_eva, restart
+from eva.scheduler import wait_for_jobs
+from eva.command_queue import CommandQueue
+from eva.prefork import WorkerPool
+from eva.session import Session, get_session_store, get_session_id
+from eva.history import get_history_recorder
+from eva.command_log import get_command_log
+from eva.audio_stream import AudioReceiver
+from eva.ipc import LocalBroker
+from eva.watcher import ConfigWatcher
 from eva.context import EvaContext
 from eva import log
+from eva import conf
+from eva import metrics
+from eva import scheduler
+from eva import hooks
+
+#: Set while :func:`serve` is consuming commands.
+SERVING = threading.Event()
+#: Set when :func:`serve` should stop consuming commands (see :func:`request_restart`).
+STOPPING = threading.Event()
+#: The command line arguments for the new Eva process once drained.
+RESTART_ARGS = []
+#: The worker processes handling interactions (see :class:`eva.prefork.WorkerPool`).
+WORKER_POOL = None
+#: The pubsub object used by a worker process to answer the clients.
+WORKER_PUBSUB = None
+#: Seconds between the heartbeats recorded by :class:`CommandCursor`.
+HEARTBEAT_INTERVAL = 5.0
 
 def serve():
     """
@@ -16,32 +55,851 @@ def serve():
 
     It begins the boot sequence, loads up all plugins, and starts listening for
     client interactions.
+
+    When worker processes are configured, they are forked right after boot,
+    before this process starts any thread (the scheduler, the pubsub broker,
+    the configuration watcher...).
     """
+    broker = None
+    if conf['pubsub']['backend'] == 'local':
+        # Plugins may publish while booting: bind the socket first.
+        broker = LocalBroker(conf['pubsub']['socket_path'])
+        broker.bind()
     boot()
+    if conf['director']['processes'] > 0:
+        start_worker_pool(conf['director']['processes'])
+    start_scheduler()
+    if broker is not None:
+        broker.start()
+    if conf['eva']['watch_config']:
+        ConfigWatcher(conf['eva']['watch_interval']).start()
     pubsub = get_pubsub()
+    if conf['audio']['enabled']:
+        start_audio_receiver(pubsub)
+    # Commands are handed to the interaction workers through a bounded queue.
+    commands = queue.Queue(maxsize=conf['director']['max_queue_size'])
+    if get_consumer_mode() == 'competing':
+        consume_competing(pubsub, commands)
+    else:
+        consume_broadcast(pubsub, commands)
+    SERVING.clear()
+    drain_and_restart(commands)
+
+def start_worker_pool(size):
+    """
+    Forks the worker processes that handle interactions (see
+    :class:`eva.prefork.WorkerPool`). Must be called after :func:`boot` and
+    before any thread is started. Worker processes inherit the loaded plugins,
+    call :func:`reset_after_fork`, and flush their buffers with
+    :func:`flush_stores` before exiting. Restarts requested by worker
+    processes are handled by this process (see :func:`eva.util.restart`).
+
+    :param size: The number of worker processes.
+    :type size: integer
+    """
+    global WORKER_POOL #pylint: disable=W0603
+    WORKER_POOL = WorkerPool(size, handle_in_worker, reset_after_fork, flush_stores, restart)
+    WORKER_POOL.start()
+
+def start_scheduler():
+    """
+    Starts the scheduler (see :func:`eva.scheduler.get_scheduler`), once the
+    worker processes were forked. Jobs only run in this process.
+    """
+    if not scheduler.running:
+        scheduler.start()
+
+def reset_after_fork():
+    """
+    Called in every worker process forked by :func:`start_worker_pool`.
+    Drops the objects created by the main process that hold threads, locks or
+    MongoDB clients (the session store, history recorder, and configuration
+    save queue), so that the worker creates its own.
+    """
+    global WORKER_PUBSUB #pylint: disable=W0603
+    WORKER_PUBSUB = None
+    eva.session.SESSION_STORE = None
+    eva.history.HISTORY_RECORDER = None
+    eva.command_log.COMMAND_LOG = None
+    eva.config.SAVE_QUEUE = SaveQueue()
+
+def handle_in_worker(data, text_to_speech):
+    """
+    Handles a command in a worker process started by :func:`start_worker_pool`.
+    The pubsub object is created in the worker since MongoDB clients can't be
+    shared between processes.
+
+    :param data: The data received from Eva clients.
+    :type data: dict
+    :param text_to_speech: Passed on to :func:`interact`.
+    :type text_to_speech: boolean
+    """
+    global WORKER_PUBSUB #pylint: disable=W0603
+    if WORKER_PUBSUB is None:
+        WORKER_PUBSUB = get_pubsub()
+    handle_data_from_client(WORKER_PUBSUB, data, text_to_speech)
+
+def start_audio_receiver(pubsub):
+    """
+    Starts receiving framed audio from voice clients (see
+    :class:`eva.audio_stream.AudioReceiver`). Every utterance received is
+    published as a command, as if a client had sent it.
+
+    :param pubsub: The pubsub object used to publish the commands.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    """
+    receiver = AudioReceiver(lambda data: pubsub.publish('eva_commands', data),
+                             conf['audio']['host'],
+                             conf['audio']['port'],
+                             conf['audio']['reorder_window'],
+                             conf['audio']['utterance_timeout'])
+    receiver.start()
+
+def get_consumer_mode():
+    """
+    Gets the configured ``consumer_mode`` (``[director]`` configuration
+    section). Competing consumers require the ``mongodb`` pubsub backend.
+
+    :return: Either ``broadcast`` or ``competing``.
+    :rtype: string
+    """
+    mode = conf['director']['consumer_mode']
+    if mode == 'competing' and conf['pubsub']['backend'] != 'mongodb':
+        log.warning('Competing consumers require the mongodb pubsub backend - using broadcast')
+        return 'broadcast'
+    return mode
+
+def consume_broadcast(pubsub, commands):
+    """
+    Handles every command sent by the clients. Only one Eva server should
+    run in this mode.
+
+    :param pubsub: The pubsub object used to receive commands from the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param commands: The command queue read by the interaction workers.
+    :type commands: :class:`queue.Queue`
+    """
+    cursor = CommandCursor(conf['pubsub']['backend'] == 'mongodb')
+    command_log = get_command_log()
+    start_workers(work, pubsub, commands, cursor)
     # Notify connected clients that Eva has started successfully.
     pubsub.publish('eva_messages', 'Eva startup successful')
-    # Start listening for commands.
-    subscriber = pubsub.subscribe('eva_commands')
-    # Subscriber will continuously tail the mongodb collection.
-    for data in subscriber:
-        if data is not None:
-            handle_data_from_client(pubsub, data)
+    SERVING.set()
+    # Start listening for commands, picking up where the last Eva process left off.
+    watermark = cursor.load()
+    for command_id, sent, data in subscribe_commands(pubsub, watermark, cursor.stopped):
+        if STOPPING.is_set():
+            break
+        cursor.heartbeat()
+        if data is None or not is_valid_command(data):
+            continue
+        if cursor.seen(command_id):
+            log.info('Skipping command %s - already processed' %command_id)
+            metrics.increment('director.commands_duplicate')
+            continue
+        if command_log is not None:
+            command_log.record(data)
+        admit_command(pubsub, commands, cursor, command_id, data, sent)
+
+def consume_competing(pubsub, commands):
+    """
+    Shares the commands sent by the clients with every other Eva server running
+    in competing mode (see :class:`eva.command_queue.CommandQueue`).
+
+    The command queue holds the partitions (client IDs) that this server owns.
+    Partitions are only claimed while the queue has room, leaving the rest to
+    other servers. Pending partitions are checked every second in order to
+    pick up commands left behind by servers that went away.
+
+    Commands received while the queue is full are given a second for another
+    server to pick them up, then answered with the busy response (see
+    :func:`shed_overflow`).
+
+    :param pubsub: The pubsub object used to receive commands from the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param commands: The partition queue read by the interaction workers.
+    :type commands: :class:`queue.Queue`
+    """
+    command_queue = CommandQueue(conf['director']['lease_timeout'])
+    command_queue.setup()
+    command_queue.start_heartbeat()
+    command_log = get_command_log()
+    start_workers(work_partitions, pubsub, commands, command_queue)
+    pubsub.publish('eva_messages', 'Eva startup successful')
+    SERVING.set()
+    log.info('Consuming commands as %s' %command_queue.instance_id)
+    next_scan = 0
+    # The commands received while the partition queue was full, by command ID.
+    overflow = {}
+    last_command_id, last_queued = command_queue.last_command()
+    for command_id, sent, data in subscribe_commands(pubsub, last_command_id, last_queued):
+        if STOPPING.is_set():
+            break
+        if data is not None and is_valid_command(data):
+            metrics.increment('director.commands_received')
+            if command_log is not None:
+                command_log.record(data)
+            deadline = sent + get_command_timeout(data)
+            partition = command_queue.enqueue(command_id, data, deadline)
+            if not admit_partition(commands, command_queue, partition):
+                overflow[command_id] = (time.time(), partition, data)
+        if time.time() >= next_scan:
+            next_scan = time.time() + 1
+            for partition in command_queue.pending_partitions():
+                admit_partition(commands, command_queue, partition)
+            shed_overflow(pubsub, commands, command_queue, overflow)
+
+def admit_partition(commands, command_queue, partition):
+    """
+    Hands a partition to the interaction workers if the partition queue has
+    room and the partition lease could be claimed.
+
+    :param commands: The partition queue read by the interaction workers.
+    :type commands: :class:`queue.Queue`
+    :param command_queue: The queue shared with the other Eva servers.
+    :type command_queue: :class:`eva.command_queue.CommandQueue`
+    :param partition: The partition with commands waiting.
+    :type partition: string
+    :return: ``False`` if the partition queue is full, ``True`` otherwise
+        (whether or not the partition was claimed by this server).
+    :rtype: boolean
+    """
+    if commands.full():
+        return False
+    if not command_queue.activate(partition):
+        return True
+    try:
+        commands.put_nowait(partition)
+    except queue.Full:
+        command_queue.deactivate(partition)
+        return False
+    finally:
+        metrics.set_gauge('director.queue_depth', commands.qsize())
+    return True
+
+def shed_overflow(pubsub, commands, command_queue, overflow):
+    """
+    Answers the commands received while the partition queue was full with the
+    busy response, if no server picked them up within a second and the
+    partition queue is still full.
+
+    :param pubsub: The pubsub object used to publish Eva messages to the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param commands: The partition queue read by the interaction workers.
+    :type commands: :class:`queue.Queue`
+    :param command_queue: The queue shared with the other Eva servers.
+    :type command_queue: :class:`eva.command_queue.CommandQueue`
+    :param overflow: The ``(time received, partition, data)`` of the commands
+        received while the queue was full, by command ID. Commands are removed
+        once handled.
+    :type overflow: dict
+    """
+    for command_id, (received, partition, data) in list(overflow.items()):
+        if time.time() - received < 1:
+            continue
+        del overflow[command_id]
+        # With room in the queue, the pending partitions are picked up instead.
+        if commands.full() and command_queue.reject(command_id, partition):
+            log.warning('Command queue is full - dropping command')
+            metrics.increment('director.commands_rejected')
+            send_busy_response(pubsub, data)
+
+class CommandCursor(object):
+    """
+    Keeps track of the commands processed by the Eva server so that a new Eva
+    process (after a restart or a crash) resumes right after the last processed
+    command, and never processes the same command twice.
+
+    The state is kept in MongoDB:
+
+        * The ``director`` collection holds the watermark: the ID of the latest
+          command such that it and every command received before it were
+          processed. It also holds the heartbeat: the last time (on the Eva
+          server's clock) this process was consuming commands
+        * The capped ``director_processed`` collection holds the IDs of
+          processed commands, used to skip the commands past the watermark that
+          were already processed (workers may finish commands out of order)
+
+    Command IDs are generated by the clients (from their own clocks), so they
+    are only used as identifiers and never compared: tailing resumes from the
+    position of the watermark command (see :func:`subscribe_commands`).
+
+    A command that was being processed when Eva crashed is processed again.
+    Only the MongoDB pubsub backend provides command IDs - with the local
+    backend, this class does nothing.
+    """
+    def __init__(self, enabled=True):
+        """
+        :param enabled: Whether or not to track commands.
+        :type enabled: boolean
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.admitted = deque()
+        self.finished = set()
+        self.processed_ids = set()
+        self.database = None
+        #: The last heartbeat of the previous Eva process (see :func:`load`).
+        self.stopped = None
+        self.last_heartbeat = 0
+
+    def load(self):
+        """
+        Loads the watermark, the heartbeat of the previous Eva process (in
+        :attr:`stopped`), and the IDs of the processed commands.
+
+        :return: The watermark, or ``None`` if no command was ever processed.
+        :rtype: `bson.objectid.ObjectId <https://api.mongodb.com/python/current/api/bson/objectid.html>`_
+        """
+        if not self.enabled:
+            return None
+        self.database = get_mongo_client()[conf['mongodb']['database']]
+        try:
+            self.database.create_collection('director_processed', capped=True, size=2 ** 20)
+        except CollectionInvalid:
+            pass
+        heartbeat = self.database['director'].find_one({'_id': 'heartbeat'})
+        if heartbeat is not None:
+            self.stopped = heartbeat['time']
+        state = self.database['director'].find_one({'_id': 'watermark'})
+        if state is None:
+            return None
+        watermark = state['command_id']
+        # The collection is capped, so this is a bounded set of recent commands.
+        processed = self.database['director_processed'].find()
+        self.processed_ids = set(document['_id'] for document in processed)
+        log.info('Resuming after command %s' %watermark)
+        return watermark
+
+    def heartbeat(self):
+        """
+        Records that this process is consuming commands, at most every
+        :data:`HEARTBEAT_INTERVAL` seconds. The next Eva process knows that
+        the commands it finds waiting were sent after that.
+        """
+        if not self.enabled or self.database is None:
+            return
+        now = time.time()
+        if now - self.last_heartbeat < HEARTBEAT_INTERVAL:
+            return
+        self.last_heartbeat = now
+        try:
+            self.database['director'].replace_one({'_id': 'heartbeat'},
+                                                  {'_id': 'heartbeat', 'time': now},
+                                                  upsert=True)
+        except Exception as err: #pylint: disable=W0703
+            log.warning('Could not record the director heartbeat: %s' %err)
+
+    def seen(self, command_id):
+        """
+        Whether or not a command was already processed by a previous Eva process.
+
+        :param command_id: The ID of the command.
+        :rtype: boolean
+        """
+        return command_id is not None and command_id in self.processed_ids
+
+    def admit(self, command_id):
+        """
+        Records that a command was consumed and will be processed.
+
+        :param command_id: The ID of the command.
+        """
+        if not self.enabled or command_id is None:
+            return
+        with self.lock:
+            self.admitted.append(command_id)
+
+    def processed(self, command_id):
+        """
+        Records that a command was processed and moves the watermark forward if
+        every command before it was processed as well.
+
+        :param command_id: The ID of the command.
+        """
+        if not self.enabled or command_id is None:
+            return
+        with self.lock:
+            self.finished.add(command_id)
+            watermark = None
+            while self.admitted and self.admitted[0] in self.finished:
+                watermark = self.admitted.popleft()
+                self.finished.discard(watermark)
+            # Persist while holding the lock so the watermark never goes backwards.
+            # The in-memory state was updated first, so a failed write only
+            # delays the watermark until the next processed command.
+            self.database['director_processed'].insert_one({'_id': command_id})
+            if watermark is not None:
+                self.database['director'].replace_one({'_id': 'watermark'},
+                                                      {'_id': 'watermark', 'command_id': watermark},
+                                                      upsert=True)
+
+def subscribe_commands(pubsub, resume_from=None, stopped=None):
+    """
+    Generator yielding a ``(command_id, sent, data)`` tuple for every command
+    published on the ``eva_commands`` channel, where ``sent`` is the time the
+    command is considered sent (used for its deadline). Yields
+    ``(None, None, None)`` when no command was received for a while, giving
+    the caller a chance to stop.
+
+    With the MongoDB backend, the command ID is the ``_id`` of the command in
+    the ``communications`` collection. Since IDs are generated by the clients
+    (from their own clocks), they don't follow the order of the capped
+    collection and are never compared: tailing resumes after the
+    ``resume_from`` command by skipping the commands up to it in the natural
+    (insertion) order. If ``resume_from`` was already dropped from the capped
+    collection, every command still in it is yielded. Without
+    ``resume_from``, only the commands published from now on are yielded.
+
+    Commands are considered sent when received, except for the commands that
+    were already waiting when Eva started (published while it was down):
+    these are considered sent at the time the client stamped them (see
+    :func:`get_sent_time`), but never before ``stopped``, so that a client
+    with a late clock can't make them expire early.
+
+    The local backend does not keep messages around, so command IDs are always
+    ``None`` and commands published while Eva is down are lost.
+
+    :param pubsub: The pubsub object used to receive commands from the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param resume_from: The ID of the last command consumed.
+    :type resume_from: `bson.objectid.ObjectId <https://api.mongodb.com/python/current/api/bson/objectid.html>`_
+    :param stopped: The last time (as returned by ``time.time()``) the
+        previous Eva process was known to consume commands (defaults to now).
+    :type stopped: float
+    """
+    collection = getattr(pubsub, 'collection', None)
+    if collection is None:
+        for data in pubsub.subscribe('eva_commands'):
+            if data is None:
+                time.sleep(0.1)
+            yield None, time.time(), data
+        return
+    query = {'type': 'message', 'channel': 'eva_commands'}
+    # The last command waiting when Eva started.
+    backlog_end = get_last_message_id(collection, query)
+    if resume_from is None:
+        resume_from, backlog_end = backlog_end, None
+    if stopped is None:
+        stopped = time.time()
+    while True:
+        cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+        skipping = resume_from is not None and \
+                   collection.find_one(dict(query, _id=resume_from), ['_id']) is not None
+        while cursor.alive:
+            try:
+                document = next(cursor)
+            except StopIteration:
+                # Nothing new within the await time, cursor is still alive.
+                yield None, None, None
+                continue
+            if skipping:
+                skipping = document['_id'] != resume_from
+                continue
+            resume_from = document['_id']
+            sent = time.time()
+            if backlog_end is not None:
+                sent = max(get_sent_time(document), min(stopped, sent))
+                if document['_id'] == backlog_end:
+                    backlog_end = None
+            yield document['_id'], sent, document['message']
+        # The cursor dies when the collection is empty (or when it fell behind
+        # the capped collection) - try again shortly.
         time.sleep(0.1)
+        yield None, None, None
 
-def handle_data_from_client(pubsub, data):
+def get_last_message_id(collection, query):
+    """
+    :param collection: The ``communications`` collection.
+    :type collection: `pymongo.collection.Collection <https://api.mongodb.com/python/current/api/pymongo/collection.html>`_
+    :param query: The query matching the messages of a channel.
+    :type query: dict
+    :return: The ID of the last message inserted (in natural order), or
+        ``None`` if there is none.
+    """
+    document = collection.find_one(query, ['_id'], sort=[('$natural', -1)])
+    if document is None:
+        return None
+    return document['_id']
+
+def get_sent_time(document):
+    """
+    Gets the time a message was published from its document in the
+    ``communications`` collection, as stamped by the client: its ``when``
+    field, or the generation time of its ``_id``. Times in the future (clients
+    with a clock ahead of Eva's) are brought back to now.
+
+    :param document: The message document.
+    :type document: dict
+    :return: The time (as returned by ``time.time()``) the message was sent.
+    :rtype: float
+    """
+    when = document.get('when')
+    if isinstance(when, datetime.datetime):
+        sent = calendar.timegm(when.utctimetuple()) + when.microsecond / 1000000.0
+    else:
+        sent = calendar.timegm(document['_id'].generation_time.utctimetuple())
+    return min(sent, time.time())
+
+def request_restart(args):
+    """
+    Asks :func:`serve` to stop accepting commands and restart Eva once the
+    commands in progress are handled. Used by :func:`eva.util.restart`.
+
+    :param args: The command line arguments for the new Eva process.
+    :type args: list
+    :return: ``True`` if a graceful restart was scheduled, ``False`` if Eva is
+        not serving commands (and should simply be restarted).
+    :rtype: boolean
+    """
+    if not SERVING.is_set():
+        return False
+    RESTART_ARGS[:] = args
+    STOPPING.set()
+    return True
+
+def drain_and_restart(commands):
+    """
+    Restarts Eva gracefully once :func:`serve` stopped accepting commands:
+
+        * Pauses the scheduler so that no new jobs are started
+        * Waits for queued commands and running jobs to finish, up to
+          ``drain_timeout`` seconds (``[director]`` configuration section)
+        * Replaces the process with a new Eva process (see :func:`eva.util.exec_eva`)
+
+    The new process resumes after the last processed command (see
+    :class:`CommandCursor`).
+
+    :param commands: The command queue read by the interaction workers.
+    :type commands: :class:`queue.Queue`
+    """
+    log.info('Restarting Eva - waiting for interactions and jobs to finish')
+    deadline = time.time() + conf['director']['drain_timeout']
+    scheduler.pause()
+    if not drain_commands(commands, deadline):
+        log.warning('Restarting with %s unfinished commands' %commands.unfinished_tasks)
+    if not wait_for_jobs(deadline):
+        log.warning('Restarting with scheduler jobs still running')
+    if WORKER_POOL is not None:
+        # Workers flush their own sessions and history before exiting.
+        WORKER_POOL.stop(max(deadline - time.time(), 1))
+    flush_stores()
+    exec_eva(RESTART_ARGS)
+
+def flush_stores():
+    """
+    Writes the sessions, history, command log, and configuration saves
+    buffered by this process immediately. Called before restarting, and by
+    worker processes before they exit (they don't run atexit functions).
+    """
+    eva.config.SAVE_QUEUE.flush()
+    if get_session_store() is not None:
+        get_session_store().flush()
+    if conf['history']['enabled']:
+        get_history_recorder().flush()
+    if get_command_log() is not None:
+        get_command_log().flush()
+
+def drain_commands(commands, deadline):
+    """
+    Waits for every command placed in the command queue to be handled.
+
+    :param commands: The command queue read by the interaction workers.
+    :type commands: :class:`queue.Queue`
+    :param deadline: The time (as returned by ``time.time()``) to stop waiting.
+    :type deadline: float
+    :return: ``True`` if every command was handled, ``False`` on timeout.
+    :rtype: boolean
+    """
+    with commands.all_tasks_done:
+        while commands.unfinished_tasks:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            commands.all_tasks_done.wait(remaining)
+    return True
+
+def admit_command(pubsub, commands, cursor, command_id, data, sent=None):
+    """
+    Places a command received from a client in the command queue along with its
+    deadline. If the queue is full, the command is dropped and the client gets
+    the busy response right away.
+
+    The deadline is ``command_deadline`` seconds (``[director]`` configuration
+    section) after the command was sent (see :func:`subscribe_commands`),
+    unless the client provided its own ``timeout`` (see
+    :func:`get_command_timeout`). Commands that are already past their
+    deadline (such as old commands sent while Eva was down) are dropped as
+    expired.
+
+    :param pubsub: The pubsub object used to publish Eva messages to the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param commands: The command queue read by the interaction workers.
+    :type commands: :class:`queue.Queue`
+    :param cursor: Keeps track of processed commands.
+    :type cursor: :class:`CommandCursor`
+    :param command_id: The ID of the command (see :func:`subscribe_commands`).
+    :param data: The data received from Eva clients.
+    :type data: dict
+    :param sent: The time (as returned by ``time.time()``) the command was
+        sent (defaults to now).
+    :type sent: float
+    """
+    deadline = (time.time() if sent is None else sent) + get_command_timeout(data)
+    cursor.admit(command_id)
+    if time.time() > deadline:
+        log.warning('Command %s expired before it was admitted - dropping command' %command_id)
+        metrics.increment('director.commands_expired')
+        reject_command(pubsub, cursor, command_id, data)
+        return
+    try:
+        commands.put_nowait((deadline, command_id, data))
+        metrics.increment('director.commands_received')
+    except queue.Full:
+        log.warning('Command queue is full - dropping command')
+        metrics.increment('director.commands_rejected')
+        reject_command(pubsub, cursor, command_id, data)
+    metrics.set_gauge('director.queue_depth', commands.qsize())
+
+def reject_command(pubsub, cursor, command_id, data):
+    """
+    Answers a command that won't be handled with the busy response, and
+    records it as processed even if the response could not be sent (so that
+    the watermark keeps moving).
+
+    :param pubsub: The pubsub object used to publish Eva messages to the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param cursor: Keeps track of processed commands.
+    :type cursor: :class:`CommandCursor`
+    :param command_id: The ID of the command.
+    :param data: The data received from Eva clients.
+    :type data: dict
+    """
+    try:
+        send_busy_response(pubsub, data)
+    except Exception as err: #pylint: disable=W0703
+        log.error('Could not send the busy response for command %s: %s' %(command_id, err))
+    finally:
+        record_processed(cursor, command_id)
+
+def record_processed(cursor, command_id):
+    """
+    Records a processed command (see :func:`CommandCursor.processed`), logging
+    any error.
+
+    :param cursor: Keeps track of processed commands.
+    :type cursor: :class:`CommandCursor`
+    :param command_id: The ID of the command.
+    """
+    try:
+        cursor.processed(command_id)
+    except Exception as err: #pylint: disable=W0703
+        log.error('Could not record processed command %s: %s' %(command_id, err))
+
+def get_command_timeout(data):
+    """
+    Gets the number of seconds a command may wait in the queue: the
+    ``timeout`` provided by the client, up to ``max_command_timeout``
+    (``[director]`` configuration section). Timeouts that aren't positive
+    numbers are replaced with ``command_deadline``.
+
+    :param data: The data received from Eva clients.
+    :type data: dict
+    :return: The timeout in seconds.
+    :rtype: float
+    """
+    config = get_snapshot().director
+    timeout = data.get('timeout')
+    if timeout is None:
+        return config['command_deadline']
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or \
+       not 0 < timeout < float('inf'):
+        log.warning('Ignoring invalid command timeout: %r' %(timeout,))
+        return config['command_deadline']
+    return min(float(timeout), config['max_command_timeout'])
+
+def is_valid_command(data):
+    """
+    Checks that a message received on the ``eva_commands`` channel can be
+    handled. Malformed messages are logged and counted (see the
+    ``director.commands_malformed`` metric).
+
+    :param data: The message received.
+    :return: Whether or not the message is a command (a dict).
+    :rtype: boolean
+    """
+    if isinstance(data, dict):
+        return True
+    log.warning('Skipping malformed command: %.100r' %(data,))
+    metrics.increment('director.commands_malformed')
+    return False
+
+def start_workers(target, *args):
+    """
+    Starts the threads (``workers`` in the ``[director]`` configuration section)
+    that handle the commands placed in the command queue.
+
+    :param target: The worker loop (:func:`work` or :func:`work_partitions`).
+    :type target: function
+    :param args: The arguments passed to the worker loop.
+    """
+    for _ in range(conf['director']['workers']):
+        worker = threading.Thread(target=target, args=args, daemon=True)
+        worker.start()
+
+def work(pubsub, commands, cursor):
+    """
+    The interaction worker loop. Takes commands off the command queue and
+    hands them to :func:`process_command`.
+
+    :param pubsub: The pubsub object used to publish Eva messages to the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param commands: The command queue filled by :func:`admit_command`.
+    :type commands: :class:`queue.Queue`
+    :param cursor: Keeps track of processed commands.
+    :type cursor: :class:`CommandCursor`
+    """
+    while True:
+        deadline, command_id, data = commands.get()
+        try:
+            process_command(pubsub, deadline, data, commands.qsize())
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not handle command %s: %s' %(command_id, err))
+            metrics.increment('director.interactions_failed')
+        finally:
+            # Failed commands count as processed, or the watermark would stop.
+            record_processed(cursor, command_id)
+            # Lets drain_commands() know when every queued command was handled.
+            commands.task_done()
+
+def work_partitions(pubsub, commands, command_queue):
+    """
+    The interaction worker loop used with competing consumers. Takes
+    partitions off the partition queue and handles their commands in order
+    until none are left, checking that the partition lease is still held
+    before each command. Every command keeps the deadline it was queued with.
+
+    :param pubsub: The pubsub object used to publish Eva messages to the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param commands: The partition queue filled by :func:`admit_partition`.
+    :type commands: :class:`queue.Queue`
+    :param command_queue: The queue shared with the other Eva servers.
+    :type command_queue: :class:`eva.command_queue.CommandQueue`
+    """
+    while True:
+        partition = commands.get()
+        try:
+            while command_queue.acquire(partition):
+                document = command_queue.next_command(partition)
+                if document is None:
+                    break
+                data = document['data']
+                deadline = document.get('deadline')
+                if deadline is None:
+                    deadline = time.time() + get_command_timeout(data)
+                process_command(pubsub, deadline, data, commands.qsize())
+                command_queue.complete(document['_id'])
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not handle commands for partition %s: %s' %(partition, err))
+        finally:
+            command_queue.deactivate(partition)
+            commands.task_done()
+
+def process_command(pubsub, deadline, data, depth):
+    """
+    Handles a single queued command. Commands that waited past their deadline
+    are dropped with the busy response. When the queue is at least
+    ``degraded_queue_size`` deep, interactions skip text-to-speech in order to
+    catch up.
+
+    :param pubsub: The pubsub object used to publish Eva messages to the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param deadline: The time (as returned by ``time.time()``) after which the
+        command should be dropped.
+    :type deadline: float
+    :param data: The data received from Eva clients.
+    :type data: dict
+    :param depth: The number of commands still waiting in the queue.
+    :type depth: integer
+    """
+    metrics.set_gauge('director.queue_depth', depth)
+    if time.time() > deadline:
+        log.warning('Command waited too long in queue - dropping command')
+        metrics.increment('director.commands_expired')
+        send_busy_response(pubsub, data)
+        return
+    degraded_size = get_snapshot().director['degraded_queue_size']
+    degraded = degraded_size > 0 and depth >= degraded_size
+    if degraded:
+        metrics.increment('director.degraded_interactions')
+    try:
+        if WORKER_POOL is None:
+            handle_data_from_client(pubsub, data, text_to_speech=not degraded)
+        else:
+            WORKER_POOL.handle(data, text_to_speech=not degraded)
+    except Exception as err: #pylint: disable=W0703
+        log.error('Interaction failed: %s' %err)
+        metrics.increment('director.interactions_failed')
+
+def send_busy_response(pubsub, data):
+    """
+    Tells a client that its command was dropped because Eva is overloaded.
+    The response has the same format as :func:`interact` return values, with
+    the ``busy`` key set to ``True``.
+
+    :param pubsub: The pubsub object used to publish Eva messages to the clients.
+    :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+    :param data: The data received from Eva clients.
+    :type data: dict
+    """
+    response = {'output_text': conf['director']['busy_response'],
+                'output_audio': None,
+                'busy': True}
+    if 'request_id' in data:
+        response['request_id'] = data['request_id']
+    pubsub.publish(get_response_channel(data), response)
+
+def handle_data_from_client(pubsub, data, text_to_speech=True):
     """
     Helper function to fire off an interaction with Eva based on client data
-    received, and then send off the response back to the clients.
+    received, and then send off the response back to the client.
+
+    The response is published on the reply channel of the client that sent the
+    command (see :func:`get_response_channel`). If the command carried a
+    ``request_id``, it is copied into the response so that the client can
+    match it with the original request.
 
     :param pubsub: The pubsub object used to publish Eva messages to the clients.
     :type pubsub: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
     :param data: The data received from Eva clients.
         See :func:`eva.context.EvaContext.__init__` for more details.
     :type data: dict
+    :param text_to_speech: Passed on to :func:`interact`.
+    :type text_to_speech: boolean
+    """
+    results = interact(data, text_to_speech)
+    if 'request_id' in data:
+        results['request_id'] = data['request_id']
+    pubsub.publish(get_response_channel(data), results)
+
+def get_response_channel(data):
+    """
+    Determines the channel a response should be published on.
+
+    Clients that provide a ``client_id`` with their commands get their own
+    reply channel named ``eva_responses_<client_id>``, so they don't receive
+    (and deserialize) every other client's responses. Commands without a
+    ``client_id`` are answered on the shared ``eva_responses`` channel.
+
+    :param data: The data received from Eva clients.
+    :type data: dict
+    :return: The name of the channel to publish the response on.
+    :rtype: string
     """
-    results = interact(data)
-    pubsub.publish('eva_responses', results)
+    client_id = data.get('client_id')
+    if client_id:
+        return 'eva_responses_%s' %client_id
+    return 'eva_responses'
 
 def boot():
     """
@@ -51,11 +909,14 @@ def boot():
     """
     log.info('Beginning Eva boot sequence')
     gossip.trigger('eva.pre_boot')
+    # Remember the core configuration as loaded from disk for future saves.
+    get_saved_config()
     load_plugins()
+    refresh_snapshot()
     gossip.trigger('eva.post_boot')
     log.info('Eva booted successfully')
 
-def interact(data):
+def interact(data, text_to_speech=True):
     """
     Eva's bread and butter function. Feeding data from the clients directly to
     this function will return a response dict, ready to be consumed by the
@@ -74,6 +935,9 @@ def interact(data):
     :param data: The data received from the clients on query/command.
         See :func:`eva.context.EvaContext.__init__` for more details.
     :type data: dict
+    :param text_to_speech: Whether or not to fire the `eva.text_to_speech`
+        trigger. Eva skips it when overloaded.
+    :type text_to_speech: boolean
     :return: A dictionary with all the information necessary for the clients to
         handle the response appropriately. Typically something like this::
 
@@ -85,6 +949,41 @@ def interact(data):
                 }
             }
 
+    :rtype: dict
+    """
+    return run_interaction(data, text_to_speech, get_interaction_state())
+
+def get_interaction_state():
+    """
+    Gathers the objects every interaction needs (the session store, history
+    recorder, and related settings), so that a batch of interactions only
+    looks them up once (see :func:`interact_many`).
+
+    :return: A dict used by :func:`run_interaction`.
+    :rtype: dict
+    """
+    config = get_snapshot()
+    state = {'sessions': get_session_store(),
+             'max_turns': config.sessions['max_turns'],
+             'speculative': config.hooks['speculative'],
+             'history': None}
+    if config.history['enabled']:
+        state['history'] = get_history_recorder()
+    return state
+
+def run_interaction(data, text_to_speech, state):
+    """
+    Runs a single interaction (see :func:`interact`).
+
+    :param data: The data received from the clients on query/command.
+    :type data: dict
+    :param text_to_speech: Whether or not to fire the `eva.text_to_speech`
+        trigger.
+    :type text_to_speech: boolean
+    :param state: The shared interaction state (see
+        :func:`get_interaction_state`).
+    :type state: dict
+    :return: The response dict (see :func:`interact`).
     :rtype: dict
     """
     log.info('Starting eva interaction')
@@ -93,21 +992,140 @@ def interact(data):
     if 'input_audio' in data:
         log.info('Interaction audio provided')
         if 'input_text' not in data:
-            gossip.trigger('eva.voice_recognition', data=data)
-    gossip.trigger('eva.pre_interaction_context', data=data)
+            hooks.trigger('eva.voice_recognition', data=data)
+    hooks.trigger('eva.pre_interaction_context', data=data)
     context = EvaContext(data)
-    gossip.trigger('eva.pre_interaction', context=context)
-    gossip.trigger('eva.interaction', context=context)
-    gossip.trigger('eva.post_interaction', context=context)
+    sessions = state['sessions']
+    session_id = get_session_id(data)
+    if sessions is None or session_id is None:
+        # Sessions are disabled or the client is anonymous: plugins still get a
+        # session, but it only lasts for this interaction.
+        sessions = None
+        context.session = Session(session_id)
+    else:
+        context.session = sessions.get(session_id)
+    hooks.trigger('eva.pre_interaction', context=context)
+    if state['speculative']:
+        hooks.trigger_speculative('eva.interaction', context)
+    else:
+        hooks.trigger('eva.interaction', context=context)
+    hooks.trigger('eva.post_interaction', context=context)
+    if sessions is not None:
+        context.session.add_turn(context.get_input_text(), context.get_output_text(),
+                                 state['max_turns'])
+        sessions.save(context.session)
     # Handle text-to-speech opportunity.
-    if context.get_output_text() and not context.get_output_audio():
-        gossip.trigger('eva.text_to_speech', context=context)
+    if text_to_speech and context.get_output_text() and not context.get_output_audio():
+        hooks.trigger('eva.text_to_speech', context=context)
     # Prepare return data.
     return_data = get_return_data(context)
     # One last chance to modify the return data before sending to client.
-    gossip.trigger('eva.pre_return_data', return_data=return_data)
+    hooks.trigger('eva.pre_return_data', return_data=return_data)
+    if state['history'] is not None:
+        state['history'].record(context, return_data)
     return return_data
 
+def interact_many(iterable, concurrency=None, text_to_speech=False, ordered=True, stats=None):
+    """
+    Runs a batch of interactions (reprocessing transcripts, regression suites,
+    nightly jobs, etc.) and streams the responses back as they are ready.
+
+    The interactions run in a pool of ``concurrency`` threads and share the
+    state looked up once for the whole batch (see
+    :func:`get_interaction_state`). The iterable is consumed lazily, so it can
+    be a generator over millions of commands. An interaction that fails yields
+    a response with ``output_text`` set to ``None`` and an ``error`` key::
+
+        for data, response in director.interact_many(commands, concurrency=8):
+            print(data['input_text'], '->', response['output_text'])
+
+    Throughput is logged when the batch is done, and recorded in the
+    ``director.batch_interactions``, ``director.batch_interactions_failed``,
+    and ``director.batch_throughput`` metrics.
+
+    :param iterable: The data of every interaction (see :func:`interact`).
+    :type iterable: iterable
+    :param concurrency: The number of interactions running at once (defaults
+        to the ``workers`` setting of the ``[director]`` section).
+    :type concurrency: integer
+    :param text_to_speech: Whether or not to fire the `eva.text_to_speech`
+        trigger - usually pointless for bulk jobs.
+    :type text_to_speech: boolean
+    :param ordered: Whether responses are yielded in the order of the
+        iterable, or as soon as they are ready.
+    :type ordered: boolean
+    :param stats: An optional dict filled with the ``interactions``,
+        ``failed``, ``seconds``, and ``per_second`` statistics of the batch.
+    :type stats: dict
+    :return: A generator of ``(data, response)`` tuples.
+    :rtype: Generator
+    """
+    if concurrency is None:
+        concurrency = conf['director']['workers']
+    if stats is None:
+        stats = {}
+    stats.update({'interactions': 0, 'failed': 0, 'seconds': 0.0, 'per_second': 0.0})
+    state = get_interaction_state()
+    def run(data):
+        # Returns the response and whether or not the interaction failed.
+        try:
+            return run_interaction(data, text_to_speech, state), False
+        except Exception as err: #pylint: disable=W0703
+            log.error('Batch interaction failed: %s' %err)
+            return {'output_text': None, 'output_audio': None, 'error': str(err)}, True
+    start = time.time()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    # Only a couple of interactions per thread are submitted ahead of time.
+    pending = deque()
+    try:
+        for data in iterable:
+            pending.append((executor.submit(run, data), data))
+            if len(pending) >= concurrency * 2:
+                yield next_batch_result(pending, ordered, stats)
+        while pending:
+            yield next_batch_result(pending, ordered, stats)
+    finally:
+        for future, _ in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        stats['seconds'] = time.time() - start
+        if stats['seconds'] > 0:
+            stats['per_second'] = stats['interactions'] / stats['seconds']
+        metrics.increment('director.batch_interactions', stats['interactions'])
+        metrics.increment('director.batch_interactions_failed', stats['failed'])
+        metrics.set_gauge('director.batch_throughput', stats['per_second'])
+        log.info('Batch of %s interactions (%s failed) done in %.2f seconds (%.1f per second)'
+                 %(stats['interactions'], stats['failed'], stats['seconds'], stats['per_second']))
+
+def next_batch_result(pending, ordered, stats):
+    """
+    Waits for the next interaction of a batch (see :func:`interact_many`).
+
+    :param pending: The ``(future, data)`` tuples of the submitted
+        interactions. Futures resolve to ``(response, failed)`` tuples.
+    :type pending: :class:`collections.deque`
+    :param ordered: Whether to wait for the oldest interaction, or for the
+        first one done.
+    :type ordered: boolean
+    :param stats: The statistics of the batch.
+    :type stats: dict
+    :return: A ``(data, response)`` tuple.
+    :rtype: tuple
+    """
+    if ordered:
+        future, data = pending.popleft()
+    else:
+        done, _ = wait([future for future, _ in pending], return_when=FIRST_COMPLETED)
+        for index, (future, data) in enumerate(pending):
+            if future in done:
+                del pending[index]
+                break
+    response, failed = future.result()
+    stats['interactions'] += 1
+    if failed:
+        stats['failed'] += 1
+    return data, response
+
 def get_return_data(context):
     """
     This function is used to extract appropriate data from the context object
@@ -9,6 +9,76 @@ plugin_directory = string(default='~/eva/plugins')
 config_directory = string(default='~/eva/configs')
 # The list of enabled plugins - dependencies will be handled by Eva on boot.
 enabled_plugins = force_list(default=list('web_ui_plugins', 'web_ui_updater'))
+# Reload configuration files when they change on disk (without restarting Eva).
+watch_config = boolean(default=True)
+# Seconds between configuration file checks (when inotify is unavailable).
+watch_interval = float(min=0.1, default=2.0)
+# Seconds to wait before writing saved configurations to disk, so that frequent
+# saves of the same file are written once (0 to write immediately).
+save_delay = float(min=0, default=1.0)
+
+[director]
+# The number of threads handling interactions concurrently.
+workers = integer(min=1, default=1)
+# The number of worker processes handling interactions, forked once Eva booted
+# (0 to handle interactions in the main process). Useful for CPU-heavy
+# plugins - set workers to at least this number to keep every process busy.
+processes = integer(min=0, default=0)
+# The maximum number of commands waiting to be handled. Commands received while
+# the queue is full are answered with the busy response.
+max_queue_size = integer(min=1, default=20)
+# Seconds a command may wait in the queue before being dropped with the busy
+# response. Clients may override this per command with a 'timeout' value.
+command_deadline = float(min=0, default=30.0)
+# The longest 'timeout' a client may ask for, in seconds. Invalid timeouts are
+# replaced with command_deadline.
+max_command_timeout = float(min=1, default=300.0)
+# Queue depth at which Eva skips text-to-speech to catch up (0 to disable).
+degraded_queue_size = integer(min=0, default=10)
+# The response sent to clients when their command is dropped.
+busy_response = string(default='Sorry, I am busy right now. Please try again in a moment.')
+# Seconds to wait for interactions and scheduler jobs to finish when restarting.
+drain_timeout = float(min=0, default=10.0)
+# 'broadcast' when a single Eva server handles every command, 'competing' to share
+# commands between several Eva servers (requires the mongodb pubsub backend).
+consumer_mode = option('broadcast', 'competing', default='broadcast')
+# Seconds a competing server keeps ownership of a client's commands without
+# renewing it. Leases are renewed every third of this while commands are handled.
+lease_timeout = float(min=1, default=60.0)
+
+[hooks]
+# Run the hooks of the interaction triggers under their deadline (if any), and
+# skip the plugins that keep failing (see the eva.hooks module).
+enabled = boolean(default=True)
+# Seconds a hook may run before being abandoned (0 for no deadline). Hooks with
+# a deadline run in their own thread, against copies of their arguments. Plugins
+# can override this with 'hook_timeout' in their info file.
+timeout = float(min=0, default=0.0)
+# Consecutive failures (errors or timeouts) after which a plugin's hooks are skipped.
+failure_threshold = integer(min=1, default=3)
+# Seconds a failing plugin's hooks are skipped before being tried again.
+cooldown = float(min=0, default=60.0)
+# Run the eva.interaction hooks of plugins marked 'speculative' in their info
+# file concurrently (see eva.hooks.trigger_speculative).
+speculative = boolean(default=False)
+
+[scheduler]
+# The number of threads used to run scheduler jobs.
+thread_pool_size = integer(min=1, default=10)
+# The number of processes for CPU-heavy jobs added with executor='processpool'.
+# The process pool is disabled when set to 0.
+process_pool_size = integer(min=0, default=0)
+# The default job store. Jobs in the mongodb store survive restarts but must be
+# picklable. Jobs can target the in-memory store with jobstore='memory'.
+job_store = option('memory', 'mongodb', default='memory')
+# Run a job only once when several of its runs were missed.
+coalesce = boolean(default=True)
+# Seconds after its scheduled time that a late job is still allowed to run.
+misfire_grace_time = integer(min=1, default=30)
+# The maximum number of concurrently running instances of a job.
+max_instances = integer(min=1, default=1)
+# Warn about interval jobs that run for at least this fraction of their interval.
+slow_job_ratio = float(min=0, max=1, default=0.8)
 
 [logging]
 # The namespace used for logging.
@@ -27,3 +97,58 @@ host = string(default='localhost')
 port = integer(default=27017)
 # The MongoDB database name for Eva.
 database = string(default='eva')
+
+[pubsub]
+# The transport used to exchange messages with clients. The local backend uses a
+# Unix domain socket and only works for clients running on the same machine.
+backend = option('mongodb', 'local', default='mongodb')
+# The Unix domain socket used by the local backend.
+socket_path = string(default='/tmp/eva.sock')
+
+[sessions]
+# Keep conversation state across interactions (see context.session).
+enabled = boolean(default=True)
+# The maximum number of conversation sessions kept in memory (sessions are not
+# kept in memory with worker processes).
+max_sessions = integer(min=1, default=1000)
+# Seconds before an unused session is dropped from memory (it stays in MongoDB).
+idle_timeout = float(min=0, default=600.0)
+# Seconds between writes of modified sessions to MongoDB.
+write_delay = float(min=0.1, default=5.0)
+# The number of previous turns kept in every session.
+max_turns = integer(min=0, default=20)
+# Seconds before MongoDB deletes an unused session (0 to keep sessions forever).
+expire_after = integer(min=0, default=604800)
+
+[history]
+# Record every interaction in the MongoDB history collection.
+enabled = boolean(default=True)
+# The number of interactions inserted at once.
+batch_size = integer(min=1, default=100)
+# Seconds between inserts when few interactions are waiting.
+flush_interval = float(min=0.1, default=2.0)
+# Seconds before MongoDB deletes a recorded interaction (0 to keep them forever).
+expire_after = integer(min=0, default=0)
+
+[command_log]
+# Record every command received in an append-only file, so that real workloads
+# can be replayed offline with replay.py.
+enabled = boolean(default=False)
+# The file commands are appended to.
+path = string(default='~/eva/commands.log')
+# Seconds between writes to the file.
+flush_interval = float(min=0.1, default=1.0)
+
+[audio]
+# Receive framed audio from voice clients (such as clients/headless.py with
+# --framed-audio) over UDP.
+# Do not enable while the Audio Server plugin listens on the same port.
+enabled = boolean(default=False)
+# The address to listen on for audio.
+host = string(default='0.0.0.0')
+# The UDP port to listen on for audio.
+port = integer(min=1, max=65535, default=8800)
+# The number of audio frames to wait for a missing (late or lost) frame.
+reorder_window = integer(min=0, default=8)
+# Seconds without audio frames before an utterance is considered done.
+utterance_timeout = float(min=0.1, default=1.0)
@@ -0,0 +1,372 @@
+"""
+Holds the HistoryRecorder class used to record every interaction with Eva, and
+the functions used to search the recorded history.
+"""
+
+import os
+import time
+import queue
+import atexit
+import datetime
+import threading
+from pymongo import ASCENDING, DESCENDING, TEXT, UpdateOne
+from eva.util import get_mongo_client
+from eva import conf
+from eva import log
+from eva import metrics
+
+class HistoryRecorder(object):
+    """
+    Records completed interactions in the ``history`` MongoDB collection.
+
+    Interactions are buffered in memory and inserted in bulk by a background
+    thread, every ``flush_interval`` seconds or as soon as ``batch_size``
+    interactions are waiting, so interactions never wait on MongoDB. When
+    MongoDB can't keep up and the buffer is full, new records are dropped
+    (see the ``history.records_dropped`` metric).
+
+    The collection is indexed by time, by client and time, and by month and
+    text (input and output) so that :func:`search`, :func:`first_occurrence`,
+    and :func:`last_occurrence` stay fast over years of history: MongoDB can't
+    sort text search results with an index, so text searches go through the
+    months one at a time (see :func:`find_text`), sorting a single month of
+    matches in memory.
+    """
+    def __init__(self, batch_size=100, flush_interval=2.0, expire_after=0):
+        """
+        :param batch_size: The number of interactions inserted at once.
+        :type batch_size: integer
+        :param flush_interval: Seconds between inserts when few interactions
+            are waiting.
+        :type flush_interval: float
+        :param expire_after: Seconds before MongoDB deletes an interaction (0
+            to keep interactions forever).
+        :type expire_after: integer
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.expire_after = expire_after
+        self.buffer = queue.Queue(maxsize=batch_size * 100)
+        self.lock = threading.Lock()
+        self.collection = None
+        self.pid = None
+
+    def get_collection(self):
+        """
+        Gets the ``history`` collection, reconnecting (and restarting the
+        writer thread) in forked worker processes.
+
+        :return: The MongoDB collection holding the interaction history.
+        :rtype: `pymongo.collection.Collection <http://api.mongodb.com/python/current/api/pymongo/collection.html>`_
+        """
+        with self.lock:
+            if self.collection is None or self.pid != os.getpid():
+                self.connect()
+        return self.collection
+
+    def connect(self):
+        """
+        Connects to MongoDB, creates the history indexes, and starts the writer
+        thread.
+        """
+        collection = get_history_collection()
+        collection.create_index([('time', DESCENDING)])
+        collection.create_index([('client_id', ASCENDING), ('time', DESCENDING)])
+        # Only one text index is allowed per collection.
+        for name, index in collection.index_information().items():
+            if name != TEXT_INDEX and any(TEXT in (key, kind) for key, kind in index['key']):
+                collection.drop_index(name)
+        collection.create_index([('period', ASCENDING), ('input_text', TEXT), ('output_text', TEXT)],
+                                weights={'input_text': 2, 'output_text': 1},
+                                name=TEXT_INDEX)
+        if self.expire_after > 0:
+            collection.create_index('expires', expireAfterSeconds=0)
+        self.collection = collection
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def record(self, context, return_data):
+        """
+        Buffers a completed interaction.
+
+        :param context: The context object of the interaction.
+        :type context: :class:`eva.context.EvaContext`
+        :param return_data: The data sent back to the client (see
+            :func:`eva.director.get_return_data`).
+        :type return_data: dict
+        """
+        try:
+            self.get_collection()
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not connect to the interaction history: %s' %err)
+            return
+        now = datetime.datetime.utcnow()
+        document = {'time': now,
+                    'period': get_period(now),
+                    'client_id': context.client_id,
+                    'request_id': context.request_id,
+                    'input_text': context.get_input_text(),
+                    'input_audio': context.get_input_audio() is not None,
+                    'output_text': return_data.get('output_text'),
+                    'output_audio': return_data.get('output_audio') is not None}
+        if self.expire_after > 0:
+            document['expires'] = now + datetime.timedelta(seconds=self.expire_after)
+        try:
+            self.buffer.put_nowait(document)
+        except queue.Full:
+            metrics.increment('history.records_dropped')
+
+    def run(self):
+        """
+        The writer loop. Inserts buffered interactions in batches.
+        """
+        pid = os.getpid()
+        self.add_periods()
+        while self.pid == pid:
+            documents = []
+            deadline = time.time() + self.flush_interval
+            while len(documents) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    documents.append(self.buffer.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.write(documents)
+
+    def add_periods(self, batch_size=1000):
+        """
+        Adds the ``period`` field (see :func:`get_period`) to the interactions
+        recorded before it existed, so that text searches find them.
+
+        :param batch_size: The number of interactions updated at once.
+        :type batch_size: integer
+        """
+        try:
+            while True:
+                documents = list(self.collection.find({'period': {'$exists': False}},
+                                                      {'time': True}).limit(batch_size))
+                if not documents:
+                    return
+                self.collection.bulk_write([UpdateOne({'_id': document['_id']},
+                                                      {'$set': {'period': get_period(document['time'])}})
+                                            for document in documents], ordered=False)
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not add periods to the interaction history: %s' %err)
+
+    def flush(self):
+        """
+        Inserts every buffered interaction immediately.
+        """
+        documents = []
+        while True:
+            try:
+                documents.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+        self.write(documents)
+
+    def write(self, documents):
+        """
+        Inserts interactions with a single bulk insert, logging any error.
+
+        :param documents: The interactions to insert.
+        :type documents: list
+        """
+        if not documents or self.collection is None:
+            return
+        try:
+            self.collection.insert_many(documents, ordered=False)
+            metrics.increment('history.records_written', len(documents))
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not record %s interactions: %s' %(len(documents), err))
+
+#: The name of the text index of the ``history`` collection.
+TEXT_INDEX = 'history_text'
+
+#: The history recorder used by :func:`eva.director.interact` (see :func:`get_history_recorder`).
+HISTORY_RECORDER = None
+
+def get_history_recorder():
+    """
+    Gets the history recorder, creating it from the ``[history]`` configuration
+    section on first use.
+
+    :return: The history recorder.
+    :rtype: :class:`HistoryRecorder`
+    """
+    global HISTORY_RECORDER #pylint: disable=W0603
+    if HISTORY_RECORDER is None:
+        HISTORY_RECORDER = HistoryRecorder(conf['history']['batch_size'],
+                                           conf['history']['flush_interval'],
+                                           conf['history']['expire_after'])
+        atexit.register(HISTORY_RECORDER.flush)
+    return HISTORY_RECORDER
+
+def get_history_collection():
+    """
+    :return: The MongoDB collection holding the interaction history.
+    :rtype: `pymongo.collection.Collection <http://api.mongodb.com/python/current/api/pymongo/collection.html>`_
+    """
+    return get_mongo_client()[conf['mongodb']['database']]['history']
+
+def get_history_query(text=None, client_id=None, since=None, until=None):
+    """
+    Builds the MongoDB query used by the history search functions.
+
+    :param text: Words to look for in the input or output text (MongoDB
+        `text search <https://docs.mongodb.com/manual/reference/operator/query/text/>`_
+        syntax: phrases in double quotes, words to exclude prefixed with ``-``).
+    :type text: string
+    :param client_id: Only match interactions with this client.
+    :type client_id: string
+    :param since: Only match interactions at or after this time (UTC).
+    :type since: datetime.datetime
+    :param until: Only match interactions before this time (UTC).
+    :type until: datetime.datetime
+    :return: The MongoDB query.
+    :rtype: dict
+    """
+    query = {}
+    if text:
+        query['$text'] = {'$search': text}
+    if client_id is not None:
+        query['client_id'] = client_id
+    if since is not None or until is not None:
+        query['time'] = {}
+        if since is not None:
+            query['time']['$gte'] = since
+        if until is not None:
+            query['time']['$lt'] = until
+    return query
+
+def search(text=None, client_id=None, since=None, until=None, limit=10):
+    """
+    Searches the recorded interactions, most recent first.
+
+    Interactions are recorded in the background, so the last few seconds of
+    interactions may not be found yet.
+
+    :param text: Words to look for (see :func:`get_history_query`).
+    :type text: string
+    :param client_id: Only match interactions with this client.
+    :type client_id: string
+    :param since: Only match interactions at or after this time (UTC).
+    :type since: datetime.datetime
+    :param until: Only match interactions before this time (UTC).
+    :type until: datetime.datetime
+    :param limit: The maximum number of interactions returned.
+    :type limit: integer
+    :return: The matching interactions (dicts with ``time``, ``client_id``,
+        ``input_text``, and ``output_text`` keys among others).
+    :rtype: list
+    """
+    query = get_history_query(text, client_id, since, until)
+    if text:
+        return find_text(query, DESCENDING, limit)
+    cursor = get_history_recorder().get_collection().find(query, {'_id': False})
+    return list(cursor.sort('time', DESCENDING).limit(limit))
+
+def first_occurrence(text, client_id=None):
+    """
+    Finds the first interaction mentioning some words. Answers questions like
+    "When did I first ask you about the weather?".
+
+    :param text: Words to look for (see :func:`get_history_query`).
+    :type text: string
+    :param client_id: Only match interactions with this client.
+    :type client_id: string
+    :return: The first matching interaction, or ``None``.
+    :rtype: dict
+    """
+    matches = find_text(get_history_query(text, client_id), ASCENDING, 1)
+    return matches[0] if matches else None
+
+def last_occurrence(text, client_id=None):
+    """
+    Finds the most recent interaction mentioning some words. Answers questions
+    like "When did I last ask you about the weather?".
+
+    :param text: Words to look for (see :func:`get_history_query`).
+    :type text: string
+    :param client_id: Only match interactions with this client.
+    :type client_id: string
+    :return: The most recent matching interaction, or ``None``.
+    :rtype: dict
+    """
+    matches = find_text(get_history_query(text, client_id), DESCENDING, 1)
+    return matches[0] if matches else None
+
+def find_text(query, direction, limit):
+    """
+    Runs a text search, sorted by time, one month at a time (newest or oldest
+    first) until ``limit`` interactions are found. Every query matches the
+    ``period`` prefix of the text index, so MongoDB only sorts a single month
+    of matches in memory instead of every match in the history.
+
+    :param query: The query (see :func:`get_history_query`).
+    :type query: dict
+    :param direction: ``pymongo.ASCENDING`` (oldest first) or
+        ``pymongo.DESCENDING`` (newest first).
+    :type direction: integer
+    :param limit: The maximum number of interactions returned.
+    :type limit: integer
+    :return: The matching interactions.
+    :rtype: list
+    """
+    collection = get_history_recorder().get_collection()
+    matches = []
+    for period in get_periods(collection, query, direction):
+        cursor = collection.find(dict(query, period=period), {'_id': False})
+        matches.extend(cursor.sort('time', direction).limit(limit - len(matches)))
+        if len(matches) >= limit:
+            break
+    return matches
+
+def get_periods(collection, query, direction):
+    """
+    Lists the months to search, from the time range of the query (or the
+    oldest and newest recorded interactions, found with the time indexes).
+
+    :param collection: The ``history`` collection.
+    :param query: The query (see :func:`get_history_query`).
+    :type query: dict
+    :param direction: The order of the months (see :func:`find_text`).
+    :type direction: integer
+    :return: The months (see :func:`get_period`).
+    :rtype: list
+    """
+    bounds = {}
+    if 'client_id' in query:
+        bounds['client_id'] = query['client_id']
+    time_range = query.get('time', {})
+    first = time_range.get('$gte')
+    if first is None:
+        oldest = collection.find_one(bounds, {'time': True}, sort=[('time', ASCENDING)])
+        first = oldest['time'] if oldest is not None else None
+    last = time_range.get('$lt')
+    if last is None:
+        newest = collection.find_one(bounds, {'time': True}, sort=[('time', DESCENDING)])
+        last = newest['time'] if newest is not None else None
+    if first is None or last is None or first > last:
+        return []
+    periods = []
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        periods.append(year * 100 + month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    if direction == DESCENDING:
+        periods.reverse()
+    return periods
+
+def get_period(when):
+    """
+    :param when: The time of an interaction (UTC).
+    :type when: datetime.datetime
+    :return: The month of the interaction, as ``YYYYMM`` (the ``period``
+        field of recorded interactions, which prefixes the text index).
+    :rtype: integer
+    """
+    return when.year * 100 + when.month
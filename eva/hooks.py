@@ -0,0 +1,542 @@
+"""
+Holds the functions used to fire the interaction triggers with a deadline and a
+circuit breaker per plugin, so that a single misbehaving plugin can't stall
+every interaction.
+
+Hooks are still called by ``gossip.trigger`` (muted hooks, deferred hooks,
+reentrancy, and the exception policy of the hook group all apply as usual):
+the function of every registration of a guarded trigger is wrapped once in a
+:class:`GuardedHook`.
+
+Plugins can give their hooks a deadline (the ``hook_timeout`` of the plugin's
+info file, or the ``timeout`` of the ``[hooks]`` configuration section - none
+by default). A hook with a deadline runs in its own thread against copies of
+its arguments (see :class:`Sandbox`), and is abandoned when it doesn't return
+in time. Python threads can't be killed, so an abandoned hook keeps running in
+the background until it returns, but its changes are thrown away. The changes
+of hooks that return in time are merged into the actual arguments.
+
+Plugins whose hooks fail (raise or time out) ``failure_threshold`` times in a
+row are skipped for ``cooldown`` seconds (see :class:`CircuitBreaker`). The
+``hooks.<plugin>.timeouts``, ``hooks.<plugin>.failures``,
+``hooks.<plugin>.skipped`` metrics and the ``hooks.<plugin>.breaker_open``
+gauge are recorded for every plugin.
+"""
+
+import copy
+import time
+import functools
+import threading
+import gossip
+from gossip.exceptions import HookNotFound, NotNowException
+from eva.config import get_snapshot
+from eva.context import EvaContext
+from eva.session import Session
+from eva.util import is_changed
+from eva import conf
+from eva import log
+from eva import metrics
+
+class HookTimeout(Exception):
+    """
+    Raised (internally) when a hook does not return before its deadline.
+    """
+    pass
+
+class CircuitBreaker(object):
+    """
+    Tracks the consecutive failures of a plugin's hooks.
+
+    The breaker opens after ``failure_threshold`` consecutive failures: the
+    plugin's hooks are skipped until ``cooldown`` seconds have passed. A single
+    trial call is then allowed - the breaker closes if it succeeds, and opens
+    again otherwise.
+    """
+    def __init__(self, name, failure_threshold=3, cooldown=60.0):
+        """
+        :param name: The name of the plugin (used in metrics).
+        :type name: string
+        :param failure_threshold: Consecutive failures that open the breaker.
+        :type failure_threshold: integer
+        :param cooldown: Seconds the breaker stays open.
+        :type cooldown: float
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        """
+        :return: Whether or not the plugin's hook should be called.
+        :rtype: boolean
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.time() - self.opened_at < self.cooldown:
+                return False
+            # Half-open: let a single call through.
+            self.trial = True
+            return True
+
+    def succeeded(self):
+        """
+        Records a successful call, closing the breaker.
+        """
+        with self.lock:
+            self.failures = 0
+            self.trial = False
+            if self.opened_at is not None:
+                log.info('Circuit breaker closed for %s' %self.name)
+                self.opened_at = None
+                metrics.set_gauge('hooks.%s.breaker_open' %self.name, 0)
+
+    def failed(self):
+        """
+        Records a failed call, opening the breaker when needed.
+        """
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    log.warning('Circuit breaker opened for %s - skipping its hooks for %s seconds'
+                                %(self.name, self.cooldown))
+                self.opened_at = time.time()
+                self.trial = False
+                metrics.set_gauge('hooks.%s.breaker_open' %self.name, 1)
+
+    def cancelled(self):
+        """
+        Records a call that deferred itself (see ``gossip.exceptions.NotNowException``),
+        which is neither a success nor a failure.
+        """
+        with self.lock:
+            self.trial = False
+
+    def is_open(self):
+        """
+        :return: Whether or not the plugin's hooks are currently skipped.
+        :rtype: boolean
+        """
+        with self.lock:
+            return self.opened_at is not None
+
+#: The circuit breaker of every plugin (see :func:`get_breaker`).
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+def get_breaker(plugin_id):
+    """
+    Gets the circuit breaker of a plugin, creating it from the ``[hooks]``
+    configuration section on first use.
+
+    :param plugin_id: The plugin ID (or module name for hooks that don't
+        belong to a plugin).
+    :type plugin_id: string
+    :return: The circuit breaker.
+    :rtype: :class:`CircuitBreaker`
+    """
+    with BREAKERS_LOCK:
+        if plugin_id not in BREAKERS:
+            BREAKERS[plugin_id] = CircuitBreaker(plugin_id,
+                                                 conf['hooks']['failure_threshold'],
+                                                 conf['hooks']['cooldown'])
+        return BREAKERS[plugin_id]
+
+def get_hook_plugin(registration):
+    """
+    :param registration: The gossip registration of a hook.
+    :return: The ID of the plugin the hook belongs to (plugins are imported
+        under their ID), or the name of its module.
+    :rtype: string
+    """
+    return getattr(registration.func, '__module__', None) or 'unknown'
+
+def get_hook_timeout(plugin_id):
+    """
+    Gets the deadline of a plugin's hooks: the ``hook_timeout`` of its info
+    file, or the ``timeout`` of the ``[hooks]`` configuration section.
+
+    :param plugin_id: The plugin ID.
+    :type plugin_id: string
+    :return: The deadline in seconds (0 for none).
+    :rtype: float
+    """
+    config = get_snapshot()
+    plugin = config.get('plugins', {}).get(plugin_id)
+    if plugin is not None:
+        timeout = plugin['info'].get('hook_timeout', -1)
+        if timeout >= 0:
+            return timeout
+    return config.hooks['timeout']
+
+def get_registrations(hook_name):
+    """
+    :param hook_name: The name of the trigger.
+    :type hook_name: string
+    :return: The active registrations of the trigger, in gossip registration order.
+    :rtype: list
+    """
+    try:
+        hook = gossip.get_hook(hook_name)
+    except HookNotFound:
+        return []
+    return [registration for registration in hook.get_registrations()
+            if registration.is_active()]
+
+#: Held while wrapping registrations (see :func:`guard_registrations`).
+GUARD_LOCK = threading.Lock()
+
+def guard_registrations(hook_name):
+    """
+    Wraps the function of every registration of a trigger in a
+    :class:`GuardedHook` (registrations are only wrapped once).
+
+    :param hook_name: The name of the trigger.
+    :type hook_name: string
+    :return: The active registrations of the trigger, in gossip registration order.
+    :rtype: list
+    """
+    registrations = get_registrations(hook_name)
+    with GUARD_LOCK:
+        for registration in registrations:
+            if not isinstance(registration.func, GuardedHook):
+                registration.func = GuardedHook(hook_name, registration.func)
+    return registrations
+
+class GuardedHook(object):
+    """
+    The function of a gossip registration, called under its plugin's deadline
+    and circuit breaker when the ``[hooks]`` guard is enabled (see
+    :func:`call_guarded`).
+    """
+    def __init__(self, hook_name, func):
+        """
+        :param hook_name: The name of the trigger.
+        :type hook_name: string
+        :param func: The function registered by the plugin.
+        :type func: function
+        """
+        functools.update_wrapper(self, func)
+        self.hook_name = hook_name
+        self.func = func
+        self.plugin_id = getattr(func, '__module__', None) or 'unknown'
+
+    def __call__(self, **kwargs):
+        speculation = get_speculation(self, kwargs)
+        if speculation is not None:
+            speculation.resolve(kwargs['context'])
+        else:
+            self.call(kwargs)
+
+    def call(self, kwargs):
+        """
+        Calls the function, under its deadline and circuit breaker when the
+        guard is enabled.
+
+        :param kwargs: The arguments of the hook.
+        :type kwargs: dict
+        :return: Whether or not the hook ran to completion (``False`` if it was
+            skipped or abandoned).
+        :rtype: boolean
+        """
+        if not get_snapshot().hooks['enabled']:
+            self.func(**kwargs)
+            return True
+        return call_guarded(self.hook_name, self.plugin_id, self.func, kwargs)
+
+def trigger(hook_name, **kwargs):
+    """
+    Fires a trigger like ``gossip.trigger``, calling every hook under its
+    plugin's deadline and circuit breaker (see :class:`GuardedHook`).
+    Exceptions raised by hooks are handled by gossip (after being counted as
+    failures), while hooks that time out are abandoned for this call.
+
+    :param hook_name: The name of the trigger.
+    :type hook_name: string
+    :param kwargs: The arguments passed to the hooks.
+    """
+    guard_registrations(hook_name)
+    gossip.trigger(hook_name, **kwargs)
+
+def is_speculative(registration):
+    """
+    :param registration: The gossip registration of a hook.
+    :return: Whether or not the hook's plugin is marked ``speculative`` in its
+        info file.
+    :rtype: boolean
+    """
+    plugin = get_snapshot().get('plugins', {}).get(get_hook_plugin(registration))
+    return plugin is not None and plugin['info'].get('speculative', False)
+
+#: The speculations of the trigger being fired by the current thread (see
+#: :func:`trigger_speculative`).
+SPECULATIONS = threading.local()
+
+def get_speculation(hook, kwargs):
+    """
+    :param hook: The hook being called.
+    :type hook: :class:`GuardedHook`
+    :param kwargs: The arguments of the hook.
+    :type kwargs: dict
+    :return: The speculation already running the hook with these arguments
+        (in the current thread's :func:`trigger_speculative` call), if any.
+    :rtype: :class:`Speculation`
+    """
+    speculation = getattr(SPECULATIONS, 'active', {}).get(hook)
+    if speculation is not None and kwargs.get('context') is speculation.original:
+        return speculation
+    return None
+
+def trigger_speculative(hook_name, context):
+    """
+    Fires a trigger that takes a context (such as ``eva.interaction``),
+    running the hooks of speculative plugins (see :func:`is_speculative`)
+    concurrently instead of one after the other.
+
+    Every speculative hook starts right away against its own copy of the
+    context and session (see :class:`Speculation`). The trigger is then fired
+    with ``gossip.trigger`` as usual: the other hooks run in gossip
+    registration order against the context, and when its turn comes, a
+    speculative hook's changes are applied to the context and session - unless
+    a plugin already responded, in which case they are thrown away (without
+    waiting for the hook). The first plugin to respond in gossip registration
+    order wins, as it would without speculation, while the trigger only takes
+    as long as its slowest useful hook.
+
+    Speculative hooks don't see the changes made by the hooks registered
+    before them, so only plugins that don't depend on them should be marked
+    speculative.
+
+    :param hook_name: The name of the trigger.
+    :type hook_name: string
+    :param context: The context object of the interaction.
+    :type context: :class:`eva.context.EvaContext`
+    """
+    speculations = {}
+    for registration in guard_registrations(hook_name):
+        if is_speculative(registration):
+            speculations[registration.func] = Speculation(registration.func, context)
+    previous = getattr(SPECULATIONS, 'active', {})
+    SPECULATIONS.active = speculations
+    try:
+        gossip.trigger(hook_name, context=context)
+    finally:
+        SPECULATIONS.active = previous
+
+class Speculation(object):
+    """
+    A speculative hook running in its own (daemon) thread against a deep copy
+    of the context, including its session (see :class:`Sandbox`).
+    """
+    def __init__(self, hook, context):
+        """
+        :param hook: The hook.
+        :type hook: :class:`GuardedHook`
+        :param context: The context object of the interaction.
+        :type context: :class:`eva.context.EvaContext`
+        """
+        self.original = context
+        self.sandbox = Sandbox({'context': context})
+        self.context = self.sandbox.kwargs['context']
+        self.completed = False
+        self.error = None
+        self.done = threading.Event()
+        thread = threading.Thread(target=self.run, args=(hook,), daemon=True)
+        thread.start()
+
+    def run(self, hook):
+        """
+        Runs the hook (under its deadline and circuit breaker when the hooks
+        guard is enabled).
+        """
+        try:
+            self.completed = hook.call({'context': self.context})
+        except Exception as err: #pylint: disable=W0703
+            self.error = err
+        finally:
+            self.done.set()
+
+    def resolve(self, context):
+        """
+        Called when the hook's turn comes in gossip registration order: ignores the
+        speculation if a plugin already responded, and applies it otherwise
+        (see :func:`apply`).
+
+        :param context: The context object of the interaction.
+        :type context: :class:`eva.context.EvaContext`
+        """
+        if context.responded:
+            metrics.increment('hooks.speculative_ignored')
+        else:
+            self.apply(context)
+
+    def apply(self, context):
+        """
+        Waits for the hook to finish, then applies the changes it made to its
+        copy of the context and session (see :func:`Sandbox.merge`), including
+        the changes made in place. Nothing is applied if the hook was skipped or
+        abandoned, and errors raised by the hook are raised again.
+
+        :param context: The context object of the interaction (the one the
+            speculation was started with).
+        :type context: :class:`eva.context.EvaContext`
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        if not self.completed:
+            return
+        self.sandbox.merge()
+
+def call_guarded(hook_name, plugin_id, func, kwargs):
+    """
+    Calls a single hook under its plugin's deadline and circuit breaker.
+
+    :param hook_name: The name of the trigger.
+    :type hook_name: string
+    :param plugin_id: The plugin the hook belongs to.
+    :type plugin_id: string
+    :param func: The function registered by the plugin.
+    :type func: function
+    :param kwargs: The arguments passed to the hook.
+    :type kwargs: dict
+    :return: Whether or not the hook ran to completion (``False`` if it was
+        skipped or abandoned).
+    :rtype: boolean
+    """
+    breaker = get_breaker(plugin_id)
+    if not breaker.allow():
+        metrics.increment('hooks.%s.skipped' %plugin_id)
+        return False
+    try:
+        call_with_deadline(func, kwargs, get_hook_timeout(plugin_id))
+    except HookTimeout:
+        log.warning('%s hook of %s timed out - abandoning it' %(hook_name, plugin_id))
+        metrics.increment('hooks.%s.timeouts' %plugin_id)
+        breaker.failed()
+        return False
+    except NotNowException:
+        breaker.cancelled()
+        raise
+    except Exception:
+        metrics.increment('hooks.%s.failures' %plugin_id)
+        breaker.failed()
+        raise
+    breaker.succeeded()
+    return True
+
+def call_with_deadline(function, kwargs, timeout):
+    """
+    Calls a function in a separate (daemon) thread, against copies of its
+    arguments (see :class:`Sandbox`), and waits for it to return. The changes
+    made to the copies are merged into the arguments if the function returned
+    (or raised) in time, and thrown away otherwise.
+
+    :param function: The function to call.
+    :type function: function
+    :param kwargs: The arguments of the function.
+    :type kwargs: dict
+    :param timeout: Seconds to wait (0 to call the function directly).
+    :type timeout: float
+    :return: The return value of the function.
+    :raises HookTimeout: If the function did not return in time.
+    """
+    if timeout <= 0:
+        return function(**kwargs)
+    sandbox = Sandbox(kwargs)
+    outcome = {}
+    def run():
+        try:
+            outcome['result'] = function(**sandbox.kwargs)
+        except BaseException as err: #pylint: disable=W0703
+            outcome['error'] = err
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise HookTimeout()
+    sandbox.merge()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome.get('result')
+
+class Sandbox(object):
+    """
+    Copies of the arguments of a hook, so that a hook that may be abandoned
+    never changes the actual arguments. Contexts (including their session) and
+    dicts are copied deeply, other arguments are passed as is.
+
+    The changes made to the copies are applied to the arguments with
+    :func:`merge`. Only the values that differ from an untouched copy are
+    written (changes made in place are detected as well), so changes made to
+    the arguments in the meantime are kept. Values are compared one attribute
+    (or key) at a time: when two copies changed the same value, the last one
+    merged wins.
+    """
+    def __init__(self, kwargs):
+        """
+        :param kwargs: The arguments of the hook.
+        :type kwargs: dict
+        """
+        self.originals = kwargs
+        self.snapshots = {name: copy_argument(value) for name, value in kwargs.items()}
+        #: The copies passed to the hook.
+        self.kwargs = {name: copy_argument(value) for name, value in kwargs.items()}
+
+    def merge(self):
+        """
+        Applies the changes made to the copies onto the arguments.
+        """
+        for name, original in self.originals.items():
+            merge_argument(original, self.snapshots[name], self.kwargs[name])
+
+def copy_argument(value):
+    """
+    :param value: The argument of a hook.
+    :return: A deep copy of the argument (see :class:`Sandbox`), or the
+        argument itself if it can't be copied.
+    """
+    if isinstance(value, EvaContext):
+        clone = copy.copy(value)
+        for name, attribute in vars(value).items():
+            setattr(clone, name, copy_argument(attribute))
+        return clone
+    if isinstance(value, Session):
+        return value.copy()
+    try:
+        return copy.deepcopy(value)
+    except Exception: #pylint: disable=W0703
+        return value
+
+def merge_argument(original, snapshot, working):
+    """
+    Applies the changes made to the copy of a hook argument (see
+    :class:`Sandbox`).
+
+    :param original: The argument.
+    :param snapshot: An untouched copy of the argument.
+    :param working: The copy passed to the hook.
+    """
+    if isinstance(original, EvaContext):
+        before = vars(snapshot)
+        for name, value in vars(working).items():
+            current = getattr(original, name, None)
+            if isinstance(current, Session) and isinstance(value, Session) and \
+               current.session_id == value.session_id:
+                current.merge(before[name], value)
+            elif name not in before or is_changed(before[name], value):
+                setattr(original, name, value)
+    elif isinstance(original, Session):
+        original.merge(snapshot, working)
+    elif isinstance(original, dict):
+        for key, value in working.items():
+            if key not in snapshot or is_changed(snapshot[key], value):
+                original[key] = value
+        for key in snapshot:
+            if key not in working:
+                original.pop(key, None)
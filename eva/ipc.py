@@ -0,0 +1,175 @@
+"""
+Holds the local pubsub transport used when Eva and its clients share a machine.
+
+Messages are exchanged as BSON documents over a Unix domain socket instead of
+being written to (and tailed from) the MongoDB ``communications`` collection.
+A single :class:`LocalBroker` (started by :func:`eva.director.serve`) relays
+published messages to every subscriber of the matching channel.
+
+The client side (:class:`eva.local_pubsub.LocalPubSub`, also importable from
+here) exposes the same ``publish``/``subscribe`` interface as the
+`anypubsub <https://github.com/smarzola/anypubsub>`_ backends.
+"""
+
+import os
+import socket
+import threading
+from bson import BSON
+from eva import log
+from eva.local_pubsub import FrameError, FrameReader, LocalSubscriber, LocalPubSub, decode_frame #pylint: disable=W0611
+
+class LocalBroker(object):
+    """
+    Relays published messages to the subscribers of a channel.
+
+    Every connection starts by sending either ``subscribe`` documents (after
+    which it only receives messages and the ``subscribed`` acknowledgment of
+    every subscription) or any number of ``publish`` documents.
+
+    Subscribers that stop reading for longer than ``send_timeout`` seconds are
+    disconnected so that they can't stall every publisher.
+    """
+    def __init__(self, path, send_timeout=5.0):
+        """
+        :param path: The Unix domain socket path to listen on.
+        :type path: string
+        :param send_timeout: Seconds to wait on a full subscriber socket.
+        :type send_timeout: float
+        """
+        self.path = path
+        self.send_timeout = send_timeout
+        self.subscribers = {}
+        self.send_locks = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def bind(self):
+        """
+        Binds the Unix domain socket without accepting connections yet
+        (connections are queued until :func:`start` is called). A stale socket
+        file left behind by a previous broker is removed.
+        """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                probe.close()
+                raise RuntimeError('A pubsub broker is already listening on %s' %self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(64)
+
+    def start(self):
+        """
+        Binds the Unix domain socket (unless :func:`bind` was called already)
+        and starts accepting connections in a background thread.
+        """
+        if self.server is None:
+            self.bind()
+        thread = threading.Thread(target=self.accept_connections, daemon=True)
+        thread.start()
+        log.info('Local pubsub broker listening on %s' %self.path)
+
+    def accept_connections(self):
+        """
+        Accepts client connections and hands each one to its own thread.
+        """
+        while True:
+            conn, _ = self.server.accept()
+            thread = threading.Thread(target=self.handle_connection, args=(conn,), daemon=True)
+            thread.start()
+
+    def handle_connection(self, conn):
+        """
+        Reads documents from a single connection until it is closed.
+
+        Connections that send an invalid frame or an unknown document are
+        dropped (with a warning) - the stream can't be trusted after that.
+
+        :param conn: The accepted client connection.
+        :type conn: :class:`socket.socket`
+        """
+        reader = FrameReader(conn)
+        try:
+            while True:
+                raw = reader.read_raw()
+                if raw is None:
+                    continue
+                document = decode_frame(raw)
+                operation = document.get('op')
+                channels = document.get('channels')
+                channel = document.get('channel')
+                if operation == 'subscribe' and isinstance(channels, list) and \
+                   all(isinstance(name, str) for name in channels):
+                    self.add_subscriber(conn, channels)
+                elif operation == 'publish' and isinstance(channel, str):
+                    self.relay(channel, raw)
+                else:
+                    log.warning('Dropping local pubsub connection: malformed %s document'
+                                %(operation or 'unknown'))
+                    break
+        except FrameError as err:
+            log.warning('Dropping local pubsub connection: %s' %err)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.remove_subscriber(conn)
+            conn.close()
+
+    def add_subscriber(self, conn, channels):
+        """
+        Registers a connection as a subscriber of the given channels, then
+        acknowledges the subscription with a ``subscribed`` document (every
+        message published after that is relayed to the connection).
+        """
+        conn.settimeout(self.send_timeout)
+        with self.lock:
+            send_lock = self.send_locks.setdefault(conn, threading.Lock())
+            for channel in channels:
+                self.subscribers.setdefault(channel, set()).add(conn)
+        with send_lock:
+            conn.sendall(BSON.encode({'op': 'subscribed', 'channels': channels}))
+
+    def remove_subscriber(self, conn):
+        """
+        Removes a connection from every channel it subscribed to.
+        """
+        with self.lock:
+            self.send_locks.pop(conn, None)
+            for subscribers in self.subscribers.values():
+                subscribers.discard(conn)
+
+    def relay(self, channel, raw):
+        """
+        Forwards an encoded ``publish`` document to all subscribers of a channel.
+        Subscribers that can no longer be written to are dropped.
+
+        :param channel: The channel the message was published on.
+        :type channel: string
+        :param raw: The encoded ``publish`` document.
+        :type raw: bytes
+        """
+        with self.lock:
+            targets = [(conn, self.send_locks[conn]) for conn in self.subscribers.get(channel, ())]
+        for conn, send_lock in targets:
+            try:
+                with send_lock:
+                    conn.sendall(raw)
+            except OSError:
+                self.remove_subscriber(conn)
+
+def start_broker(path):
+    """
+    Starts the local pubsub broker. Used by :func:`eva.director.serve` when the
+    ``local`` pubsub backend is configured.
+
+    :param path: The Unix domain socket path to listen on.
+    :type path: string
+    :return: The running broker.
+    :rtype: :class:`LocalBroker`
+    """
+    broker = LocalBroker(path)
+    broker.start()
+    return broker
@@ -0,0 +1,322 @@
+"""
+Client side of Eva's local pubsub transport (see :mod:`eva.ipc` for the
+broker).
+
+Clients running on the same machine as the Eva server can use this instead of
+tailing the MongoDB ``communications`` collection. This module only depends on
+the ``bson`` module that ships with pymongo, so that clients can use it without
+installing Eva itself (``clients/local_pubsub.py`` is a link to this file)::
+
+    from local_pubsub import LocalPubSub
+    pubsub = LocalPubSub('/tmp/eva.sock')
+    pubsub.publish('eva_commands', {'input_text': 'hello'})
+
+The Eva server must be configured with ``backend = local`` in its ``[pubsub]``
+configuration section.
+"""
+
+import os
+import socket
+import time
+import struct
+import threading
+import collections
+from bson import BSON
+from bson.errors import InvalidBSON
+
+#: The size of the smallest valid BSON document (an empty one).
+MIN_FRAME_SIZE = 5
+
+#: The size of the largest document accepted (the BSON/MongoDB limit).
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+class FrameError(ConnectionError):
+    """
+    Raised when the other end sent data that can't be a BSON document. The
+    stream can't be resynchronized after that, so the connection must be
+    dropped.
+    """
+    pass
+
+class FrameReader(object):
+    """
+    Buffers data read from a socket and splits it into BSON documents.
+
+    Every BSON document starts with its own little-endian int32 length, so no
+    additional framing is required on the wire. Partial documents are kept
+    in the buffer across socket timeouts.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def read_raw(self):
+        """
+        Reads the next raw BSON document from the socket.
+
+        :return: The raw document bytes, or ``None`` if the socket timed out
+            before a full document was received.
+        :rtype: bytes
+        :raises ConnectionError: If the other end closed the connection.
+        :raises FrameError: If the other end sent a length that can't be a
+            BSON document.
+        """
+        while True:
+            if len(self.buffer) >= 4:
+                length = struct.unpack('<i', self.buffer[:4])[0]
+                if length < MIN_FRAME_SIZE or length > MAX_FRAME_SIZE:
+                    raise FrameError('Invalid frame length: %s' %length)
+                if len(self.buffer) >= length:
+                    raw = bytes(self.buffer[:length])
+                    del self.buffer[:length]
+                    return raw
+            try:
+                chunk = self.sock.recv(65536)
+            except socket.timeout:
+                return None
+            if not chunk:
+                raise ConnectionError('Connection closed by peer')
+            self.buffer.extend(chunk)
+
+    def read(self):
+        """
+        Same as :func:`read_raw` but returns the decoded document.
+
+        :return: The decoded document, or ``None`` on timeout.
+        :rtype: dict
+        :raises FrameError: If the document is not valid BSON.
+        """
+        raw = self.read_raw()
+        if raw is None:
+            return None
+        return decode_frame(raw)
+
+def decode_frame(raw):
+    """
+    Decodes a raw BSON document read by a :class:`FrameReader`.
+
+    :param raw: The raw document bytes.
+    :type raw: bytes
+    :return: The decoded document.
+    :rtype: dict
+    :raises FrameError: If the document is not valid BSON.
+    """
+    try:
+        return BSON(raw).decode()
+    except InvalidBSON as err:
+        raise FrameError('Invalid BSON document: %s' %err)
+
+class LocalSubscriber(object):
+    """
+    Iterable subscriber returned by :func:`LocalPubSub.subscribe`.
+
+    Yields ``None`` whenever no message arrived within ``timeout`` seconds (or
+    while the broker is unreachable), mirroring the behaviour that Eva's
+    consumer loops already expect from the MongoDB backend.
+
+    The broker acknowledges every subscription: :func:`connect` returns once
+    the initial channels are live, and channels added later with
+    :func:`add_channels` come with an event set when they are.
+    """
+    def __init__(self, path, channels, timeout=1.0):
+        self.path = path
+        self.channels = list(channels)
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+        # Messages received while waiting for the broker's acknowledgment.
+        self.backlog = collections.deque()
+        # Channels the broker confirmed on the current connection.
+        self.confirmed = set()
+        # (channels, event) tuples waiting for the broker's acknowledgment.
+        self.waiting = []
+
+    def __iter__(self):
+        return self
+
+    def connect(self):
+        """
+        Connects to the broker, registers interest in our channels and waits
+        for the broker to acknowledge them.
+
+        :raises OSError: If the broker could not be reached or did not
+            acknowledge the subscription within ``timeout`` seconds.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        with self.lock:
+            # Channels added from now on are sent on the new connection.
+            sock.connect(self.path)
+            sock.sendall(BSON.encode({'op': 'subscribe', 'channels': self.channels}))
+            self.sock = sock
+            self.reader = FrameReader(sock)
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            document = self.reader.read()
+            if document is None:
+                continue
+            if document.get('op') == 'subscribed':
+                self.acknowledge(document.get('channels', []))
+                return
+            self.backlog.append((document.get('channel'), document.get('message')))
+        raise OSError('The broker did not acknowledge the subscription')
+
+    def add_channels(self, channels, ready=None):
+        """
+        Subscribes to more channels on the current connection, without
+        missing anything published on the existing ones.
+
+        :param channels: The channels to add.
+        :type channels: list
+        :param ready: The event to set once the channels are live (a new one
+            is created otherwise).
+        :type ready: :class:`threading.Event`
+        :return: The event set once the broker acknowledged the channels.
+        :rtype: :class:`threading.Event`
+        """
+        ready = ready or threading.Event()
+        with self.lock:
+            if self.confirmed.issuperset(channels):
+                ready.set()
+                return ready
+            self.waiting.append((set(channels), ready))
+            added = [channel for channel in channels if channel not in self.channels]
+            self.channels.extend(added)
+            if added and self.sock is not None:
+                try:
+                    self.sock.sendall(BSON.encode({'op': 'subscribe', 'channels': added}))
+                except OSError:
+                    # Subscribed again (with every channel) on reconnection.
+                    pass
+        return ready
+
+    def acknowledge(self, channels):
+        """
+        Records the channels confirmed by the broker and sets the events of
+        the subscriptions that are now live.
+
+        :param channels: The channels the broker confirmed.
+        :type channels: list
+        """
+        with self.lock:
+            self.confirmed.update(channels)
+            waiting = []
+            for wanted, ready in self.waiting:
+                if self.confirmed.issuperset(wanted):
+                    ready.set()
+                else:
+                    waiting.append((wanted, ready))
+            self.waiting = waiting
+
+    def close(self):
+        """
+        Closes the connection to the broker.
+        """
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+            self.sock = None
+            self.reader = None
+            self.confirmed = set()
+
+    def __next__(self):
+        received = self.receive()
+        if received is None:
+            return None
+        return received[1]
+
+    def receive(self):
+        """
+        Waits for the next message, up to ``timeout`` seconds.
+
+        :return: The channel the message was published on and the message,
+            or ``None`` if no message arrived in time.
+        :rtype: tuple
+        """
+        if self.backlog:
+            return self.backlog.popleft()
+        if self.reader is None:
+            try:
+                self.connect()
+            except OSError:
+                self.close()
+                time.sleep(self.timeout)
+                return None
+            if self.backlog:
+                return self.backlog.popleft()
+        try:
+            document = self.reader.read()
+        except (ConnectionError, OSError):
+            self.close()
+            return None
+        if document is None:
+            return None
+        if document.get('op') == 'subscribed':
+            self.acknowledge(document.get('channels', []))
+            return None
+        return document.get('channel'), document.get('message')
+
+class LocalPubSub(object):
+    """
+    A pubsub client that talks to Eva's local broker over a Unix domain
+    socket. Publishing reuses a single connection per process.
+    """
+    def __init__(self, path):
+        """
+        :param path: The Unix domain socket path the broker listens on.
+        :type path: string
+        """
+        self.path = path
+        self.sock = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        """
+        Publish a message to a channel. Messages published while no
+        subscriber is connected are dropped.
+
+        :param channel: The channel to publish in.
+        :type channel: string
+        :param message: The message to publish (anything BSON-encodable).
+        :type message: string or dict
+        """
+        frame = BSON.encode({'op': 'publish', 'channel': channel, 'message': message})
+        with self.lock:
+            try:
+                self.get_socket().sendall(frame)
+            except OSError:
+                # The broker may have restarted - retry once on a new connection.
+                self.sock = None
+                self.get_socket().sendall(frame)
+
+    def get_socket(self):
+        """
+        Returns the publishing connection, reconnecting after a fork.
+
+        :return: A socket connected to the broker.
+        :rtype: :class:`socket.socket`
+        """
+        if self.sock is None or self.pid != os.getpid():
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.path)
+            self.pid = os.getpid()
+        return self.sock
+
+    def subscribe(self, *channels):
+        """
+        Subscribe to one or many channels.
+
+        :return: An iterable yielding the messages published on ``channels``.
+        :rtype: :class:`LocalSubscriber`
+        """
+        subscriber = LocalSubscriber(self.path, channels)
+        # Register with the broker right away (connecting waits for the
+        # broker's acknowledgment) so that nothing published after this call is
+        # missed. The subscriber will retry on iteration otherwise.
+        try:
+            subscriber.connect()
+        except OSError:
+            subscriber.close()
+        return subscriber
@@ -0,0 +1,92 @@
+"""
+Holds the Metrics class used to record Eva's runtime statistics.
+"""
+
+import threading
+from bisect import bisect_left
+
+#: Default histogram bucket upper bounds (in seconds).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metrics(object):
+    """
+    A small, thread-safe, in-process registry of counters, gauges, and
+    histograms. Eva records things like queue depth and job durations here,
+    and plugins (a web UI for example) can read them back with
+    :func:`get_metrics`.
+
+    It should not be necessary to instantiate this class manually as this is
+    already done in the __init__.py file. Use `from eva import metrics` to use
+    a singleton instance of this class.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1):
+        """
+        Increments a counter.
+
+        :param name: The name of the counter.
+        :type name: string
+        :param value: The amount to increment the counter by.
+        :type value: integer
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        """
+        Sets a gauge to its current value.
+
+        :param name: The name of the gauge.
+        :type name: string
+        :param value: The current value.
+        :type value: float
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS):
+        """
+        Records a value (typically a duration in seconds) in a histogram.
+
+        :param name: The name of the histogram.
+        :type name: string
+        :param value: The observed value.
+        :type value: float
+        :param buckets: The bucket upper bounds used if the histogram is new.
+        :type buckets: tuple
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = {'count': 0,
+                             'sum': 0.0,
+                             'min': value,
+                             'max': value,
+                             'buckets': list(buckets),
+                             'counts': [0] * (len(buckets) + 1)}
+                self.histograms[name] = histogram
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['min'] = min(histogram['min'], value)
+            histogram['max'] = max(histogram['max'], value)
+            histogram['counts'][bisect_left(histogram['buckets'], value)] += 1
+
+    def get_metrics(self):
+        """
+        Returns a snapshot of every metric recorded so far.
+
+        :return: A dict with ``counters``, ``gauges``, and ``histograms`` keys.
+        :rtype: dict
+        """
+        with self.lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = dict(histogram, counts=list(histogram['counts']))
+            return {'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'histograms': histograms}
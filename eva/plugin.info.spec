@@ -6,4 +6,11 @@ description = string(default='No description')
 version = string(default='0.0.0')
 # List of Eva plugin dependencies for this plugin.
 dependencies = force_list(default=list())
+# Seconds this plugin's interaction hooks may run before being abandoned (-1 to
+# use the 'timeout' of the [hooks] configuration section, 0 for no deadline).
+hook_timeout = float(min=-1, default=-1)
+# Whether this plugin's eva.interaction hooks may run concurrently with other
+# plugins' hooks (when 'speculative' is enabled in the [hooks] section). The
+# first plugin to respond in gossip registration order still wins.
+speculative = boolean(default=False)
 # Use the requirements.txt for Python module dependencies.
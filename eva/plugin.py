@@ -9,7 +9,7 @@ import shutil
 import importlib
 import gossip
 from git import Repo
-from eva.config import get_eva_directory, get_config, get_plugin_config
+from eva.config import get_eva_directory, get_config, get_plugin_config, refresh_snapshot
 from eva import conf
 from eva import log
 
@@ -198,6 +198,7 @@ def enable_plugin(plugin_id, downloadable_plugins=None):
         if plugin_path not in sys.path: sys.path.insert(0, plugin_path)
         mod = importlib.import_module(plugin_id)
         conf['plugins'][plugin_id]['module'] = mod
+        refresh_snapshot()
         log.info('Plugin enabled: %s' %plugin_id)
         try:
             log.debug('Running %s.on_enable()' %plugin_id)
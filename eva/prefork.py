@@ -0,0 +1,661 @@
+"""
+Holds the WorkerPool class used to handle interactions in worker processes
+forked from the booted Eva server (``processes`` in the ``[director]``
+configuration section).
+"""
+
+import os
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import send_handle, recv_handle
+import gossip
+from eva import config
+from eva import log
+from eva import metrics
+
+#: The name of worker processes (see :func:`is_worker_process`).
+WORKER_NAME = 'eva-worker-%s'
+#: The name of the template process (see :class:`TemplateProcess`).
+TEMPLATE_NAME = 'eva-template'
+#: The pipe to the main process, in worker processes (see :func:`send_to_parent`).
+WORKER_CONN = None
+WORKER_CONN_LOCK = threading.Lock()
+#: Set while applying configuration updates made by another process, so that
+#: they are not sent back to it.
+SYNCING = threading.local()
+
+class TemplateProcess(object):
+    """
+    A copy of the booted Eva server that forks the worker processes.
+
+    The template is forked right after boot, before the main process starts
+    any thread (the scheduler, the pubsub broker, the configuration watcher,
+    the session reaper...), so forking it never copies a lock held by another
+    thread. Every worker process (including the ones replacing workers that
+    died) is forked from the template: workers share the plugins loaded on
+    boot copy-on-write, and never boot again.
+    """
+    def __init__(self, target, initializer=None, finalizer=None):
+        """
+        :param target: The function that handles a command in a worker
+            process (see :func:`run_worker`).
+        :type target: function
+        :param initializer: The function called in every worker process
+            before it handles any command.
+        :type initializer: function
+        :param finalizer: The function called in every worker process before
+            it exits.
+        :type finalizer: function
+        """
+        self.target = target
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Forks the template process. Must be called before the main process
+        starts any thread.
+        """
+        context = multiprocessing.get_context('fork')
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_template,
+                                       args=(child_conn, parent_conn, self.target,
+                                             self.initializer, self.finalizer),
+                                       name=TEMPLATE_NAME,
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+    def fork(self, index):
+        """
+        Asks the template to fork a worker process.
+
+        :param index: The position of the worker in the pool.
+        :type index: integer
+        :return: The PID of the worker process and the main process end of the
+            pipe connected to it.
+        :rtype: tuple
+        :raises RuntimeError: If the template process is gone.
+        """
+        parent_conn, child_conn = multiprocessing.Pipe()
+        try:
+            with self.lock:
+                self.conn.send(index)
+                send_handle(self.conn, child_conn.fileno(), self.process.pid)
+                pid = self.conn.recv()
+        except (EOFError, OSError) as err:
+            parent_conn.close()
+            raise RuntimeError('The template process exited (%s)' %err)
+        finally:
+            child_conn.close()
+        return pid, parent_conn
+
+    def stop(self):
+        """
+        Stops the template process (workers are stopped separately).
+        """
+        if self.process is None:
+            return
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+class WorkerProcess(object):
+    """
+    A single worker process forked by the template process, along with the
+    pipe used to hand it commands.
+
+    The main process sends ``('command', (data, text_to_speech))`` and
+    ``('config', updates)`` tuples on the pipe. Worker processes send
+    ``(kind, value)`` tuples: ``ready`` once started, ``done`` (with the error
+    message, if any) once a command was handled, ``restart`` (with the
+    arguments of :func:`eva.util.restart`) whenever a plugin asks for a
+    restart, and ``config`` (see :func:`forward_config_update`) whenever the
+    configuration is updated in the worker.
+    """
+    def __init__(self, index, template, on_restart=None, on_update=None):
+        """
+        :param index: The position of the worker in the pool (used in logs).
+        :type index: integer
+        :param template: The template process forking the worker.
+        :type template: :class:`TemplateProcess`
+        :param on_restart: The function called in the main process when the
+            worker process asks for a restart. It receives the restart arguments.
+        :type on_restart: function
+        :param on_update: The function called in the main process when the
+            configuration was updated in the worker process. It receives the
+            worker and the update.
+        :type on_update: function
+        """
+        self.index = index
+        self.template = template
+        self.on_restart = on_restart
+        self.on_update = on_update
+        self.pid = None
+        self.conn = None
+        #: The last configuration update sent to the worker (see :func:`WorkerPool.get_updates`).
+        self.seen = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Forks the worker process from the template and waits until it is
+        ready to handle commands.
+
+        :raises RuntimeError: If the worker process failed to start.
+        """
+        self.pid, self.conn = self.template.fork(self.index)
+        self.seen = 0
+        try:
+            self.receive()
+        except (EOFError, OSError):
+            raise RuntimeError('Worker process %s exited while starting' %self.index)
+        log.info('Started worker process %s (pid %s)' %(self.index, self.pid))
+
+    def restart(self):
+        """
+        Replaces a worker process that died.
+        """
+        log.warning('Worker process %s (pid %s) exited - restarting' %(self.index, self.pid))
+        metrics.increment('director.worker_restarts')
+        self.conn.close()
+        self.start()
+
+    def receive(self):
+        """
+        Waits for the next ``ready`` or ``done`` message from the worker
+        process, handling the restart requests and configuration updates
+        received in the meantime.
+
+        :return: The value of the message.
+        :raises EOFError: If the worker process exited.
+        """
+        while True:
+            kind, value = self.conn.recv()
+            if not self.dispatch(kind, value):
+                return value
+
+    def poll(self):
+        """
+        Handles the restart requests and configuration updates sent by an idle
+        worker process (from a plugin thread for example). Must be called while
+        holding the lock.
+
+        :raises EOFError: If the worker process exited.
+        """
+        while self.conn.poll():
+            kind, value = self.conn.recv()
+            self.dispatch(kind, value)
+
+    def dispatch(self, kind, value):
+        """
+        Handles a ``restart`` or ``config`` message.
+
+        :return: Whether or not the message was handled.
+        :rtype: boolean
+        """
+        if kind == 'restart':
+            log.info('Worker process %s asked for a restart' %self.index)
+            if self.on_restart is not None:
+                self.on_restart(value)
+            return True
+        if kind == 'config':
+            if self.on_update is not None:
+                self.on_update(self, value)
+            return True
+        return False
+
+    def sync(self, updates):
+        """
+        Sends configuration updates to the worker process. Must be called
+        while holding the lock.
+
+        :param updates: The updates (see :func:`WorkerPool.get_updates`).
+        :type updates: list
+        """
+        if updates:
+            self.conn.send(('config', updates))
+
+    def stop(self, timeout):
+        """
+        Closes the pipe, which makes the worker process exit once its buffers
+        are flushed (see :func:`run_worker`), and waits for it. The process is
+        terminated if it didn't exit in time.
+
+        :param timeout: Seconds to wait for the process to exit.
+        :type timeout: float
+        """
+        if self.pid is None:
+            return
+        self.conn.close()
+        deadline = time.time() + timeout
+        while self.is_alive() and time.time() < deadline:
+            time.sleep(0.05)
+        if self.is_alive():
+            log.warning('Worker process %s (pid %s) did not exit - terminating it' \
+                        %(self.index, self.pid))
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def is_alive(self):
+        """
+        :rtype: boolean
+        """
+        if self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def handle(self, data, text_to_speech, updates=None):
+        """
+        Hands a command to the worker process and waits until it is handled.
+
+        :param data: The data received from Eva clients.
+        :type data: dict
+        :param text_to_speech: Whether or not to run text-to-speech.
+        :type text_to_speech: boolean
+        :param updates: A function returning the configuration updates to
+            send first (see :func:`WorkerPool.get_updates`).
+        :type updates: function
+        :raises RuntimeError: If the command failed or the worker process died.
+        """
+        with self.lock:
+            if not self.is_alive():
+                self.restart()
+            try:
+                if updates is not None:
+                    self.sync(updates(self))
+                self.conn.send(('command', (data, text_to_speech)))
+                error = self.receive()
+            except (EOFError, OSError):
+                self.restart()
+                raise RuntimeError('Worker process %s died while handling a command' %self.index)
+        if error is not None:
+            raise RuntimeError(error)
+
+class WorkerPool(object):
+    """
+    A pool of worker processes handling interactions, so that CPU-heavy plugins
+    (speech recognition, NLP, etc.) are not limited to a single core.
+
+    Eva boots once, in the main process. :func:`start` then forks a template
+    process (see :class:`TemplateProcess`) before any thread is started, and
+    the template forks the workers: they inherit the loaded plugins and fire
+    the ``eva.post_fork`` trigger (for plugins to re-open their per-process
+    resources) after ``initializer`` is called. The scheduler never runs in
+    worker processes.
+
+    Commands are handed to an idle worker by :func:`handle`, which blocks until
+    the command was handled. A supervisor thread restarts workers that die.
+    Workers call ``finalizer`` (which flushes their buffered sessions and
+    history) before exiting, either when :func:`stop` closes their pipe or when
+    they are terminated.
+
+    Configuration updates (:func:`eva.config.update_config`, including the
+    ones made by the configuration watcher) are kept in sync: updates made in
+    the main process are sent to every worker before its next command (or
+    within ``check_interval`` seconds when idle), and updates made in a worker
+    are applied in the main process, which passes them on to the other workers.
+    The ``eva.config_reloaded`` trigger only fires in the main process.
+    """
+    def __init__(self, size, target, initializer=None, finalizer=None, on_restart=None,
+                 check_interval=1.0):
+        """
+        :param size: The number of worker processes.
+        :type size: integer
+        :param target: The function that handles a command in a worker process.
+        :type target: function
+        :param initializer: The function called in every worker process before
+            it handles any command.
+        :type initializer: function
+        :param finalizer: The function called in every worker process before
+            it exits.
+        :type finalizer: function
+        :param on_restart: The function called in the main process when a
+            worker process asks for a restart (see :func:`send_to_parent`).
+        :type on_restart: function
+        :param check_interval: Seconds between supervisor checks.
+        :type check_interval: float
+        """
+        self.template = TemplateProcess(target, initializer, finalizer)
+        self.workers = [WorkerProcess(index, self.template, on_restart, self.apply_update)
+                        for index in range(size)]
+        self.idle = queue.Queue()
+        self.check_interval = check_interval
+        self.stopping = threading.Event()
+        # The latest update of every configuration value, keyed by
+        # (section, plugin ID, key), as (sequence, origin worker PID, value).
+        self.updates = {}
+        self.sequence = 0
+        self.updates_lock = threading.Lock()
+
+    def start(self):
+        """
+        Forks the template process, starts every worker process and the
+        supervisor thread. Must be called before the main process starts any
+        thread.
+        """
+        self.template.start()
+        config.UPDATE_LISTENERS.append(self.config_updated)
+        for worker in self.workers:
+            worker.start()
+            self.idle.put(worker)
+        thread = threading.Thread(target=self.supervise, daemon=True)
+        thread.start()
+
+    def supervise(self):
+        """
+        The supervisor loop. Restarts idle workers that died (busy workers are
+        restarted by :func:`WorkerProcess.handle`), handles the messages of
+        idle workers, and sends them the configuration updates.
+        """
+        while not self.stopping.is_set():
+            time.sleep(self.check_interval)
+            for worker in self.workers:
+                if not worker.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if self.stopping.is_set():
+                        continue
+                    if not worker.is_alive():
+                        worker.restart()
+                        continue
+                    try:
+                        worker.poll()
+                        worker.sync(self.get_updates(worker))
+                    except (EOFError, OSError):
+                        worker.restart()
+                except Exception as err: #pylint: disable=W0703
+                    log.error('Could not restart worker process %s: %s' %(worker.index, err))
+                finally:
+                    worker.lock.release()
+
+    def handle(self, data, text_to_speech=True):
+        """
+        Hands a command to the next idle worker process and waits until it is
+        handled.
+
+        :param data: The data received from Eva clients.
+        :type data: dict
+        :param text_to_speech: Whether or not to run text-to-speech.
+        :type text_to_speech: boolean
+        """
+        worker = self.idle.get()
+        try:
+            worker.handle(data, text_to_speech, self.get_updates)
+        finally:
+            self.idle.put(worker)
+
+    def config_updated(self, values, section, plugin_id, save): #pylint: disable=W0613
+        """
+        Records a configuration update made in the main process (see
+        :data:`eva.config.UPDATE_LISTENERS`).
+        """
+        if not getattr(SYNCING, 'active', False):
+            self.record_update(values, section, plugin_id)
+
+    def apply_update(self, worker, update):
+        """
+        Applies a configuration update made in a worker process to the main
+        process, and records it for the other workers.
+
+        :param worker: The worker the update comes from.
+        :type worker: :class:`WorkerProcess`
+        :param update: The ``(values, section, plugin_id, save)`` of the update.
+        :type update: tuple
+        """
+        values, section, plugin_id, save = update
+        self.record_update(values, section, plugin_id, worker.pid)
+        SYNCING.active = True
+        try:
+            config.update_config(values, section, plugin_id, save)
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not apply the configuration update of worker process %s: %s' \
+                      %(worker.index, err))
+        finally:
+            SYNCING.active = False
+
+    def record_update(self, values, section, plugin_id, origin=None):
+        """
+        Records the values of a configuration update, to be sent to the
+        worker processes.
+
+        :param values: The updated configuration keys and their values.
+        :type values: dict
+        :param section: The updated Eva configuration section.
+        :type section: string
+        :param plugin_id: The plugin whose configuration was updated.
+        :type plugin_id: string
+        :param origin: The PID of the worker the update comes from (not sent
+            back to it).
+        :type origin: integer
+        """
+        with self.updates_lock:
+            for key, value in values.items():
+                self.sequence += 1
+                self.updates[(section, plugin_id, key)] = (self.sequence, origin, plain(value))
+
+    def get_updates(self, worker):
+        """
+        Gets the configuration updates a worker process has not seen yet, and
+        marks them as seen.
+
+        :param worker: The worker process.
+        :type worker: :class:`WorkerProcess`
+        :return: ``(section, plugin_id, values)`` tuples.
+        :rtype: list
+        """
+        grouped = {}
+        with self.updates_lock:
+            for (section, plugin_id, key), (sequence, origin, value) in self.updates.items():
+                if sequence > worker.seen and origin != worker.pid:
+                    grouped.setdefault((section, plugin_id), {})[key] = value
+            worker.seen = self.sequence
+        return [(section, plugin_id, values) for (section, plugin_id), values in grouped.items()]
+
+    def stop(self, timeout=5.0):
+        """
+        Stops every worker process once it is idle (see
+        :func:`WorkerProcess.stop`), then the template process.
+
+        :param timeout: Seconds to wait for every worker process to exit.
+        :type timeout: float
+        """
+        self.stopping.set()
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            with worker.lock:
+                worker.stop(max(deadline - time.time(), 0))
+        self.template.stop()
+
+def plain(value):
+    """
+    Converts configuration sections to plain dicts, so that they can be sent
+    to other processes.
+
+    :param value: A configuration value.
+    :return: The value, with sections replaced by dicts.
+    """
+    if isinstance(value, dict):
+        return dict((key, plain(item)) for key, item in value.items())
+    return value
+
+def is_worker_process():
+    """
+    :return: Whether or not this is a worker process.
+    :rtype: boolean
+    """
+    return multiprocessing.current_process().name.startswith(WORKER_NAME %'')
+
+def send_to_parent(kind, value=None):
+    """
+    Sends a message to the main process from a worker process (see
+    :class:`WorkerProcess`).
+
+    :param kind: The kind of message (``ready``, ``done``, ``restart``, or
+        ``config``).
+    :type kind: string
+    :param value: The value of the message.
+    """
+    with WORKER_CONN_LOCK:
+        WORKER_CONN.send((kind, value))
+
+def request_restart(args):
+    """
+    Asks the main process to restart Eva gracefully (see
+    :func:`eva.util.restart`). Worker processes never restart on their own: the
+    main process stops them while it drains.
+
+    :param args: A list of arguments to feed Eva on restart.
+    :type args: list
+    """
+    try:
+        send_to_parent('restart', list(args))
+    except (OSError, ValueError) as err:
+        log.error('Could not ask the main process for a restart: %s' %err)
+
+def forward_config_update(values, section, plugin_id, save):
+    """
+    Sends a configuration update made in a worker process to the main process
+    (registered in :data:`eva.config.UPDATE_LISTENERS` by :func:`run_worker`),
+    which saves it if asked to.
+    """
+    if getattr(SYNCING, 'active', False):
+        return
+    try:
+        send_to_parent('config', (plain(values), section, plugin_id, save))
+    except (OSError, ValueError) as err:
+        log.error('Could not send a configuration update to the main process: %s' %err)
+
+def apply_config_updates(updates):
+    """
+    Applies the configuration updates sent by the main process to a worker
+    process.
+
+    :param updates: ``(section, plugin_id, values)`` tuples.
+    :type updates: list
+    """
+    SYNCING.active = True
+    try:
+        for section, plugin_id, values in updates:
+            try:
+                config.update_config(values, section, plugin_id)
+            except Exception as err: #pylint: disable=W0703
+                log.error('Could not apply a configuration update: %s' %err)
+    finally:
+        SYNCING.active = False
+
+def run_template(conn, parent_conn, target, initializer=None, finalizer=None):
+    """
+    The template process loop (see :class:`TemplateProcess`). Forks a worker
+    process for every ``(index, pipe)`` received from the main process, until
+    the main process closes the pipe. Reaps the worker processes that exited.
+
+    :param conn: The template end of the pipe to the main process.
+    :type conn: :class:`multiprocessing.connection.Connection`
+    :param parent_conn: The main process end of the pipe (closed here).
+    :type parent_conn: :class:`multiprocessing.connection.Connection`
+    """
+    parent_conn.close()
+    while True:
+        try:
+            if conn.poll(1):
+                index = conn.recv()
+                handle = recv_handle(conn)
+                pid = os.fork()
+                if pid == 0:
+                    conn.close()
+                    multiprocessing.current_process().name = WORKER_NAME %index
+                    code = 0
+                    try:
+                        run_worker(Connection(handle), target, initializer, finalizer)
+                    except SystemExit as err:
+                        code = err.code if isinstance(err.code, int) else 0
+                    except BaseException: #pylint: disable=W0703
+                        code = 1
+                    finally:
+                        os._exit(code) #pylint: disable=W0212
+                os.close(handle)
+                conn.send(pid)
+        except (EOFError, OSError, RuntimeError):
+            return
+        reap_children()
+
+def reap_children():
+    """
+    Collects the exit status of the worker processes that exited.
+    """
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+def run_worker(conn, target, initializer=None, finalizer=None):
+    """
+    The worker process loop. Calls ``initializer`` and fires the
+    ``eva.post_fork`` trigger, then handles the commands and configuration
+    updates received from the main process until the pipe is closed (or the
+    process is terminated), and calls ``finalizer`` before exiting.
+
+    :param conn: The worker end of the pipe.
+    :type conn: :class:`multiprocessing.connection.Connection`
+    :param target: The function that handles a command.
+    :type target: function
+    :param initializer: The function called before handling any command.
+    :type initializer: function
+    :param finalizer: The function called before exiting.
+    :type finalizer: function
+    """
+    global WORKER_CONN #pylint: disable=W0603
+    WORKER_CONN = conn
+    config.UPDATE_LISTENERS[:] = [forward_config_update]
+    config.SAVE_LOCALLY = False
+    # Worker processes exit without running atexit functions - terminating
+    # one must go through the finalizer as well.
+    signal.signal(signal.SIGTERM, stop_worker)
+    try:
+        if initializer is not None:
+            initializer()
+        gossip.trigger('eva.post_fork')
+        send_to_parent('ready')
+        while True:
+            try:
+                kind, value = conn.recv()
+            except (EOFError, OSError):
+                return
+            if kind == 'config':
+                apply_config_updates(value)
+                continue
+            data, text_to_speech = value
+            try:
+                target(data, text_to_speech)
+                send_to_parent('done')
+            except Exception as err: #pylint: disable=W0703
+                log.error('Interaction failed in worker process: %s' %err)
+                send_to_parent('done', str(err))
+    finally:
+        if finalizer is not None:
+            finalizer()
+
+def stop_worker(signum, frame): #pylint: disable=W0613
+    """
+    Signal handler turning ``SIGTERM`` into a clean exit of :func:`run_worker`.
+    """
+    raise SystemExit(0)
@@ -0,0 +1,292 @@
+"""
+Replays the commands recorded by the command log (see
+:mod:`eva.command_log`) in order to reproduce and benchmark real workloads
+offline.
+
+Commands are sent at their recorded pace (``speed=1``), N times faster
+(``speed=N``), or as fast as possible (``speed=0``), either straight to
+:func:`eva.director.interact` in this process (``target='interact'``, plugins
+are loaded first) or to a running Eva server through the pubsub
+(``target='pubsub'``)::
+
+    python3 replay.py ~/eva/commands.log --speed=2 --target=pubsub
+
+Latency is measured from the time a command was due (not the time it was
+actually sent), so that a saturated server shows up as growing latency instead
+of a slower replay.
+
+Replayed commands are kept apart from the conversations of real clients: their
+session IDs are prefixed with ``replay-`` (see ``session_prefix``). With the
+``interact`` target, sessions are only kept in memory and the interactions are
+not recorded in the history. With the ``pubsub`` target, the server handles
+the commands as usual (including its history).
+"""
+
+import time
+import uuid
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from eva.command_log import read_command_log
+from eva.session import get_session_id
+from eva.util import get_pubsub
+from eva import conf
+
+#: The prefix of the session IDs of replayed commands.
+SESSION_PREFIX = 'replay-'
+
+def replay(path, target='interact', speed=1.0, concurrency=None, text_to_speech=False,
+           timeout=30.0, limit=None, session_prefix=SESSION_PREFIX):
+    """
+    Replays a command log and measures how Eva handled it.
+
+    :param path: The command log file.
+    :type path: string
+    :param target: Either ``interact`` or ``pubsub``.
+    :type target: string
+    :param speed: How many times faster than recorded the commands are sent
+        (0 for as fast as possible).
+    :type speed: float
+    :param concurrency: The number of interactions running at once with the
+        ``interact`` target (defaults to the ``workers`` setting of the
+        ``[director]`` section).
+    :type concurrency: integer
+    :param text_to_speech: Whether or not to fire the `eva.text_to_speech`
+        trigger with the ``interact`` target.
+    :type text_to_speech: boolean
+    :param timeout: Seconds to wait for a response with the ``pubsub``
+        target before counting it as an error.
+    :type timeout: float
+    :param limit: The maximum number of commands to replay.
+    :type limit: integer
+    :param session_prefix: The prefix added to the session ID of every command.
+    :type session_prefix: string
+    :return: The report (see :func:`get_report`).
+    :rtype: dict
+    """
+    if target == 'pubsub':
+        player = PubSubPlayer(timeout)
+    else:
+        player = InteractPlayer(concurrency or conf['director']['workers'], text_to_speech)
+    start = time.time()
+    first = None
+    for count, record in enumerate(read_command_log(path)):
+        if limit is not None and count >= limit:
+            break
+        if first is None:
+            first = record['time']
+        due = start
+        if speed > 0:
+            due = start + (record['time'] - first) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        player.send(get_replay_data(record['data'], session_prefix), due)
+    player.wait()
+    return get_report(player.latencies, player.errors, time.time() - start)
+
+def get_replay_data(data, session_prefix=SESSION_PREFIX):
+    """
+    :param data: A recorded command.
+    :type data: dict
+    :param session_prefix: The prefix added to the session ID.
+    :type session_prefix: string
+    :return: A copy of the command, with a prefixed session ID (the recorded
+        ``session_id`` or ``client_id``).
+    :rtype: dict
+    """
+    data = dict(data)
+    session_id = get_session_id(data)
+    if session_id is not None:
+        data['session_id'] = session_prefix + session_id
+    return data
+
+def get_report(latencies, errors, duration):
+    """
+    Summarizes a replay.
+
+    :param latencies: The latency of every successful command, in seconds.
+    :type latencies: list
+    :param errors: The number of failed (or unanswered) commands.
+    :type errors: integer
+    :param duration: The duration of the replay, in seconds.
+    :type duration: float
+    :return: A dict with the ``commands``, ``errors``, ``error_rate``,
+        ``duration``, ``throughput``, and ``p50``/``p90``/``p99``/``max``
+        latency (in seconds) of the replay.
+    :rtype: dict
+    """
+    commands = len(latencies) + errors
+    ordered = sorted(latencies)
+    report = {'commands': commands,
+              'errors': errors,
+              'error_rate': float(errors) / commands if commands else 0.0,
+              'duration': duration,
+              'throughput': commands / duration if duration > 0 else 0.0}
+    for name, percentile in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]:
+        report[name] = get_percentile(ordered, percentile)
+    return report
+
+def get_percentile(ordered, percentile):
+    """
+    :param ordered: Sorted values.
+    :type ordered: list
+    :param percentile: The percentile (0 to 100).
+    :type percentile: float
+    :return: The nearest-rank percentile of the values (``None`` if empty).
+    :rtype: float
+    """
+    if not ordered:
+        return None
+    rank = int(round(percentile / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+class InteractPlayer(object):
+    """
+    Replays commands through :func:`eva.director.interact` in a thread pool.
+    Sessions are kept in memory (see :class:`eva.session.MemorySessionStore`)
+    and the history is not recorded.
+
+    At most ``concurrency * 2`` commands are queued at once (like
+    :func:`eva.director.interact_many`): sending waits for the oldest command
+    beyond that, so that a fast replay doesn't queue the whole log in memory.
+    """
+    def __init__(self, concurrency, text_to_speech):
+        # Imported here so that replaying to the pubsub doesn't import plugins.
+        from eva import director
+        from eva.session import MemorySessionStore
+        director.boot()
+        director.start_scheduler()
+        self.state = dict(director.get_interaction_state(),
+                          sessions=MemorySessionStore(), history=None)
+        self.run_interaction = director.run_interaction
+        self.text_to_speech = text_to_speech
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def send(self, data, due):
+        """
+        Queues an interaction.
+
+        :param data: The recorded command.
+        :type data: dict
+        :param due: The time the command was due.
+        :type due: float
+        """
+        if len(self.pending) >= self.concurrency * 2:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self.run, data, due))
+
+    def run(self, data, due):
+        """
+        Runs an interaction and records its latency.
+        """
+        try:
+            self.run_interaction(data, self.text_to_speech, self.state)
+        except Exception: #pylint: disable=W0703
+            with self.lock:
+                self.errors += 1
+            return
+        with self.lock:
+            self.latencies.append(time.time() - due)
+
+    def wait(self):
+        """
+        Waits for every interaction to finish.
+        """
+        self.executor.shutdown(wait=True)
+
+class PubSubPlayer(object):
+    """
+    Replays commands to a running Eva server. Commands are sent with the
+    player's own client ID (so responses come back on its reply channel) and a
+    new request ID, keeping their (prefixed) session ID. Busy responses and
+    commands left unanswered count as errors.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.pubsub = get_pubsub()
+        self.client_id = 'replay-%s' %uuid.uuid4().hex
+        self.lock = threading.Lock()
+        # The due time of every outstanding request, by request ID.
+        self.pending = {}
+        self.latencies = []
+        self.errors = 0
+        self.subscriber = self.pubsub.subscribe('eva_responses_%s' %self.client_id)
+        thread = threading.Thread(target=self.receive, daemon=True)
+        thread.start()
+
+    def send(self, data, due):
+        """
+        Publishes a command.
+
+        :param data: The recorded command.
+        :type data: dict
+        :param due: The time the command was due.
+        :type due: float
+        """
+        request_id = uuid.uuid4().hex
+        data.update({'client_id': self.client_id, 'request_id': request_id})
+        with self.lock:
+            self.pending[request_id] = due
+        self.pubsub.publish('eva_commands', data)
+
+    def receive(self):
+        """
+        Matches responses with their requests. Runs in a background thread.
+        """
+        for message in self.subscriber:
+            if not isinstance(message, dict):
+                continue
+            with self.lock:
+                due = self.pending.pop(message.get('request_id'), None)
+                if due is None:
+                    continue
+                if message.get('busy'):
+                    self.errors += 1
+                else:
+                    self.latencies.append(time.time() - due)
+
+    def wait(self):
+        """
+        Waits for the outstanding responses, counting the ones that don't
+        arrive within the timeout as errors.
+        """
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            with self.lock:
+                if not self.pending:
+                    break
+            time.sleep(0.1)
+        with self.lock:
+            self.errors += len(self.pending)
+            self.pending.clear()
+
+def main():
+    """
+    Replays a command log from the command line and prints the report.
+    """
+    parser = argparse.ArgumentParser(description='Replay commands recorded by the Eva command log.')
+    parser.add_argument('path', help='The command log file')
+    parser.add_argument('--target', help='Where to send the commands', choices=['interact', 'pubsub'], default='interact')
+    parser.add_argument('--speed', help='Times faster than recorded (0 for as fast as possible)', type=float, default=1.0)
+    parser.add_argument('--concurrency', help='Interactions running at once (interact target)', type=int)
+    parser.add_argument('--text-to-speech', help='Fire text-to-speech (interact target)', action='store_true')
+    parser.add_argument('--timeout', help='Seconds to wait for a response (pubsub target)', type=float, default=30.0)
+    parser.add_argument('--limit', help='Maximum number of commands to replay', type=int)
+    parser.add_argument('--session-prefix', help='Prefix added to the session IDs of the commands', default=SESSION_PREFIX)
+    args = parser.parse_args()
+    report = replay(args.path, args.target, args.speed, args.concurrency,
+                    args.text_to_speech, args.timeout, args.limit, args.session_prefix)
+    print('Commands:   %s' %report['commands'])
+    print('Errors:     %s (%.2f%%)' %(report['errors'], report['error_rate'] * 100))
+    print('Duration:   %.2f seconds' %report['duration'])
+    print('Throughput: %.2f commands per second' %report['throughput'])
+    for name in ['p50', 'p90', 'p99', 'max']:
+        if report[name] is not None:
+            print('Latency %-3s %.1f ms' %(name + ':', report[name] * 1000))
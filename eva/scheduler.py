@@ -2,12 +2,190 @@
 Holds functions required to start and manage the Eva scheduler.
 """
 
+import time
+import datetime
+import threading
+from collections import deque
 import gossip
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.jobstores.mongodb import MongoDBJobStore
-from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+from apscheduler.executors.pool import ThreadPoolExecutor, ProcessPoolExecutor
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.events import EVENT_ALL, EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, \
+    EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_ADDED, \
+    EVENT_JOB_MODIFIED, EVENT_JOB_REMOVED
 from eva.util import get_mongo_client
 from eva import conf
+from eva import log
+from eva import metrics
+
+class JobMonitor(object):
+    """
+    Records `APScheduler <https://apscheduler.readthedocs.io/en/latest/>`_ job
+    statistics in the :class:`eva.metrics.Metrics` singleton. For every job ID:
+
+        * ``scheduler.<job_id>.duration``: Histogram of run durations (seconds
+          from the job submission to its completion)
+        * ``scheduler.<job_id>.queue_lag``: Histogram of the delay between the
+          scheduled run time and the job submission (the time spent waiting
+          for the scheduler, which is not part of the duration)
+        * ``scheduler.<job_id>.running``: Gauge of running instances
+        * ``scheduler.<job_id>.errors``, ``.misfires``, and
+          ``.max_instances_skipped``: Counters
+
+    Interval jobs whose run duration reaches ``slow_job_ratio`` (``[scheduler]``
+    configuration section) of their interval are logged and fire the
+    `eva.scheduler.slow_job` trigger. Job intervals are looked up when a job
+    is added or modified (or the first time a job loaded from a persistent job
+    store runs), not on every run.
+    """
+    def __init__(self, scheduler):
+        """
+        :param scheduler: The scheduler whose events are monitored.
+        :type scheduler: `apscheduler.schedulers.base.BaseScheduler
+            <https://apscheduler.readthedocs.io/en/latest/modules/schedulers/base.html>`_
+        """
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        # The submission time of the runs that have not finished.
+        self.submitted = {}
+        # The completion time of the runs whose submission was not dispatched yet.
+        self.finished = {}
+        self.running = {}
+        self.intervals = {}
+
+    def running_jobs(self):
+        """
+        Returns the number of job runs that were submitted but have not finished.
+
+        :rtype: integer
+        """
+        with self.lock:
+            return sum(self.running.values())
+
+    def handle_event(self, event):
+        """
+        The listener registered for all APScheduler events.
+        Fires the `eva.scheduler.event` trigger for every event.
+
+        :param event: The APScheduler event.
+        :type event: `apscheduler.events.SchedulerEvent
+            <https://apscheduler.readthedocs.io/en/latest/modules/events.html>`_
+        """
+        if event.code == EVENT_JOB_SUBMITTED:
+            self.job_submitted(event)
+        elif event.code in (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR):
+            self.job_finished(event)
+        elif event.code == EVENT_JOB_MISSED:
+            metrics.increment('scheduler.%s.misfires' %event.job_id)
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            metrics.increment('scheduler.%s.max_instances_skipped' %event.job_id)
+        elif event.code in (EVENT_JOB_ADDED, EVENT_JOB_MODIFIED):
+            self.update_interval(event.job_id, event.jobstore)
+        elif event.code == EVENT_JOB_REMOVED:
+            with self.lock:
+                self.intervals.pop(event.job_id, None)
+        gossip.trigger('eva.scheduler.event', event=event)
+
+    def update_interval(self, job_id, jobstore):
+        """
+        Looks up (and remembers) the interval of a job, or ``None`` if it isn't
+        an interval job.
+        """
+        job = self.scheduler.get_job(job_id, jobstore)
+        interval = None
+        if job is not None and isinstance(job.trigger, IntervalTrigger):
+            interval = job.trigger.interval_length
+        with self.lock:
+            self.intervals[job_id] = interval
+
+    def job_submitted(self, event):
+        """
+        Records the queue lag of a job run and when it was submitted. Runs in
+        the scheduler thread.
+
+        Short jobs may finish before this event is dispatched, in which case
+        their duration is recorded now.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        submitted = time.time()
+        if event.job_id not in self.intervals:
+            self.update_interval(event.job_id, event.jobstore)
+        for run_time in event.scheduled_run_times:
+            metrics.observe('scheduler.%s.queue_lag' %event.job_id,
+                            (now - run_time).total_seconds())
+            key = (event.job_id, run_time)
+            with self.lock:
+                finished = self.finished.pop(key, None)
+                if finished is None:
+                    self.submitted[key] = submitted
+                    self.running[event.job_id] = self.running.get(event.job_id, 0) + 1
+                running = self.running.get(event.job_id, 0)
+            metrics.set_gauge('scheduler.%s.running' %event.job_id, running)
+            if finished is not None:
+                self.record_run(event.job_id, max(0.0, finished - submitted))
+
+    def job_finished(self, event):
+        """
+        Records the duration of a job run, from its submission. Runs in the
+        executor thread that ran the job.
+        """
+        now = time.time()
+        if event.code == EVENT_JOB_ERROR:
+            metrics.increment('scheduler.%s.errors' %event.job_id)
+        key = (event.job_id, event.scheduled_run_time)
+        with self.lock:
+            submitted = self.submitted.pop(key, None)
+            if submitted is not None:
+                self.running[event.job_id] -= 1
+            else:
+                # The submission event has not been dispatched yet.
+                self.finished[key] = now
+            running = self.running.get(event.job_id, 0)
+        metrics.set_gauge('scheduler.%s.running' %event.job_id, running)
+        if submitted is not None:
+            self.record_run(event.job_id, max(0.0, now - submitted))
+
+    def record_run(self, job_id, duration):
+        """
+        Records a job run duration and flags interval jobs that are taking
+        almost as long as their interval to run.
+
+        :param job_id: The ID of the job.
+        :type job_id: string
+        :param duration: The run duration in seconds.
+        :type duration: float
+        """
+        metrics.observe('scheduler.%s.duration' %job_id, duration)
+        with self.lock:
+            interval = self.intervals.get(job_id)
+        if interval and duration >= interval * conf['scheduler']['slow_job_ratio']:
+            log.warning('Scheduler job %s took %.2fs to run (interval is %ss)'
+                        %(job_id, duration, interval))
+            gossip.trigger('eva.scheduler.slow_job',
+                           job_id=job_id,
+                           duration=duration,
+                           interval=interval)
+
+#: The :class:`JobMonitor` of the Eva scheduler.
+JOB_MONITOR = None
+
+def wait_for_jobs(deadline):
+    """
+    Waits for the running scheduler jobs to finish. Used when restarting Eva
+    so that jobs aren't killed mid-execution.
+
+    :param deadline: The time (as returned by ``time.time()``) to stop waiting.
+    :type deadline: float
+    :return: ``True`` if no job is running anymore, ``False`` on timeout.
+    :rtype: boolean
+    """
+    while JOB_MONITOR is not None and JOB_MONITOR.running_jobs() > 0:
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.1)
+    return True
 
 def job_failed(event):
     """
@@ -43,25 +221,49 @@ def get_scheduler():
             # This will fire off the job immediately.
             scheduler.add_job(func_name, id="eva_<plugin_id>_job")
 
-    .. todo::
+    All scheduler events are recorded by a :class:`JobMonitor`.
+
+    :note: The ``conf`` singleton is not thread-safe. Jobs should read
+        configuration from :func:`eva.config.get_snapshot` and change it with
+        :func:`eva.config.update_config`.
 
-        Need to add listeners for all event types:
-        https://apscheduler.readthedocs.io/en/latest/modules/events.html#event-codes
+    The executors, job stores, and job defaults are configured in the
+    ``[scheduler]`` section of the Eva configuration file. Besides the default
+    thread pool and job store, jobs can target:
 
-    :note: This function most likely needs to be revisited as it may not be
-        thread-safe. Eva and plugins can modify the config singleon
-        simultaneously inside and outside of jobs.
+        * ``executor='processpool'`` to run CPU-heavy jobs in a separate process
+          (only if ``process_pool_size`` is greater than 0)
+        * ``jobstore='memory'`` to keep high-frequency jobs out of MongoDB
 
     :return: The scheduler object used by plugins to schedule long-running jobs.
     :rtype: `apscheduler.schedulers.background.BackgroundScheduler
         <https://apscheduler.readthedocs.io/en/latest/modules/schedulers/background.html>`_
     """
-    client = get_mongo_client()
-    db_name = conf['mongodb']['database']
-    scheduler = BackgroundScheduler(jobstore=MongoDBJobStore(database=db_name,
-                                                             collection='scheduler',
-                                                             client=client))
+    scheduler_conf = conf['scheduler']
+    executors = {'default': ThreadPoolExecutor(scheduler_conf['thread_pool_size'])}
+    if scheduler_conf['process_pool_size'] > 0:
+        executors['processpool'] = ProcessPoolExecutor(scheduler_conf['process_pool_size'])
+    jobstores = {'memory': MemoryJobStore()}
+    if scheduler_conf['job_store'] == 'mongodb':
+        jobstores['default'] = MongoDBJobStore(database=conf['mongodb']['database'],
+                                               collection='scheduler',
+                                               client=get_mongo_client())
+    else:
+        jobstores['default'] = MemoryJobStore()
+    job_defaults = {'coalesce': scheduler_conf['coalesce'],
+                    'misfire_grace_time': scheduler_conf['misfire_grace_time'],
+                    'max_instances': scheduler_conf['max_instances']}
+    scheduler = BackgroundScheduler(executors=executors,
+                                    jobstores=jobstores,
+                                    job_defaults=job_defaults)
     scheduler.add_listener(job_succeeded, EVENT_JOB_EXECUTED)
     scheduler.add_listener(job_failed, EVENT_JOB_ERROR)
-    scheduler.start()
+    global JOB_MONITOR #pylint: disable=W0603
+    JOB_MONITOR = JobMonitor(scheduler)
+    scheduler.add_listener(JOB_MONITOR.handle_event, EVENT_ALL)
+    # With worker processes, the director starts the scheduler once they are
+    # forked (see eva.director.start_scheduler): jobs only run in the main
+    # Eva process.
+    if conf['director']['processes'] == 0:
+        scheduler.start()
     return scheduler
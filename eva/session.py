@@ -0,0 +1,467 @@
+"""
+Holds the Session and SessionStore classes used to keep conversation state
+across interactions (available to plugins as ``context.session``).
+"""
+
+import os
+import re
+import copy
+import time
+import atexit
+import datetime
+import threading
+from collections import OrderedDict
+from pymongo import UpdateOne
+from eva.util import get_mongo_client, is_changed
+from eva import conf
+from eva import log
+
+#: The characters MongoDB doesn't accept in field names (before 5.0), escaped
+#: in session data keys along with the escape character itself.
+ESCAPED_CHARACTERS = {'%': '%25', '.': '%2E', '$': '%24'}
+UNESCAPED_CHARACTERS = dict((escaped, character) for character, escaped in ESCAPED_CHARACTERS.items())
+ESCAPED_PATTERN = re.compile('|'.join(UNESCAPED_CHARACTERS))
+
+def escape_keys(value):
+    """
+    Escapes the characters MongoDB rejects in field names (see
+    :data:`ESCAPED_CHARACTERS`) in every key of the (possibly nested)
+    dicts of a value, so that keys such as ``my_plugin.asked`` can be stored.
+
+    :param value: The value to write to MongoDB.
+    :return: A copy of the value with escaped keys.
+    """
+    if isinstance(value, dict):
+        return dict((escape_key(key), escape_keys(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [escape_keys(item) for item in value]
+    return value
+
+def escape_key(key):
+    """
+    :param key: A session data key.
+    :return: The key with the characters of :data:`ESCAPED_CHARACTERS` escaped.
+    """
+    if not isinstance(key, str):
+        return key
+    return ''.join(ESCAPED_CHARACTERS.get(character, character) for character in key)
+
+def unescape_keys(value):
+    """
+    Reverts :func:`escape_keys`.
+
+    :param value: The value read from MongoDB.
+    :return: A copy of the value with the original keys.
+    """
+    if isinstance(value, dict):
+        return dict((unescape_key(key), unescape_keys(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [unescape_keys(item) for item in value]
+    return value
+
+def unescape_key(key):
+    """
+    :param key: An escaped session data key (see :func:`escape_key`).
+    :return: The original key.
+    """
+    if not isinstance(key, str) or '%' not in key:
+        return key
+    return ESCAPED_PATTERN.sub(lambda match: UNESCAPED_CHARACTERS[match.group(0)], key)
+
+class Session(object):
+    """
+    The state of a conversation with a client. Plugins can store anything that
+    MongoDB can persist with dict-style access, and read the previous turns of
+    the conversation from :attr:`turns`. Keys may contain dots and dollar signs
+    (they are escaped in MongoDB, see :func:`escape_keys`)::
+
+        @gossip.register('eva.interaction')
+        def interaction(context):
+            if context.contains('again'):
+                last_turn = context.session.turns[-1]
+                context.set_output_text(last_turn['output_text'])
+            context.session['my_plugin.asked'] = True
+    """
+    def __init__(self, session_id, data=None, turns=None):
+        """
+        :param session_id: The client or conversation ID.
+        :type session_id: string
+        :param data: The values stored by plugins.
+        :type data: dict
+        :param turns: The previous turns of the conversation.
+        :type turns: list
+        """
+        #: The client or conversation ID.
+        self.session_id = session_id
+        #: The values stored by plugins.
+        self.data = data or {}
+        #: The previous turns of the conversation, oldest first. Each turn is a
+        #: dict with ``input_text``, ``output_text``, and ``time`` keys.
+        self.turns = turns or []
+        #: When this session was last used (as returned by ``time.time()``).
+        self.last_access = time.time()
+        self.lock = threading.RLock()
+        # Turns added since the session was last written to MongoDB.
+        self.pending_turns = []
+        self.max_turns = None
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.data[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def get(self, key, default=None):
+        """
+        Gets a value stored in the session.
+
+        :param key: The key of the value.
+        :type key: string
+        :param default: The value returned if the key is missing.
+        :return: The stored value.
+        """
+        with self.lock:
+            return self.data.get(key, default)
+
+    def add_turn(self, input_text, output_text, max_turns=20):
+        """
+        Records a turn of the conversation. Only the last ``max_turns`` turns
+        are kept.
+
+        :param input_text: The query or command from the client.
+        :type input_text: string
+        :param output_text: Eva's response.
+        :type output_text: string
+        :param max_turns: The number of turns to keep.
+        :type max_turns: integer
+        """
+        with self.lock:
+            turn = {'input_text': input_text,
+                    'output_text': output_text,
+                    'time': datetime.datetime.utcnow()}
+            self.turns.append(turn)
+            self.pending_turns.append(turn)
+            self.max_turns = max_turns
+            if len(self.turns) > max_turns:
+                del self.turns[:len(self.turns) - max_turns]
+
+    def copy(self):
+        """
+        :return: A deep copy of this session that can be changed without
+            touching this session (see :func:`merge`).
+        :rtype: :class:`Session`
+        """
+        with self.lock:
+            session = Session(self.session_id, copy.deepcopy(self.data), copy.deepcopy(self.turns))
+            session.max_turns = self.max_turns
+            return session
+
+    def merge(self, snapshot, working):
+        """
+        Applies the changes made to a copy of this session (see :func:`copy`).
+        Only the values that differ between ``snapshot`` and ``working`` are
+        written, so changes made to this session in the meantime are kept.
+
+        :param snapshot: An untouched copy of this session.
+        :type snapshot: :class:`Session`
+        :param working: The copy that was changed.
+        :type working: :class:`Session`
+        """
+        with self.lock:
+            for key, value in working.data.items():
+                if key not in snapshot.data or is_changed(snapshot.data[key], value):
+                    self.data[key] = value
+            for key in snapshot.data:
+                if key not in working.data:
+                    self.data.pop(key, None)
+            if working.pending_turns:
+                self.turns.extend(working.pending_turns)
+                self.pending_turns.extend(working.pending_turns)
+                self.max_turns = working.max_turns
+                if len(self.turns) > self.max_turns:
+                    del self.turns[:len(self.turns) - self.max_turns]
+
+    def get_update(self):
+        """
+        Gets the MongoDB update writing this session's data and appending the
+        turns added since the last call. Turns are pushed rather than replaced
+        so that turns written by other processes are kept.
+
+        :return: The update document.
+        :rtype: dict
+        """
+        with self.lock:
+            update = {'$set': {'data': escape_keys(self.data),
+                               'updated': datetime.datetime.utcnow()}}
+            if self.pending_turns:
+                update['$push'] = {'turns': {'$each': self.pending_turns,
+                                             '$slice': -self.max_turns}}
+                self.pending_turns = []
+            return update
+
+class SessionStore(object):
+    """
+    Keeps the sessions of active conversations, backed by the ``sessions``
+    MongoDB collection.
+
+    When ``cache`` is enabled, at most ``max_sessions`` sessions are kept in memory (least recently used
+    sessions are dropped first) and sessions unused for ``idle_timeout`` seconds
+    are dropped as well. Sessions are read from MongoDB when they are not in
+    memory. Changes are written behind: modified sessions are written in bulk
+    every ``write_delay`` seconds from a background thread (and before being
+    dropped from memory).
+
+    When ``cache`` is disabled, sessions are read from MongoDB on every
+    interaction and written as soon as they are saved. This is used with worker
+    processes (``processes`` in the ``[director]`` configuration section), as a
+    session cached by one worker would never see the changes made by another.
+    Turns are appended with ``$push`` either way, but the session's data is
+    written as a whole: when two interactions of the same conversation run at
+    once, the last one to be saved wins.
+    """
+    def __init__(self, max_sessions=1000, idle_timeout=600.0, write_delay=5.0, expire_after=0,
+                 cache=True):
+        """
+        :param max_sessions: The maximum number of sessions kept in memory.
+        :type max_sessions: integer
+        :param idle_timeout: Seconds before an unused session is dropped from memory.
+        :type idle_timeout: float
+        :param write_delay: Seconds between bulk writes of modified sessions.
+        :type write_delay: float
+        :param expire_after: Seconds before MongoDB deletes an unused session
+            (0 to keep sessions forever).
+        :type expire_after: integer
+        :param cache: Whether or not sessions are kept in memory and written
+            behind.
+        :type cache: boolean
+        """
+        self.cache = cache
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.write_delay = write_delay
+        self.expire_after = expire_after
+        self.sessions = OrderedDict()
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.connect_lock = threading.Lock()
+        self.collection = None
+        self.pid = None
+
+    def get_collection(self):
+        """
+        Gets the ``sessions`` collection, reconnecting (and restarting the
+        writer thread) in forked worker processes.
+
+        :return: The MongoDB collection holding the sessions.
+        :rtype: `pymongo.collection.Collection <http://api.mongodb.com/python/current/api/pymongo/collection.html>`_
+        """
+        with self.connect_lock:
+            if self.collection is None or self.pid != os.getpid():
+                self.connect()
+        return self.collection
+
+    def connect(self):
+        """
+        Connects to MongoDB and starts the writer thread.
+        """
+        collection = get_mongo_client()[conf['mongodb']['database']]['sessions']
+        if self.expire_after > 0:
+            collection.create_index('updated', expireAfterSeconds=self.expire_after)
+        self.collection = collection
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def get(self, session_id):
+        """
+        Gets a session, reading it from MongoDB if it isn't in memory (or if
+        the cache is disabled). A new session is created if it doesn't exist.
+
+        :param session_id: The client or conversation ID.
+        :type session_id: string
+        :return: The session.
+        :rtype: :class:`Session`
+        """
+        collection = self.get_collection()
+        if not self.cache:
+            return self.load(collection, session_id)
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                session.last_access = time.time()
+                return session
+        loaded = self.load(collection, session_id)
+        with self.lock:
+            # Another thread may have loaded the session in the meantime.
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = loaded
+                self.sessions[session_id] = session
+            evicted = self.evict()
+        self.write(evicted)
+        return session
+
+    def load(self, collection, session_id):
+        """
+        Reads a session from MongoDB, creating a new one if it doesn't exist.
+
+        :param collection: The ``sessions`` collection.
+        :param session_id: The client or conversation ID.
+        :type session_id: string
+        :return: The session.
+        :rtype: :class:`Session`
+        """
+        document = collection.find_one({'_id': session_id})
+        if document is None:
+            return Session(session_id)
+        return Session(session_id, unescape_keys(document.get('data')), document.get('turns'))
+
+    def save(self, session):
+        """
+        Marks a session as modified so that it gets written to MongoDB (right
+        away if the cache is disabled).
+
+        :param session: The modified session.
+        :type session: :class:`Session`
+        """
+        if not self.cache:
+            self.write([session])
+            return
+        with self.lock:
+            self.dirty[session.session_id] = session
+
+    def evict(self):
+        """
+        Drops the least recently used sessions (over ``max_sessions``) and idle
+        sessions from memory. Must be called while holding the lock.
+
+        :return: The modified sessions that were dropped and need to be written.
+        :rtype: list
+        """
+        evicted = []
+        cutoff = time.time() - self.idle_timeout
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and session.last_access >= cutoff:
+                break
+            del self.sessions[session_id]
+            if session_id in self.dirty:
+                evicted.append(self.dirty.pop(session_id))
+        return evicted
+
+    def run(self):
+        """
+        The writer loop. Writes modified sessions every ``write_delay`` seconds.
+        """
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(self.write_delay)
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every modified session to MongoDB immediately and drops idle
+        sessions from memory.
+        """
+        with self.lock:
+            sessions = list(self.dirty.values())
+            self.dirty.clear()
+            self.evict()
+        self.write(sessions)
+
+    def write(self, sessions):
+        """
+        Writes sessions to MongoDB with a single bulk write, logging any error.
+
+        :param sessions: The sessions to write.
+        :type sessions: list
+        """
+        if not sessions or self.collection is None:
+            return
+        requests = [UpdateOne({'_id': session.session_id}, session.get_update(), upsert=True)
+                    for session in sessions]
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception as err: #pylint: disable=W0703
+            log.error('Could not save %s sessions: %s' %(len(sessions), err))
+
+class MemorySessionStore(object):
+    """
+    A session store that keeps sessions in memory only, for interactions that
+    must not touch the conversations of real clients (see :mod:`eva.replay`).
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        """
+        Gets a session, creating it if it doesn't exist.
+
+        :param session_id: The client or conversation ID.
+        :type session_id: string
+        :return: The session.
+        :rtype: :class:`Session`
+        """
+        with self.lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = Session(session_id)
+            return self.sessions[session_id]
+
+    def save(self, session):
+        """
+        Does nothing - sessions are never written.
+        """
+        pass
+
+    def flush(self):
+        """
+        Does nothing - sessions are never written.
+        """
+        pass
+
+#: The session store used by :func:`eva.director.interact` (see :func:`get_session_store`).
+SESSION_STORE = None
+
+def get_session_store():
+    """
+    Gets the session store, creating it from the ``[sessions]`` configuration
+    section on first use. Sessions are not cached in memory when the director
+    runs worker processes.
+
+    :return: The session store, or ``None`` if sessions are disabled.
+    :rtype: :class:`SessionStore`
+    """
+    global SESSION_STORE #pylint: disable=W0603
+    if SESSION_STORE is None and conf['sessions']['enabled']:
+        SESSION_STORE = SessionStore(conf['sessions']['max_sessions'],
+                                     conf['sessions']['idle_timeout'],
+                                     conf['sessions']['write_delay'],
+                                     conf['sessions']['expire_after'],
+                                     conf['director']['processes'] == 0)
+        atexit.register(SESSION_STORE.flush)
+    return SESSION_STORE
+
+def get_session_id(data):
+    """
+    Gets the session a command belongs to: the ``session_id`` provided by the
+    client, or its ``client_id``. Commands from clients that provide neither
+    don't belong to any session.
+
+    :param data: The data received from Eva clients.
+    :type data: dict
+    :return: The session ID, or ``None`` for anonymous commands.
+    :rtype: string
+    """
+    return data.get('session_id') or data.get('client_id')
@@ -9,6 +9,8 @@ from urllib.parse import quote_plus
 import gossip
 from pymongo import MongoClient
 from anypubsub import create_pubsub_from_settings
+from eva.ipc import LocalPubSub
+from eva.config import SAVE_QUEUE
 from eva import log
 from eva import conf
 
@@ -16,15 +18,59 @@ def restart(args=[]): #pylint: disable=W0102
     """
     Function used to restart Eva.
 
+    When the Eva server is running, the restart is graceful: Eva stops
+    accepting new commands, waits for the interactions in progress and the
+    running scheduler jobs to finish (up to ``drain_timeout`` seconds), and
+    remembers the last command consumed so that the new process resumes from
+    there. See :func:`eva.director.drain_and_restart` for details.
+
+    In worker processes (``processes`` in the ``[director]`` configuration
+    section), the request is forwarded to the main process, which restarts the
+    whole server.
+
     .. warning::
 
-        This will restart Eva immediately and kill all running scheduler jobs.
+        The restart happens in the background - this function returns
+        immediately when the Eva server is running. Otherwise (Local CLI for
+        example), Eva is restarted immediately.
 
     :param args: A list of arguments to feed Eva on restart.
     :type args: list
     """
-    args.insert(0, sys.argv[0])
-    os.execl(sys.executable, sys.executable, *args)
+    from eva import prefork
+    from eva.director import request_restart
+    if prefork.is_worker_process():
+        prefork.request_restart(args)
+    elif not request_restart(list(args)):
+        exec_eva(args)
+
+def is_changed(old, new):
+    """
+    Compares a copy of a value taken earlier with the current value.
+
+    :param old: The earlier copy.
+    :param new: The current value.
+    :return: Whether or not the value changed. Values that can't be compared
+        are considered changed.
+    :rtype: boolean
+    """
+    if old is new:
+        return False
+    try:
+        return bool(old != new)
+    except Exception: #pylint: disable=W0703
+        return True
+
+def exec_eva(args):
+    """
+    Replaces the current process with a new Eva process.
+    Pending configuration saves are written to disk first.
+
+    :param args: A list of arguments to feed Eva on restart.
+    :type args: list
+    """
+    SAVE_QUEUE.flush()
+    os.execl(sys.executable, sys.executable, sys.argv[0], *args)
 
 def get_mongo_client():
     """
@@ -53,9 +99,16 @@ def get_pubsub():
     """
     Helper function to get the pubsub client used to send and receive messages.
 
+    The backend is selected with the ``backend`` option of the ``[pubsub]``
+    configuration section. The ``local`` backend talks to the broker started
+    by :func:`eva.director.serve` over a Unix domain socket.
+
     :return: The pubsub object used to publish Eva messages to the clients.
     :rtype: `anypubsub.interfaces.PubSub  <https://github.com/smarzola/anypubsub>`_
+        or :class:`eva.ipc.LocalPubSub`
     """
+    if conf['pubsub']['backend'] == 'local':
+        return LocalPubSub(conf['pubsub']['socket_path'])
     mongo_client = get_mongo_client()
     return create_pubsub_from_settings({'backend': 'mongodb',
                                         'client': mongo_client,
@@ -0,0 +1,178 @@
+"""
+Holds the ConfigWatcher class used to reload configuration changes without
+restarting Eva.
+"""
+
+import os
+import threading
+import gossip
+from eva.config import get_config, get_plugin_config, update_config, mark_section_saved, \
+    is_written_by_eva
+from eva import conf
+from eva import log
+
+# Use inotify when available, fall back to polling file modification times.
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+class ConfigWatcher(object):
+    """
+    Watches Eva's configuration file and the plugin ``config_directory`` for
+    changes. Only the file that changed is re-validated, and only the
+    sections that differ are swapped into the live configuration (through
+    :func:`eva.config.update_config`).
+
+    Fires the `eva.config_reloaded` trigger for every changed section. Files
+    written by Eva itself (see :func:`eva.config.save_config`) are not
+    reloaded, since the live configuration already holds their values (and
+    may hold newer ones by the time the file is read).
+
+    Uses `inotify_simple <https://pypi.python.org/pypi/inotify_simple>`_ if it is
+    installed, otherwise file modification times are checked every
+    ``interval`` seconds.
+
+    .. note::
+
+        Some settings (``[mongodb]``, ``[pubsub]``, worker and pool sizes) are
+        only read on boot and still require a restart to take effect.
+    """
+    def __init__(self, interval=2.0):
+        """
+        :param interval: Seconds between checks when polling.
+        :type interval: float
+        """
+        self.interval = interval
+        self.config_file = conf.filename
+        self.config_dir = os.path.expanduser(conf['eva']['config_directory'])
+        self.mtimes = {}
+        self.stop_event = threading.Event()
+
+    def start(self):
+        """
+        Starts watching for configuration changes in a background thread.
+        """
+        self.mtimes = self.get_mtimes()
+        thread = threading.Thread(target=self.watch, daemon=True)
+        thread.start()
+        log.info('Watching configuration files for changes')
+
+    def stop(self):
+        """
+        Stops watching for configuration changes.
+        """
+        self.stop_event.set()
+
+    def watch(self):
+        """
+        The watcher loop. Waits for changes using inotify or polling, then
+        reloads the changed files.
+        """
+        inotify = self.get_inotify()
+        while not self.stop_event.is_set():
+            if inotify is None:
+                self.stop_event.wait(self.interval)
+            else:
+                inotify.read(timeout=int(self.interval * 1000), read_delay=100)
+            mtimes = self.get_mtimes()
+            changed = [path for path, mtime in mtimes.items()
+                       if self.mtimes.get(path) != mtime and not is_written_by_eva(path, mtime)]
+            self.mtimes = mtimes
+            for path in changed:
+                try:
+                    self.reload(path)
+                except Exception as err: #pylint: disable=W0703
+                    log.error('Could not reload configuration file %s: %s' %(path, err))
+
+    def get_inotify(self):
+        """
+        Sets up inotify watches on the directories holding the configuration
+        files. Directories are watched (rather than files) so that editors
+        replacing files on save are picked up.
+
+        :return: The inotify object, or ``None`` if inotify is unavailable.
+        """
+        if INotify is None:
+            return None
+        inotify = INotify()
+        watch_flags = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE
+        directories = set([self.config_dir])
+        if self.config_file is not None:
+            directories.add(os.path.dirname(os.path.abspath(self.config_file)))
+        for directory in directories:
+            if os.path.isdir(directory):
+                inotify.add_watch(directory, watch_flags)
+        return inotify
+
+    def get_mtimes(self):
+        """
+        Gets the modification times of every watched configuration file.
+
+        :return: The modification time (in nanoseconds) of every watched file,
+            keyed by path.
+        :rtype: dict
+        """
+        paths = []
+        if self.config_file is not None:
+            paths.append(self.config_file)
+        if os.path.isdir(self.config_dir):
+            for file_name in os.listdir(self.config_dir):
+                if file_name.endswith('.conf'):
+                    paths.append(os.path.join(self.config_dir, file_name))
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+        return mtimes
+
+    def reload(self, path):
+        """
+        Re-validates a changed configuration file and applies its changes.
+
+        :param path: The path of the configuration file that changed.
+        :type path: string
+        """
+        if path == self.config_file:
+            new_config = get_config(path)
+            for section in new_config:
+                if section in conf:
+                    self.apply(new_config[section], conf[section], section=section)
+                    mark_section_saved(section, new_config[section], defaults=False)
+            return
+        plugin_id = os.path.basename(path)[:-len('.conf')]
+        if plugin_id not in conf.get('plugins', {}):
+            return
+        new_config = get_plugin_config(plugin_id, self.config_dir)
+        self.apply(new_config, conf['plugins'][plugin_id]['config'], plugin_id=plugin_id)
+
+    def apply(self, new_values, old_values, section=None, plugin_id=None): #pylint: disable=R0201
+        """
+        Swaps the values that changed into the live configuration.
+
+        Only the changed keys are passed to :func:`eva.config.update_config`,
+        so values that plugins changed at runtime for other keys are kept.
+        Keys removed from the file (that the specification doesn't fill in
+        again) keep their live value.
+
+        :param new_values: The freshly loaded configuration values.
+        :type new_values: dict
+        :param old_values: The live configuration values.
+        :type old_values: dict
+        :param section: The Eva configuration section being reloaded.
+        :type section: string
+        :param plugin_id: The plugin whose configuration is being reloaded.
+        :type plugin_id: string
+        """
+        diff = {}
+        for key in new_values:
+            if new_values[key] != old_values.get(key):
+                diff[key] = (old_values.get(key), new_values[key])
+        if not diff:
+            return
+        log.info('Reloading configuration (%s): %s' %(plugin_id or section, ', '.join(diff)))
+        update_config(dict((key, new) for key, (_, new) in diff.items()),
+                      section=section, plugin_id=plugin_id)
+        gossip.trigger('eva.config_reloaded', section=section, plugin_id=plugin_id, diff=diff)
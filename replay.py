@@ -0,0 +1,8 @@
+#!/usr/bin/python3
+"""
+Convenience script to replay commands recorded by the Eva command log (see
+``python3 replay.py --help``).
+"""
+
+import eva.replay
+eva.replay.main()
@@ -4,7 +4,10 @@ Convenience script to start up the Eva server.
 """
 
 import eva.director
-try:
-    eva.director.serve()
-except KeyboardInterrupt:
-    print('You may need to CTRL-C a few more times...')
+
+# Worker processes (see eva.prefork) import this script again.
+if __name__ == '__main__':
+    try:
+        eva.director.serve()
+    except KeyboardInterrupt:
+        print('You may need to CTRL-C a few more times...')
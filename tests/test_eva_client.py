@@ -0,0 +1,56 @@
+"""
+Tests the client library (``clients/eva_client.py``) against a local pubsub
+broker and a stand-in Eva server that echoes every command back.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clients'))
+from eva.ipc import LocalBroker
+from eva_client import EvaClient
+from local_pubsub import LocalPubSub
+
+def echo(path, ready):
+    """
+    Answers every command on the client's reply channel, like Eva does
+    (except for commands asking not to be answered).
+    """
+    pubsub = LocalPubSub(path)
+    subscriber = pubsub.subscribe('eva_commands')
+    ready.set()
+    for data in subscriber:
+        if isinstance(data, dict) and not data.get('ignore'):
+            pubsub.publish('eva_responses_%s' %data['client_id'],
+                           {'request_id': data['request_id'],
+                            'output_text': data['input_text']})
+
+class EvaClientTest(unittest.TestCase):
+    """
+    Tests :class:`eva_client.EvaClient`.
+    """
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'eva.sock')
+        LocalBroker(self.path).start()
+        ready = threading.Event()
+        threading.Thread(target=echo, args=(self.path, ready), daemon=True).start()
+        self.assertTrue(ready.wait(5))
+
+    def test_request_right_after_connect(self):
+        client = EvaClient.connect(socket_path=self.path, timeout=5)
+        futures = [client.request('command %s' %index) for index in range(5)]
+        responses = [future.result() for future in futures]
+        self.assertEqual([response['output_text'] for response in responses],
+                         ['command %s' %index for index in range(5)])
+        self.assertEqual(client.outstanding(), 0)
+
+    def test_timeout(self):
+        client = EvaClient.connect(socket_path=self.path, timeout=5)
+        future = client.request('unanswered', timeout=0.2, ignore=True)
+        self.assertRaises(TimeoutError, future.result, 5)
+        self.assertEqual(client.outstanding(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Runs the endpointer benchmark (``clients/benchmarks/vad.py``) on its synthetic
+recordings, so that threshold or noise floor changes that cut, miss, or invent
+speech are caught.
+"""
+
+import os
+import sys
+import unittest
+import importlib.util
+CLIENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clients')
+sys.path.insert(0, CLIENTS)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def load_benchmark():
+    """
+    Loads the benchmark module (named ``vad`` like the endpointer module).
+    """
+    spec = importlib.util.spec_from_file_location(
+        'vad_benchmark', os.path.join(CLIENTS, 'benchmarks', 'vad.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class EndpointerTest(unittest.TestCase):
+    """
+    Tests :class:`vad.Endpointer`.
+    """
+    def setUp(self):
+        self.benchmark = load_benchmark()
+        self.endpointer = self.benchmark.Endpointer(self.benchmark.SAMPLE_RATE)
+
+    def test_synthetic_fixtures(self):
+        for name, samples, start, end in self.benchmark.synthetic_fixtures():
+            self.benchmark.evaluate(self.endpointer, samples)
+            start_error, end_error, cut = self.benchmark.score(self.endpointer, start, end)
+            if start is None:
+                self.assertIsNone(cut, name)
+                continue
+            self.assertEqual(cut, 'no', name)
+            self.assertLess(abs(start_error), 0.1, name)
+            self.assertLess(abs(end_error), 0.1, name)
+
+    def test_recording_shorter_than_noise_seed(self):
+        fixture = self.benchmark.synthetic_fixtures()[0]
+        samples = fixture[1][:int(0.2 * self.benchmark.SAMPLE_RATE)]
+        sent, recorded = self.benchmark.evaluate(self.endpointer, samples)
+        self.assertEqual(recorded, len(samples))
+        self.assertLessEqual(sent, recorded)
+        self.assertIsNotNone(self.endpointer.noise_floor)
+
+if __name__ == '__main__':
+    unittest.main()